@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark recall/latenza di index FAISS approssimati (HNSW, IVF, PQ)
+
+Gli index candidati vengono costruiti dai vettori dell'indice corrente (nessun
+nuovo embedding) nello stesso ordine di posizione, quindi BM25 e indice dei
+metadati restano allineati e HybridRetriever può usarli al posto di quello esatto.
+
+Per ogni configurazione vengono riportati:
+- recall@k rispetto alla ricerca esatta (Flat) sulle query del dataset di valutazione
+- latenza media e p95 per query, memoria dell'index e tempo di build/training
+- MRR e MAP della ricerca ibrida completa (solo senza --scale)
+
+Con --scale N l'indice viene ampliato con copie perturbate dei vettori per
+stimare recall e latenza su un vault N volte più grande di quello attuale.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import faiss
+
+from retrieval_evaluation import RetrievalEvaluator
+from evaluation_dataset import EVALUATION_DATASET
+from core.vector_store import set_search_params
+
+K_VALUES = [1, 3, 5, 10]
+EF_SEARCH_GRID = [16, 32, 64, 128]
+NPROBE_GRID = [1, 4, 16, 64]
+MIN_RECALL = 0.95  # Recall@k minima per la raccomandazione
+
+
+def default_specs(n_vectors, dim):
+    """Spec di faiss.index_factory adatte alla dimensione dell'indice"""
+    nlist = max(1, int(np.sqrt(n_vectors)))
+    pq_m = next((m for m in (48, 32, 16, 8) if dim % m == 0 and m <= dim // 4), None)  # >= 4 dimensioni per sottoquantizzatore
+    specs = [("Flat", {}), ("HNSW32", {"ef_search": EF_SEARCH_GRID})]
+    if n_vectors >= nlist * 39:  # FAISS consiglia almeno ~39 vettori per lista
+        specs.append((f"IVF{nlist},Flat", {"nprobe": NPROBE_GRID}))
+        if pq_m:
+            specs.append((f"IVF{nlist},PQ{pq_m}", {"nprobe": NPROBE_GRID}))
+    return specs
+
+
+def synthetic_vectors(vectors, scale, seed=0):
+    """Vettori originali più (scale - 1) copie con rumore gaussiano"""
+    if scale <= 1:
+        return vectors
+    rng = np.random.default_rng(seed)
+    noise_std = vectors.std(axis=0) * 0.1
+    copies = [vectors] + [
+        vectors + rng.normal(size=vectors.shape).astype(np.float32) * noise_std
+        for _ in range(scale - 1)
+    ]
+    return np.ascontiguousarray(np.vstack(copies), dtype=np.float32)
+
+
+def build_index(spec, vectors):
+    """Crea, addestra e popola un index; restituisce (index, secondi di build)"""
+    start = time.perf_counter()
+    index = faiss.index_factory(vectors.shape[1], spec, faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index, time.perf_counter() - start
+
+
+def measure_search(index, query_vectors, k, ground_truth):
+    """Recall@k rispetto a ground_truth e latenza per singola query (ms)"""
+    latencies = []
+    recalls = []
+    for query_vector, expected in zip(query_vectors, ground_truth):
+        start = time.perf_counter()
+        _, found = index.search(query_vector[np.newaxis, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(np.intersect1d(found[0][found[0] >= 0], expected)) / len(expected))
+    return {
+        f"recall_at_{k}": float(np.mean(recalls)),
+        "latency_ms_mean": float(np.mean(latencies)),
+        "latency_ms_p95": float(np.percentile(latencies, 95))
+    }
+
+
+def evaluate_retrieval(evaluator, index, k_values):
+    """MRR/MAP della ricerca ibrida con l'index indicato al posto di quello corrente"""
+    retriever = evaluator.hybrid_retriever
+    original_index = retriever.vector_store.index
+    retriever.vector_store.index = index
+    try:
+        retrieved = evaluator.retrieve_documents_batch([item["query"] for item in EVALUATION_DATASET],
+                                                       k=max(k_values))
+        results = [
+            evaluator.evaluate_single_query(query_data, k_values, retrieved_files=files)
+            for query_data, files in zip(EVALUATION_DATASET, retrieved)
+        ]
+    finally:
+        retriever.vector_store.index = original_index
+    summary = evaluator.summarize_results(results, k_values)
+    return {
+        "mean_reciprocal_rank": summary["mean_reciprocal_rank"],
+        "mean_average_precision": summary["mean_average_precision"]
+    }
+
+
+def run_benchmark(specs=None, k=10, scale=1, min_recall=MIN_RECALL, output_file="ann_benchmark_results.json"):
+    """
+    Confronta le configurazioni di index sul dataset di valutazione
+    
+    Args:
+        specs: Lista di (spec, griglia parametri); default da default_specs
+        k: k per recall@k e ground truth esatta
+        scale: Fattore di ampliamento sintetico dell'indice
+        min_recall: Recall@k minima per la configurazione raccomandata
+        output_file: File JSON dei risultati
+    
+    Returns:
+        dict: Risultati per configurazione e raccomandazione
+    """
+    evaluator = RetrievalEvaluator()
+    retriever = evaluator.hybrid_retriever
+    
+    base_vectors = retriever.vector_store.index.reconstruct_n(0, retriever.vector_store.index.ntotal)
+    vectors = synthetic_vectors(base_vectors, scale)
+    query_vectors = retriever.embeddings.embed_queries_array([item["query"] for item in EVALUATION_DATASET])
+    specs = specs or default_specs(len(vectors), vectors.shape[1])
+    
+    print(f"📐 Indice: {len(vectors)} vettori (scala {scale}x), dimensione {vectors.shape[1]}")
+    print(f"🔍 Query di valutazione: {len(query_vectors)}")
+    
+    # Ground truth esatta
+    exact_index, _ = build_index("Flat", vectors)
+    _, ground_truth = exact_index.search(query_vectors, k)
+    
+    results = []
+    for spec, grid in specs:
+        try:
+            index, build_seconds = build_index(spec, vectors)
+        except RuntimeError as e:
+            print(f"⚠️ {spec}: build non riuscita ({e})")
+            continue
+        memory_mb = len(faiss.serialize_index(index)) / (1024 * 1024)
+        
+        param_name, values = next(iter(grid.items()), (None, [None]))
+        for value in values:
+            if param_name:
+                set_search_params(index, **{param_name: value})
+            
+            result = {
+                "index_spec": spec,
+                "nprobe": value if param_name == "nprobe" else None,
+                "ef_search": value if param_name == "ef_search" else None,
+                "build_seconds": build_seconds,
+                "memory_mb": memory_mb,
+                **measure_search(index, query_vectors, k, ground_truth)
+            }
+            if scale == 1:
+                result.update(evaluate_retrieval(evaluator, index, K_VALUES))
+            results.append(result)
+            
+            label = f"{spec}" + (f" {param_name}={value}" if param_name else "")
+            print(f"   {label:<28} recall@{k}={result[f'recall_at_{k}']:.3f} "
+                  f"lat={result['latency_ms_mean']:.2f}ms p95={result['latency_ms_p95']:.2f}ms "
+                  f"mem={memory_mb:.1f}MB" + (f" MRR={result['mean_reciprocal_rank']:.3f}" if scale == 1 else ""))
+    
+    # Configurazione più veloce sopra la soglia di recall
+    eligible = [r for r in results if r[f"recall_at_{k}"] >= min_recall]
+    best = min(eligible, key=lambda r: r["latency_ms_mean"]) if eligible else None
+    if best:
+        recommendation = (f"✅ RACCOMANDAZIONE: faiss_index_spec=\"{best['index_spec']}\""
+                          + (f", faiss_nprobe={best['nprobe']}" if best["nprobe"] else "")
+                          + (f", faiss_ef_search={best['ef_search']}" if best["ef_search"] else "")
+                          + f" (recall@{k}={best[f'recall_at_{k}']:.3f}, {best['latency_ms_mean']:.2f}ms)")
+    else:
+        recommendation = f"➡️ RACCOMANDAZIONE: nessuna configurazione con recall@{k} >= {min_recall}, mantenere Flat"
+    print(recommendation)
+    
+    output = {
+        "n_vectors": len(vectors),
+        "scale": scale,
+        "k": k,
+        "min_recall": min_recall,
+        "results": results,
+        "best": best,
+        "recommendation": recommendation
+    }
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(output, f, indent=2, ensure_ascii=False)
+    print(f"💾 Risultati salvati in {output_file}")
+    
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark recall/latenza di index FAISS approssimati")
+    parser.add_argument("--spec", action="append", default=None,
+                        help="Spec di faiss.index_factory da provare (ripetibile, default: Flat/HNSW/IVF/IVF-PQ)")
+    parser.add_argument("--k", type=int, default=10, help="k per recall@k")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="Amplia l'indice con copie sintetiche (es. 10 per un vault 10x)")
+    parser.add_argument("--min-recall", type=float, default=MIN_RECALL,
+                        help="Recall minima per la raccomandazione")
+    args = parser.parse_args()
+    
+    specs = None
+    if args.spec:
+        specs = [
+            (spec, {"ef_search": EF_SEARCH_GRID} if "HNSW" in spec else
+                   {"nprobe": NPROBE_GRID} if spec.startswith("IVF") else {})
+            for spec in args.spec
+        ]
+    run_benchmark(specs=specs, k=args.k, scale=args.scale, min_recall=args.min_recall)
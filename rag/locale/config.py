@@ -29,16 +29,80 @@ class Settings(BaseSettings):
     temperature: float = 0.1
     
     # Llamafile Configuration
-    use_llamafile_cli: bool = True   # Modalità CLI diretta (raccomandato)
-    use_llamafile_api: bool = False  # Modalità server HTTP (backup)
+    use_llamafile_server: bool = False  # Server persistente avviato e supervisionato da LLMAdapter (opt-in: avvia un processo)
+    use_llamafile_cli: bool = True   # Modalità CLI diretta (un processo per query, fallback)
+    use_llamafile_api: bool = False  # Modalità server HTTP esterno (backup)
+    llamafile_path: str = "/opt/llm/llamafiles/google_gemma-3-4b-it-Q6_K.llamafile"
     llamafile_base_url: str = "http://127.0.0.1:8080"
     llamafile_timeout: int = 30  # Ridotto per Gemma3-4B (più veloce)
     llamafile_max_tokens: int = 2048  # Aumentato per risposte complete
     
+    # Server llamafile gestito
+    llamafile_gpu: str = "AUTO"             # Auto-detect GPU (ROCm); "disable" per solo CPU
+    llamafile_n_gpu_layers: int = 35        # Offload completo su GPU
+    llamafile_ctx_size: int = 8192
+    llamafile_threads: int = 8
+    llamafile_startup_timeout: int = 120    # Secondi per il caricamento del modello
+    llamafile_health_interval: int = 10     # Secondi tra i controlli di /health
+    llamafile_max_restarts: int = 5         # Riavvii automatici dopo crash entro la finestra
+    llamafile_restart_window: int = 600     # Secondi: i riavvii più vecchi non contano nel limite
+    llamafile_cache_prompt: bool = True     # Riusa la KV cache per il prefisso comune del prompt
+    llamafile_parallel: int = 1             # Slot del server (-np); con più slot ogni template di prompt ha il suo
+    llamafile_pool_size: int = 4            # Connessioni HTTP keep-alive verso il server (sync e async)
+    llamafile_health_ttl: int = 30          # Secondi di validità dello stato di /health in cache
+    
     # Retrieval Configuration - ridotti per Gemma3-4B
     top_k_chunks: int = 3  # Meno chunk per evitare prompt troppo lunghi
+    answer_reserve_tokens: int = 1024  # Token minimi riservati alla risposta (almeno i max_tokens della generazione)
+    context_margin_tokens: int = 64    # Margine per i confini tra chunk nel conteggio dei token
     chunk_size: int = 800  # Chunk più piccoli
     chunk_overlap: int = 200
+    # Struttura dell'index FAISS (stringa di faiss.index_factory): "Flat" esatto,
+    # "HNSW32" o "IVF1024,Flat" / "IVF1024,PQ32" per vault grandi (le eliminazioni
+    # su index non Flat ricostruiscono l'index dai vettori rimanenti)
+    faiss_index_spec: str = "Flat"
+    faiss_nprobe: int = 16      # Liste IVF visitate per query
+    faiss_ef_search: int = 64   # Ampiezza di ricerca HNSW
+    
+    # Ingestion
+    embedding_batch_size: int = 64          # Chunk per batch di embedding
+    ingest_workers: Optional[int] = None    # Processi per parsing/chunking (default: numero di CPU)
+    
+    # Shard per cliente (query_clienti)
+    client_shards_enabled: bool = False     # Usa un indice FAISS per cliente se disponibile
+    client_shards_path: Path = Path("client_shards")
+    shard_search_workers: int = 4           # Thread per la ricerca in parallelo sugli shard
+    
+    # Hybrid Retrieval - fusion dei risultati semantic + BM25
+    hybrid_fusion: str = "weighted"      # "weighted" (score pesati) o "rrf" (reciprocal rank fusion)
+    rrf_k: int = 60                      # Costante di smorzamento della RRF
+    
+    # Hybrid Retrieval - boost additivi applicati al fattore moltiplicativo (base 1.0)
+    boost_short_file: float = 0.3        # File corti (chunk unico)
+    boost_cliente: float = 0.8           # Cliente menzionato nella query
+    boost_recent: float = 0.2            # Documenti che citano l'anno boost_recent_year
+    boost_recent_year: int = 2025
+    boost_prices: float = 0.4            # Documenti con prezzi per query di costo
+    boost_date_exact: float = 1.5        # Journal del giorno richiesto
+    boost_date_calendar: float = 0.7     # Journal per query generiche di calendario
+    boost_corpus_cliente: float = 3.5    # corpus.md del cliente per query di informazioni generali
+    boost_corpus_generic: float = 0.2    # corpus.md di altri clienti per le stesse query
+    boost_file: float = 0.9              # File menzionato nella query (es. concorrenti.md)
+    boost_cliente_file: float = 2.0      # Cliente + file menzionati insieme
+    
+    # Reranking (Cross-Encoder)
+    reranker_model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    reranker_batch_size: int = 32        # Coppie query-chunk per batch di predict
+    reranker_max_length: int = 512       # Token massimi per coppia (troncamento)
+    reranker_top_n: int = 0              # Riordina solo i primi N candidati della fusion (0 = tutti)
+    rerank_cache_size: int = 4096        # Score (query, chunk) in LRU
+    
+    # Backend di inferenza CPU: "torch" (sentence-transformers) o "onnx" (int8 quantizzato,
+    # richiede optimum[onnxruntime]; l'export avviene al primo uso in onnx_models_path)
+    reranker_backend: str = "torch"
+    embedding_backend: str = "torch"
+    onnx_models_path: Path = Path("onnx_models")
+    onnx_embedding_max_length: int = 128  # max_seq_length sentence-transformers del modello di default
     
     # Security
     max_file_size_mb: int = 50
@@ -51,6 +115,11 @@ class Settings(BaseSettings):
     # Cache
     enable_cache: bool = True
     cache_ttl_seconds: int = 3600
+    embedding_cache_size: int = 1024          # Embedding delle query in LRU
+    embedding_cache_persist: bool = False     # Persiste gli embedding su disco
+    embedding_cache_dir: Path = Path("embedding_cache")
+    embedding_cache_disk_size: int = 50000    # Entry massime su disco (LRU)
+    embedding_cache_flush_every: int = 50     # Scritture index.json ogni N set
     
     # Docling Preprocessing
     enable_docling_preprocessing: bool = True
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Indice invertito BM25 persistente su disco.
+
+Sostituisce la ricostruzione di BM25Okapi ad ogni avvio: postings, lunghezze
+documenti e tabella IDF vengono salvati accanto all'indice FAISS e ricaricati
+in memory-map. I documenti sono identificati dalla loro posizione nell'indice
+FAISS e sincronizzati tramite gli ID del docstore, così un aggiornamento
+ri-tokenizza solo i chunk nuovi.
+"""
+
+import os
+import re
+import json
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.logger import StructuredLogger
+
+logger = StructuredLogger(__name__)
+
+
+BM25_DIRNAME = "bm25"
+FORMAT_VERSION = 1
+ARRAY_NAMES = ("term_offsets", "postings_docs", "postings_tf", "doc_lengths", "idf")
+
+_PUNCT_RE = re.compile(r'[^\w\s]')
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokenizza il testo per BM25 (lowercase, senza punteggiatura)"""
+    return _PUNCT_RE.sub(' ', text.lower()).split()
+
+
+class BM25Index:
+    """
+    Indice BM25 (Okapi) con postings su array NumPy.
+
+    Lo scoring replica BM25Okapi di rank_bm25 (stessi k1, b, epsilon),
+    così i punteggi restano confrontabili con la versione precedente.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.vocab: Dict[str, int] = {}
+        self.doc_keys: List[str] = []
+        self.term_offsets = np.zeros(1, dtype=np.int64)
+        self.postings_docs = np.zeros(0, dtype=np.int32)
+        self.postings_tf = np.zeros(0, dtype=np.int32)
+        self.doc_lengths = np.zeros(0, dtype=np.int32)
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.avgdl = 0.0
+
+    @property
+    def corpus_size(self) -> int:
+        return len(self.doc_keys)
+
+    # ------------------------------------------------------------------
+    # Costruzione
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def build(cls, doc_keys: Sequence[str], texts: Sequence[str], **kwargs) -> "BM25Index":
+        """Costruisce l'indice da zero"""
+        index = cls(**kwargs)
+        index._rebuild(list(doc_keys), [(i, tokenize(t)) for i, t in enumerate(texts)])
+        return index
+
+    def sync(self, doc_keys: Sequence[str], get_text: Callable[[int], str]) -> int:
+        """
+        Allinea l'indice alla lista corrente di documenti FAISS.
+
+        I documenti già indicizzati vengono rimappati sulla nuova posizione,
+        quelli rimossi eliminati e solo i nuovi vengono tokenizzati. La
+        riscrittura degli array resta lineare nel numero totale di postings
+        (vedi _rebuild).
+
+        Args:
+            doc_keys: ID docstore nell'ordine delle posizioni FAISS
+            get_text: Funzione posizione -> testo, chiamata solo per i nuovi documenti
+
+        Returns:
+            Numero di documenti (ri)tokenizzati
+        """
+        doc_keys = list(doc_keys)
+        if doc_keys == self.doc_keys:
+            return 0
+
+        old_positions = {key: i for i, key in enumerate(self.doc_keys)}
+        remap = np.full(len(self.doc_keys), -1, dtype=np.int64)
+        new_tokens = []
+        for new_pos, key in enumerate(doc_keys):
+            old_pos = old_positions.get(key)
+            if old_pos is None:
+                new_tokens.append((new_pos, tokenize(get_text(new_pos))))
+            else:
+                remap[old_pos] = new_pos
+
+        self._rebuild(doc_keys, new_tokens, remap=remap)
+        return len(new_tokens)
+
+    def _rebuild(self, doc_keys, new_tokens, remap=None):
+        """
+        Ricostruisce gli array dei postings.
+
+        I postings esistenti vengono rimappati e riordinati con operazioni
+        vettoriali; solo i documenti nuovi passano dal codice Python. Gli array
+        piatti (e i file .npy) vengono comunque riscritti per intero, quindi un
+        aggiornamento costa O(postings totali) in NumPy più la tokenizzazione
+        dei soli documenti nuovi.
+
+        Args:
+            doc_keys: Nuovi ID docstore
+            new_tokens: Token dei documenti nuovi, come lista di (posizione, token)
+            remap: Array vecchia posizione -> nuova posizione (-1 se rimosso)
+        """
+        doc_lengths = np.zeros(len(doc_keys), dtype=np.int32)
+        vocab: Dict[str, int] = {}
+        term_parts, doc_parts, tf_parts = [], [], []
+
+        # Postings esistenti rimappati sulle nuove posizioni (senza i documenti rimossi)
+        if remap is not None and len(remap):
+            kept = remap >= 0
+            doc_lengths[remap[kept]] = np.asarray(self.doc_lengths)[kept]
+            vocab = dict(self.vocab)
+            if len(self.postings_docs):
+                old_terms = np.repeat(np.arange(len(self.vocab), dtype=np.int64), np.diff(self.term_offsets))
+                old_docs = remap[np.asarray(self.postings_docs)]
+                keep = old_docs >= 0
+                term_parts.append(old_terms[keep])
+                doc_parts.append(old_docs[keep])
+                tf_parts.append(np.asarray(self.postings_tf)[keep])
+
+        # Postings dei documenti nuovi (i termini nuovi prendono gli ID successivi)
+        for pos, tokens in new_tokens:
+            doc_lengths[pos] = len(tokens)
+            if not tokens:
+                continue
+            token_ids = np.fromiter((vocab.setdefault(token, len(vocab)) for token in tokens),
+                                    dtype=np.int64, count=len(tokens))
+            term_ids, tfs = np.unique(token_ids, return_counts=True)
+            term_parts.append(term_ids)
+            doc_parts.append(np.full(len(term_ids), pos, dtype=np.int64))
+            tf_parts.append(tfs)
+
+        terms = np.concatenate(term_parts) if term_parts else np.zeros(0, dtype=np.int64)
+        docs = np.concatenate(doc_parts) if doc_parts else np.zeros(0, dtype=np.int64)
+        tfs = np.concatenate(tf_parts) if tf_parts else np.zeros(0, dtype=np.int64)
+
+        # Termini rimasti senza postings eliminati dal vocabolario (non contano nell'IDF medio)
+        df = np.bincount(terms, minlength=len(vocab))
+        present = df > 0
+        compact_ids = np.cumsum(present) - 1
+        terms = compact_ids[terms]
+        order = np.lexsort((docs, terms))
+
+        self.vocab = {term: int(compact_ids[term_id]) for term, term_id in vocab.items() if present[term_id]}
+        self.doc_keys = list(doc_keys)
+        self.term_offsets = np.concatenate([[0], np.cumsum(df[present])]).astype(np.int64)
+        self.postings_docs = docs[order].astype(np.int32)
+        self.postings_tf = tfs[order].astype(np.int32)
+        self.doc_lengths = doc_lengths
+        self._compute_idf()
+
+    def _compute_idf(self):
+        """Calcola la tabella IDF come in BM25Okapi"""
+        n_docs = len(self.doc_keys)
+        self.avgdl = float(self.doc_lengths.sum()) / n_docs if n_docs else 0.0
+
+        df = np.diff(self.term_offsets).astype(np.float64)
+        idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+        if len(idf):
+            average_idf = idf.sum() / len(idf)
+            idf[idf < 0] = self.epsilon * average_idf
+        self.idf = idf.astype(np.float32)
+
+    # ------------------------------------------------------------------
+    # Scoring
+    # ------------------------------------------------------------------
+
+    def get_scores(self, query_tokens: List[str]) -> np.ndarray:
+        """Score BM25 di tutti i documenti (stessa semantica di BM25Okapi.get_scores)"""
+        scores = np.zeros(self.corpus_size, dtype=np.float64)
+        if not self.corpus_size:
+            return scores
+
+        norm = self.k1 * (1 - self.b + self.b * np.asarray(self.doc_lengths) / (self.avgdl or 1.0))
+        for token in query_tokens:
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            docs = np.asarray(self.postings_docs[start:end])
+            tf = np.asarray(self.postings_tf[start:end], dtype=np.float64)
+            scores[docs] += self.idf[term_id] * (tf * (self.k1 + 1) / (tf + norm[docs]))
+        return scores
+
+    def _term_scores(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Documenti e contributi BM25 di un singolo termine"""
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        docs = np.asarray(self.postings_docs[start:end])
+        tf = np.asarray(self.postings_tf[start:end], dtype=np.float64)
+        norm = self.k1 * (1 - self.b + self.b * np.asarray(self.doc_lengths)[docs] / (self.avgdl or 1.0))
+        return docs, self.idf[term_id] * (tf * (self.k1 + 1) / (tf + norm))
+
+    def score_sparse(self, query_tokens: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score BM25 dei soli documenti che contengono almeno un termine della query.
+
+        Tocca solo i postings dei termini della query, quindi il costo dipende
+        dal numero di postings corrispondenti e non dalla dimensione del corpus.
+
+        Returns:
+            Tupla (doc_ids ordinati, scores) con gli stessi valori di get_scores
+        """
+        doc_parts, score_parts = [], []
+        for token in query_tokens:
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            docs, term_scores = self._term_scores(term_id)
+            doc_parts.append(docs)
+            score_parts.append(term_scores)
+
+        if not doc_parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        doc_ids, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts), minlength=len(doc_ids))
+        return doc_ids.astype(np.int64), scores
+
+    def top_k(self, query_tokens: List[str], k: int) -> Tuple[np.ndarray, np.ndarray, float]:
+        """
+        Migliori k documenti BM25 per la query.
+
+        Returns:
+            Tupla (doc_ids, scores, max_score) con doc_ids ordinati per score
+            decrescente e max_score da usare come normalizzatore
+        """
+        doc_ids, scores = self.score_sparse(query_tokens)
+        return self._select_top_k(doc_ids, scores, k)
+
+    def top_k_batch(self, queries_tokens: List[List[str]], k: int) -> List[Tuple[np.ndarray, np.ndarray, float]]:
+        """
+        Migliori k documenti BM25 per più query insieme.
+
+        I contributi di ogni termine vengono calcolati una sola volta anche se
+        compare in più query, e gli score di tutte le query sono accumulati con
+        un unico bincount su chiavi (query, documento).
+
+        Returns:
+            Lista di tuple (doc_ids, scores, max_score) come top_k, una per query
+        """
+        n_docs = max(self.corpus_size, 1)
+        term_cache: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        key_parts, score_parts = [], []
+        for q, query_tokens in enumerate(queries_tokens):
+            for token in query_tokens:
+                term_id = self.vocab.get(token)
+                if term_id is None:
+                    continue
+                if term_id not in term_cache:
+                    term_cache[term_id] = self._term_scores(term_id)
+                docs, term_scores = term_cache[term_id]
+                key_parts.append(docs.astype(np.int64) + q * n_docs)
+                score_parts.append(term_scores)
+
+        if not key_parts:
+            empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), 0.0)
+            return [empty for _ in queries_tokens]
+
+        keys, inverse = np.unique(np.concatenate(key_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts), minlength=len(keys))
+        # Le chiavi sono ordinate: ogni query occupa un intervallo contiguo
+        bounds = np.searchsorted(keys // n_docs, np.arange(len(queries_tokens) + 1))
+
+        results = []
+        for q in range(len(queries_tokens)):
+            start, end = bounds[q], bounds[q + 1]
+            results.append(self._select_top_k(keys[start:end] - q * n_docs, scores[start:end], k))
+        return results
+
+    @staticmethod
+    def _select_top_k(doc_ids: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray, float]:
+        if not len(doc_ids) or k <= 0:
+            return doc_ids[:0], scores[:0], float(scores.max()) if len(scores) else 0.0
+
+        max_score = float(scores.max())
+        if k < len(doc_ids):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(doc_ids))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return doc_ids[top], scores[top], max_score
+
+    # ------------------------------------------------------------------
+    # Persistenza
+    # ------------------------------------------------------------------
+
+    def save(self, path: Path) -> None:
+        """Salva l'indice nella directory indicata"""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        # Scrittura su file temporanei + rename: eventuali memory-map aperte
+        # sulla versione precedente restano valide
+        for name in ARRAY_NAMES:
+            tmp_file = path / f"{name}.npy.tmp"
+            with open(tmp_file, 'wb') as f:
+                np.save(f, np.asarray(getattr(self, name)))
+            os.replace(tmp_file, path / f"{name}.npy")
+
+        terms = [None] * len(self.vocab)
+        for term, term_id in self.vocab.items():
+            terms[term_id] = term
+
+        meta = {
+            "version": FORMAT_VERSION,
+            "k1": self.k1,
+            "b": self.b,
+            "epsilon": self.epsilon,
+            "avgdl": self.avgdl,
+            "terms": terms,
+            "doc_keys": self.doc_keys,
+        }
+        tmp_meta = path / "meta.json.tmp"
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_meta, path / "meta.json")
+
+        logger.info(f"Indice BM25 salvato in: {path} ({self.corpus_size} documenti, {len(terms)} termini)")
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["BM25Index"]:
+        """Carica l'indice in memory-map. Restituisce None se assente o incompatibile"""
+        path = Path(path)
+        meta_file = path / "meta.json"
+        if not meta_file.exists():
+            return None
+
+        try:
+            with open(meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get("version") != FORMAT_VERSION:
+                logger.warning(f"Versione indice BM25 non compatibile in: {path}")
+                return None
+
+            index = cls(k1=meta["k1"], b=meta["b"], epsilon=meta["epsilon"])
+            index.avgdl = meta["avgdl"]
+            index.doc_keys = meta["doc_keys"]
+            index.vocab = {term: i for i, term in enumerate(meta["terms"])}
+            for name in ARRAY_NAMES:
+                setattr(index, name, np.load(path / f"{name}.npy", mmap_mode='r'))
+            return index
+        except Exception as e:
+            logger.error(f"Errore caricamento indice BM25", exception=e, path=str(path))
+            return None
+
+
+def load_or_sync(index_path: Path, doc_keys: Sequence[str], get_text: Callable[[int], str]) -> BM25Index:
+    """
+    Carica l'indice BM25 salvato accanto all'indice FAISS e lo aggiorna
+    incrementalmente se il docstore è cambiato.
+
+    Args:
+        index_path: Directory dell'indice FAISS
+        doc_keys: ID docstore nell'ordine delle posizioni FAISS
+        get_text: Funzione posizione -> testo del documento
+    """
+    bm25_path = Path(index_path) / BM25_DIRNAME
+    index = BM25Index.load(bm25_path)
+
+    if index is None:
+        logger.info("Indice BM25 non trovato, costruzione completa")
+        index = BM25Index()
+
+    doc_keys = list(doc_keys)
+    if doc_keys != index.doc_keys or not (bm25_path / "meta.json").exists():
+        updated = index.sync(doc_keys, get_text)
+        index.save(bm25_path)
+        logger.info(f"Indice BM25 aggiornato: {updated} documenti tokenizzati")
+
+    return index
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Boosting vettorizzato dei candidati della ricerca ibrida.
+
+I boost dipendono dai metadati dei chunk (array di MetadataIndex allineati
+alle posizioni FAISS) e dall'analisi della query: vengono calcolati con
+operazioni NumPy sull'insieme dei candidati invece che documento per documento.
+"""
+
+from typing import Dict, Optional
+
+import numpy as np
+
+from config import settings
+from core.query_analyzer import MetadataIndex, QueryAnalysis
+
+
+BOOST_SETTINGS = (
+    "boost_short_file",
+    "boost_cliente",
+    "boost_recent",
+    "boost_prices",
+    "boost_date_exact",
+    "boost_date_calendar",
+    "boost_corpus_cliente",
+    "boost_corpus_generic",
+    "boost_file",
+    "boost_cliente_file",
+)
+
+
+class MetadataBooster:
+    """Calcola i fattori di boost per un insieme di candidati"""
+
+    def __init__(self, metadata_index: MetadataIndex, weights: Optional[Dict[str, float]] = None):
+        self.metadata_index = metadata_index
+        # Pesi letti una sola volta da config.settings (sovrascrivibili per il tuning)
+        self.weights = {name: getattr(settings, name) for name in BOOST_SETTINGS}
+        if weights:
+            self.weights.update(weights)
+
+    def boost_factors(self, ids: np.ndarray, analysis: QueryAnalysis) -> np.ndarray:
+        """
+        Fattori di boost (>= 1.0) per i candidati
+
+        Args:
+            ids: Posizioni FAISS dei candidati
+            analysis: Analisi della query
+
+        Returns:
+            Array di fattori moltiplicativi allineato a ids
+        """
+        index = self.metadata_index
+        w = self.weights
+        ids = np.asarray(ids, dtype=np.int64)
+        boost = np.ones(len(ids), dtype=np.float64)
+        if not len(ids):
+            return boost
+
+        # Boost per file corti e documenti recenti
+        boost += w["boost_short_file"] * index.is_short_file[ids]
+        boost += w["boost_recent"] * index.mentions_recent_year[ids]
+
+        # Boost per documenti con prezzi se la query contiene termini di costo
+        if analysis.asks_prices:
+            boost += w["boost_prices"] * index.has_prices[ids]
+
+        # Boost per documenti del cliente menzionato nella query
+        cliente_code = index.cliente_code[ids]
+        mentioned_clienti = [index.cliente_codes[c] for c in analysis.mentioned_clienti if c in index.cliente_codes]
+        cliente_mentioned = np.isin(cliente_code, mentioned_clienti)
+        boost += w["boost_cliente"] * cliente_mentioned
+
+        # Boost per query con date - priorità per file Journal
+        if analysis.has_date_reference:
+            journal_code = index.journal_date_code[ids]
+            is_journal = journal_code >= 0
+            target_code = index.journal_date_codes.get(analysis.target_date, -2)
+            exact = is_journal & (journal_code == target_code)
+            boost += w["boost_date_exact"] * exact
+            if analysis.is_calendar_query:
+                boost += w["boost_date_calendar"] * (is_journal & ~exact)
+
+        # Boost per file specifici menzionati nella query
+        filename_code = index.filename_code[ids]
+        mentioned_files = [index.filename_codes[f] for f in analysis.mentioned_files if f in index.filename_codes]
+        file_mentioned = np.isin(filename_code, mentioned_files)
+        boost += w["boost_file"] * file_mentioned
+
+        # Query di informazioni generali: corpus.md del cliente giusto molto in alto
+        if analysis.asks_general_info:
+            is_corpus = filename_code == index.filename_codes.get('corpus.md', -2)
+            boost += np.where(cliente_mentioned, w["boost_corpus_cliente"], w["boost_corpus_generic"]) * is_corpus
+
+        # SUPER BOOST quando la query contiene sia il cliente (anche solo una parola
+        # del nome) che un tipo di file, e il doc è del cliente giusto con il file giusto
+        if file_mentioned.any() and index.cliente_names:
+            cliente_words_in_query = np.array(
+                [analysis.cliente_in_query(name) for name in index.cliente_names] + [False]
+            )
+            # Il codice -1 (nessun cliente) punta all'ultimo elemento (False)
+            boost += w["boost_cliente_file"] * (file_mentioned & cliente_words_in_query[cliente_code])
+
+        return boost
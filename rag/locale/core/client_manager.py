@@ -6,15 +6,49 @@ Gestione clienti e metadata per archivio documenti
 """
 
 import os
+import re
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import json
 
+import numpy as np
+import faiss
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from config import settings
 from utils.logger import StructuredLogger
+from core.vector_store import FAISSVectorStore
 
 logger = StructuredLogger(__name__)
 
+SHARDS_MANIFEST = "shards.json"
+GLOBAL_SHARD = "_global"  # Chunk senza client_name (documenti condivisi)
+
+
+def _shard_dirname(client_name: str) -> str:
+    return re.sub(r'[^\w\-]+', '_', client_name).strip('_') or "cliente"
+
+
+def index_fingerprint(index_path: Path) -> Optional[Dict[str, int]]:
+    """
+    Impronta dei file di un indice FAISS salvato (dimensione e mtime)
+    
+    Ogni salvataggio dell'indice (ingestione completa o incrementale) la
+    cambia; gli shard confrontano quella registrata alla creazione.
+    """
+    fingerprint = {}
+    for filename in ("index.faiss", "index.pkl"):
+        path = Path(index_path) / filename
+        if not path.exists():
+            return None
+        stat = path.stat()
+        fingerprint[f"{path.stem}_{path.suffix[1:]}_size"] = stat.st_size
+        fingerprint[f"{path.stem}_{path.suffix[1:]}_mtime_ns"] = stat.st_mtime_ns
+    return fingerprint
+
 
 class ClientMetadataManager:
     """Gestisce metadata e struttura clienti"""
@@ -136,6 +170,187 @@ class ClientMetadataManager:
             with open(metadata_path, 'r', encoding='utf-8') as f:
                 self.clients_metadata = json.load(f)
             logger.info(f"Metadata caricati da: {metadata_path}")
+    
+    def build_shards(self, vector_store: FAISSVectorStore, output_path: Path, source_path: Path = None) -> Dict[str, int]:
+        """
+        Divide l'indice globale in un indice FAISS per cliente più uno shard
+        globale con i chunk senza client_name
+        
+        I vettori vengono ricostruiti dall'indice esistente, quindi non serve
+        ricalcolare gli embedding. Gli shard e il manifest (shards.json) vengono
+        scritti in output_path; il manifest registra l'impronta dell'indice
+        globale (source_path, default settings.faiss_index_path) per rilevare
+        gli shard non più allineati.
+        
+        Returns:
+            Dict shard -> numero di chunk
+        """
+        output_path = Path(output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+        
+        source = vector_store.vector_store
+        metadata_index = vector_store.metadata_index
+        client_positions = metadata_index.positions_by_value("client_name")
+        
+        # Shard globale: posizioni non assegnate a nessun cliente
+        assigned = np.zeros(len(metadata_index), dtype=bool)
+        for positions in client_positions.values():
+            assigned[positions] = True
+        shard_positions = dict(client_positions)
+        global_positions = np.flatnonzero(~assigned)
+        if len(global_positions):
+            shard_positions[GLOBAL_SHARD] = global_positions
+        
+        source_path = Path(source_path or settings.faiss_index_path)
+        manifest = {
+            "source_index": str(source_path),
+            "source_ntotal": int(source.index.ntotal),
+            "source_fingerprint": index_fingerprint(source_path),
+            "created_at": datetime.now().isoformat(),
+            "shards": {}
+        }
+        for shard_name, positions in shard_positions.items():
+            dirname = GLOBAL_SHARD if shard_name == GLOBAL_SHARD else _shard_dirname(shard_name)
+            documents = [metadata_index.documents[position] for position in positions]
+            vectors = source.index.reconstruct_batch(positions)
+            
+            shard = FAISS.from_embeddings(
+                [(doc.page_content, vector) for doc, vector in zip(documents, vectors)],
+                vector_store.embeddings,
+                metadatas=[doc.metadata for doc in documents],
+                ids=[source.index_to_docstore_id[int(position)] for position in positions],
+                distance_strategy=source.distance_strategy
+            )
+            shard.save_local(str(output_path / dirname))
+            manifest["shards"][shard_name] = {"path": dirname, "chunks": len(positions)}
+            logger.info(f"Shard creato: {shard_name}", chunks=len(positions))
+        
+        with open(output_path / SHARDS_MANIFEST, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        
+        logger.info(f"Shard salvati in: {output_path}", shards=len(shard_positions))
+        return {name: info["chunks"] for name, info in manifest["shards"].items()}
+
+
+class ClientShardRouter:
+    """
+    Ricerca sugli indici per cliente creati da ClientMetadataManager.build_shards
+    
+    Con un filtro cliente interroga solo lo shard del cliente (e, se richiesto,
+    lo shard globale); senza filtro interroga tutti gli shard in parallelo e
+    unisce i top-k per distanza. Gli shard vengono caricati al primo utilizzo
+    e condividono lo stesso modello di embedding.
+    
+    Gli shard sono una copia dell'indice globale: dopo un aggiornamento
+    dell'indice (impronta diversa da quella del manifest) non sono più
+    disponibili finché non vengono ricostruiti.
+    """
+    
+    def __init__(self, shards_path: Path = None, max_workers: int = None):
+        self.shards_path = Path(shards_path or settings.client_shards_path)
+        self.max_workers = max_workers or settings.shard_search_workers
+        
+        with open(self.shards_path / SHARDS_MANIFEST, 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self.shard_info: Dict[str, Dict[str, Any]] = self.manifest["shards"]
+        if not self.is_current(self.manifest):
+            logger.warning(
+                f"Shard in {self.shards_path} non allineati all'indice {self.manifest.get('source_index')}: "
+                f"ricostruirli con --build-shards"
+            )
+        
+        self.embeddings = None
+        self.shards: Dict[str, FAISSVectorStore] = {}
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="shard-search")
+        logger.info(f"Router shard inizializzato: {len(self.shard_info)} shard in {self.shards_path}")
+    
+    @staticmethod
+    def is_current(manifest: Dict[str, Any]) -> bool:
+        """L'indice globale non è cambiato dalla creazione degli shard"""
+        fingerprint = manifest.get("source_fingerprint")
+        return fingerprint is not None and fingerprint == index_fingerprint(Path(manifest["source_index"]))
+    
+    @classmethod
+    def is_available(cls, shards_path: Path = None) -> bool:
+        """Shard presenti e allineati all'indice globale"""
+        manifest_path = Path(shards_path or settings.client_shards_path) / SHARDS_MANIFEST
+        if not manifest_path.exists():
+            return False
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if not cls.is_current(manifest):
+            logger.warning(f"Shard in {manifest_path.parent} non aggiornati rispetto a {manifest.get('source_index')}")
+            return False
+        return True
+    
+    @property
+    def clients(self) -> List[str]:
+        return sorted(name for name in self.shard_info if name != GLOBAL_SHARD)
+    
+    def get_shard(self, name: str) -> FAISSVectorStore:
+        """Shard caricato (lazy); tutti usano gli embedding del primo"""
+        if name not in self.shards:
+            shard = FAISSVectorStore(embeddings=self.embeddings)
+            shard.load(self.shards_path / self.shard_info[name]["path"])
+            self.embeddings = shard.embeddings
+            self.shards[name] = shard
+        return self.shards[name]
+    
+    def route(self, client_filter: str = None, include_global: bool = False) -> List[str]:
+        """Shard da interrogare per il filtro cliente"""
+        if not client_filter:
+            return list(self.shard_info)
+        shards = [client_filter] if client_filter in self.shard_info else []
+        if include_global and GLOBAL_SHARD in self.shard_info:
+            shards.append(GLOBAL_SHARD)
+        return shards
+    
+    def search(
+        self, 
+        query: str, 
+        k: int = 5, 
+        client_filter: str = None, 
+        metadata_filter: Dict[str, Any] = None, 
+        contains_filter: Dict[str, str] = None,
+        include_global: bool = False
+    ) -> List[Tuple[Document, float]]:
+        """
+        Top-k sugli shard selezionati dal filtro cliente
+        
+        Args:
+            query: Query di ricerca
+            k: Numero di risultati
+            client_filter: Cliente (None: tutti gli shard)
+            metadata_filter: Filtri esatti aggiuntivi (es. file_type)
+            contains_filter: Filtri per sottostringa (es. subfolder)
+            include_global: Con client_filter, cerca anche nello shard globale
+        """
+        shard_names = self.route(client_filter, include_global)
+        if not shard_names:
+            return []
+        
+        # Carica gli shard e calcola l'embedding (in cache) prima del fan-out
+        shards = [self.get_shard(name) for name in shard_names]
+        self.embeddings.embed_query_array(query)
+        
+        def search_shard(shard: FAISSVectorStore) -> List[Tuple[Document, float]]:
+            return shard.similarity_search_with_filter(query, k, metadata_filter, contains_filter)
+        
+        if len(shards) == 1:
+            results = search_shard(shards[0])
+        else:
+            results = [hit for hits in self.executor.map(search_shard, shards) for hit in hits]
+        
+        # Le distanze degli shard sono confrontabili (stesso modello e metrica)
+        inner_product = shards[0].vector_store.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        results.sort(key=lambda hit: -hit[1] if inner_product else hit[1])
+        return results[:k]
+    
+    def get_documents(self, client_name: str) -> List[Document]:
+        """Tutti i chunk di un cliente"""
+        if client_name not in self.shard_info:
+            return []
+        return self.get_shard(client_name).get_documents()
 
 
 class ClientAwareDocumentProcessor:
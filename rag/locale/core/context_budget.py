@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Conteggio dei token con il tokenizer del modello e composizione del contesto
+entro la finestra del modello.
+
+ContextBudgeter riempie il prompt con i chunk nell'ordine di ranking finché
+c'è spazio: salta i duplicati e rimuove dai chunk dello stesso file la parte
+ripetuta dall'overlap dello splitter (chunk_overlap), così i token del
+contesto vanno solo a testo nuovo.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from config import settings
+
+MIN_OVERLAP_CHARS = 20  # Sotto questa soglia una sovrapposizione è casuale
+
+
+class TokenCounter:
+    """
+    Conteggio dei token con cache LRU per testo
+
+    count_fn è il tokenizer del modello (es. /tokenize del server llamafile);
+    se assente si usa la stima di 1 token ogni 4 caratteri e exact è False.
+    """
+
+    def __init__(self, count_fn: Optional[Callable[[str], int]] = None, cache_size: int = 4096):
+        self.count_fn = count_fn
+        self.exact = count_fn is not None
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, int]" = OrderedDict()
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if not self.exact:
+            return len(text) // 4
+        tokens = self.cache.get(text)
+        if tokens is None:
+            tokens = self.count_fn(text)
+            self.cache[text] = tokens
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(text)
+        return tokens
+
+
+def overlap_size(left: str, right: str, max_overlap: int) -> int:
+    """Caratteri con cui l'inizio di right ripete la fine di left (overlap dello splitter)"""
+    for size in range(min(len(left), len(right), max_overlap), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+class ContextBudgeter:
+    """Sceglie i chunk da inserire nel prompt entro il budget di token"""
+
+    def __init__(self, counter: TokenCounter, n_ctx: int, answer_tokens: int = None,
+                 margin_tokens: int = None, max_overlap: int = None):
+        self.counter = counter
+        self.n_ctx = n_ctx
+        # La riserva copre almeno i max_tokens chiesti al modello: prompt e risposta restano entro n_ctx
+        self.answer_tokens = (max(settings.answer_reserve_tokens, settings.llamafile_max_tokens)
+                              if answer_tokens is None else answer_tokens)
+        self.margin_tokens = settings.context_margin_tokens if margin_tokens is None else margin_tokens
+        self.max_overlap = settings.chunk_overlap if max_overlap is None else max_overlap
+
+    def budget(self, fixed_prompt: str) -> int:
+        """Token disponibili per il contesto dato il resto del prompt"""
+        return self.n_ctx - self.answer_tokens - self.margin_tokens - self.counter.count(fixed_prompt)
+
+    def pack(self, parts: List[str], sources: List[str], fixed_prompt: str, separator: str = "\n\n") -> Dict:
+        """
+        Riempie il contesto con i chunk nell'ordine dato (ranking)
+
+        Args:
+            parts: Testo di ogni chunk, già formattato per il prompt
+            sources: File di provenienza di ogni chunk (per l'overlap tra chunk adiacenti)
+            fixed_prompt: Prompt senza contesto (istruzioni e domanda)
+            separator: Separatore tra i chunk nel contesto
+
+        Returns:
+            dict: context, indices (chunk usati, in ordine), context_tokens, budget,
+                  chunks_dropped, duplicates_removed, overlap_chars_removed, truncated
+        """
+        budget = self.budget(fixed_prompt)
+        separator_tokens = self.counter.count(separator)
+        used = 0
+        texts, indices = [], []
+        selected_by_source: Dict[str, List[str]] = {}
+        seen = set()
+        duplicates = 0
+        overlap_chars = 0
+        dropped = 0
+        truncated = False
+
+        for i, (text, source) in enumerate(zip(parts, sources)):
+            key = text.strip()
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+
+            # Overlap con chunk dello stesso file già inseriti (in entrambe le direzioni)
+            original_length = len(text)
+            for previous in selected_by_source.get(source, []):
+                text = text[overlap_size(previous, text, self.max_overlap):]
+                text = text[:len(text) - overlap_size(text, previous, self.max_overlap)]
+            overlap_chars += original_length - len(text)
+            if not text.strip():
+                duplicates += 1
+                continue
+
+            cost = self.counter.count(text) + (separator_tokens if texts else 0)
+            if used + cost > budget:
+                if not texts and budget > 0:
+                    # Il primo chunk da solo non entra: viene troncato
+                    text = self._truncate(text, budget)
+                    cost = self.counter.count(text)
+                    truncated = True
+                else:
+                    dropped += 1
+                    continue
+
+            texts.append(text)
+            indices.append(i)
+            selected_by_source.setdefault(source, []).append(text)
+            used += cost
+
+        return {
+            "context": separator.join(texts),
+            "indices": indices,
+            "context_tokens": used,
+            "budget": budget,
+            "chunks_dropped": dropped,
+            "duplicates_removed": duplicates,
+            "overlap_chars_removed": overlap_chars,
+            "truncated": truncated
+        }
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """Prefisso di text entro max_tokens (ricerca binaria sulla lunghezza)"""
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.counter.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Embeddings con cache LRU per le query.
+
+Avvolge HuggingFaceEmbeddings (o il modello ONNX int8 con backend "onnx"):
+gli embedding delle query vengono riusati tramite la cache condivisa di
+utils.cache, quelli dei documenti (ingestion) passano direttamente al modello.
+"""
+
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from config import settings
+from utils.cache import EmbeddingCache, get_embedding_cache
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings HuggingFace con cache degli embedding delle query"""
+
+    def __init__(self, model_name: str = None, cache: EmbeddingCache = None, backend: str = None):
+        self.model_name = model_name or settings.embedding_model_name
+        self.backend = backend or settings.embedding_backend
+        if self.backend == "onnx":
+            from core.onnx_models import OnnxEmbeddings
+            self.embeddings = OnnxEmbeddings(self.model_name)
+            self.cache_key = f"{self.model_name}:onnx-int8"  # Vettori diversi da quelli torch
+        else:
+            self.embeddings = HuggingFaceEmbeddings(model_name=self.model_name)
+            self.cache_key = self.model_name
+        self.cache = cache or get_embedding_cache()
+
+    def embed_query_array(self, text: str) -> np.ndarray:
+        """Embedding della query come vettore float32 (sola lettura)"""
+        vector = self.cache.get(self.cache_key, text)
+        if vector is None:
+            vector = self.cache.set(self.cache_key, text, self.embeddings.embed_query(text))
+        return vector
+
+    def embed_queries_array(self, texts: List[str]) -> np.ndarray:
+        """
+        Embedding di più query come matrice float32 (una riga per query).
+
+        Le query non in cache vengono codificate con un'unica chiamata al
+        modello (embed_documents, identico a embed_query senza prompt di query).
+        """
+        vectors = [self.cache.get(self.cache_key, text) for text in texts]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            computed = dict(zip(missing, self.embeddings.embed_documents(missing)))
+            for text, vector in computed.items():
+                computed[text] = self.cache.set(self.cache_key, text, vector)
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack(vectors)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_query_array(text).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
@@ -8,15 +8,18 @@ Sistema di tracking file per ingest incrementale
 import json
 import hashlib
 from pathlib import Path
-from typing import Dict, List, Optional, Set
+from typing import Dict, List, Optional, Set, Tuple
 from datetime import datetime
 import sqlite3
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.logger import StructuredLogger
 
 logger = StructuredLogger(__name__)
 
+HASH_BUFFER_SIZE = 1024 * 1024  # Letture da 1 MB per il calcolo dell'hash
+
 
 class FileTracker:
     """Traccia stato dei file per ingest incrementale"""
@@ -68,7 +71,7 @@ class FileTracker:
         hash_sha256 = hashlib.sha256()
         try:
             with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
+                for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
                     hash_sha256.update(chunk)
             return hash_sha256.hexdigest()
         except Exception as e:
@@ -83,7 +86,7 @@ class FileTracker:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "SELECT file_hash, last_modified FROM processed_files WHERE file_path = ?",
+                "SELECT file_hash, file_size, last_modified FROM processed_files WHERE file_path = ? AND status = 'processed'",
                 (str(file_path),)
             )
             result = cursor.fetchone()
@@ -91,12 +94,76 @@ class FileTracker:
             if not result:
                 return False
             
-            # Verifica se il file è stato modificato
-            current_hash = self._calculate_file_hash(file_path)
-            current_mtime = file_path.stat().st_mtime
+            # Dimensione e mtime invariati: file non modificato, niente hash
+            file_stat = file_path.stat()
+            if result["file_size"] == file_stat.st_size and result["last_modified"] == file_stat.st_mtime:
+                return True
+            
+            return result["file_hash"] == self._calculate_file_hash(file_path)
+    
+    def _load_tracked(self) -> Dict[str, Tuple[int, float, str]]:
+        """Carica in memoria tutti i file processati: path -> (size, mtime, hash)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT file_path, file_size, last_modified, file_hash
+                FROM processed_files
+                WHERE status = 'processed'
+            """)
+            return {row["file_path"]: (row["file_size"], row["last_modified"], row["file_hash"])
+                    for row in cursor.fetchall()}
+    
+    def scan_files(self, file_paths: List[Path], max_workers: int = None) -> List[Path]:
+        """
+        Individua in blocco i file nuovi o modificati
+        
+        Legge tutti i record con una sola query, scarta i file con dimensione
+        e mtime invariati e calcola l'hash (in un pool di thread) solo per i
+        file sospetti. I file toccati ma con contenuto identico vengono
+        aggiornati nel database con una sola transazione.
+        
+        Returns:
+            Lista dei file da (ri)processare, nell'ordine di file_paths
+        """
+        tracked = self._load_tracked()
+        
+        changed = set()
+        suspects = []
+        for file_path in file_paths:
+            record = tracked.get(str(file_path))
+            if record is None:
+                changed.add(file_path)
+                continue
+            try:
+                file_stat = file_path.stat()
+            except OSError:
+                continue
+            if record[0] != file_stat.st_size:
+                changed.add(file_path)
+            elif record[1] != file_stat.st_mtime:
+                suspects.append((file_path, file_stat))
+        
+        if suspects:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                hashes = list(executor.map(lambda item: self._calculate_file_hash(item[0]), suspects))
+            
+            touched = []
+            for (file_path, file_stat), file_hash in zip(suspects, hashes):
+                if file_hash and file_hash == tracked[str(file_path)][2]:
+                    touched.append((file_stat.st_mtime, str(file_path)))
+                else:
+                    changed.add(file_path)
             
-            return (result["file_hash"] == current_hash and 
-                   result["last_modified"] == current_mtime)
+            if touched:
+                with self.get_connection() as conn:
+                    conn.executemany(
+                        "UPDATE processed_files SET last_modified = ? WHERE file_path = ?", touched
+                    )
+                    conn.commit()
+        
+        logger.info(f"Scansione file: {len(file_paths)} totali, {len(suspects)} verificati con hash, "
+                    f"{len(changed)} da processare")
+        return [file_path for file_path in file_paths if file_path in changed]
     
     def mark_file_processed(self, file_path: Path, chunk_count: int = 0, client_name: str = None):
         """Marca un file come processato"""
@@ -126,6 +193,37 @@ class FileTracker:
         
         logger.info(f"File marcato come processato: {file_path}")
     
+    def mark_files_processed(self, entries: List[Tuple[Path, int, Optional[str]]], max_workers: int = None):
+        """
+        Marca più file come processati in una sola transazione
+        
+        Args:
+            entries: Lista di (file_path, chunk_count, client_name)
+        """
+        entries = [entry for entry in entries if entry[0].exists()]
+        if not entries:
+            return
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = list(executor.map(lambda entry: self._calculate_file_hash(entry[0]), entries))
+        
+        processed_at = datetime.now().isoformat()
+        rows = []
+        for (file_path, chunk_count, client_name), file_hash in zip(entries, hashes):
+            file_stat = file_path.stat()
+            rows.append((str(file_path), file_hash, file_stat.st_size, file_stat.st_mtime,
+                         processed_at, chunk_count, client_name, 'processed'))
+        
+        with self.get_connection() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO processed_files 
+                (file_path, file_hash, file_size, last_modified, processed_at, chunk_count, client_name, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.commit()
+        
+        logger.info(f"Marcati come processati {len(rows)} file")
+    
     def mark_file_failed(self, file_path: Path, error_message: str = ""):
         """Marca un file come fallito"""
         with self.get_connection() as conn:
@@ -147,14 +245,14 @@ class FileTracker:
     
     def get_unprocessed_files(self, directory: Path, allowed_extensions: Set[str]) -> List[Path]:
         """Ottiene lista file non ancora processati"""
-        unprocessed = []
+        candidates = []
         
         for ext in allowed_extensions:
             for file_path in directory.rglob(f"*{ext}"):
-                if file_path.is_file() and not self.is_file_processed(file_path):
-                    unprocessed.append(file_path)
+                if file_path.is_file():
+                    candidates.append(file_path)
         
-        return unprocessed
+        return self.scan_files(candidates)
     
     def get_processed_files(self, client_name: str = None) -> List[Dict]:
         """Ottiene lista file processati"""
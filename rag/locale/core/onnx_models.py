@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Inferenza CPU con modelli ONNX quantizzati int8 (onnxruntime).
+
+Cross-encoder del reranker e modello di embedding vengono esportati con
+optimum alla prima richiesta, quantizzati dinamicamente (pesi int8) e salvati
+in settings.onnx_models_path; i caricamenti successivi riusano l'export su
+disco. optimum e onnxruntime sono dipendenze opzionali, importate solo quando
+il backend "onnx" viene selezionato.
+"""
+
+import shutil
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config import settings
+from utils.logger import StructuredLogger
+
+logger = StructuredLogger(__name__)
+
+QUANTIZED_FILE = "model_quantized.onnx"
+TASK_CLASSES = {
+    "text-classification": "ORTModelForSequenceClassification",  # Cross-encoder
+    "feature-extraction": "ORTModelForFeatureExtraction",        # Embedding
+}
+
+
+def _require_optimum():
+    try:
+        import optimum.onnxruntime as ort_models
+    except ImportError as e:
+        raise ImportError(
+            "Il backend ONNX richiede optimum e onnxruntime: pip install 'optimum[onnxruntime]'"
+        ) from e
+    return ort_models
+
+
+def export_dir(model_name: str, task: str) -> Path:
+    """Cartella dell'export quantizzato di un modello"""
+    return Path(settings.onnx_models_path) / f"{model_name.replace('/', '__')}-{task}-int8"
+
+
+def export_quantized_model(model_name: str, task: str, output_dir: Path = None) -> Path:
+    """
+    Esporta un modello HuggingFace in ONNX e lo quantizza in int8 (dinamico).
+
+    Args:
+        model_name: Nome del modello HuggingFace
+        task: "text-classification" (cross-encoder) o "feature-extraction" (embedding)
+        output_dir: Cartella di destinazione (default export_dir)
+
+    Returns:
+        Path: Cartella con model_quantized.onnx e tokenizer
+    """
+    output_dir = Path(output_dir or export_dir(model_name, task))
+    if (output_dir / QUANTIZED_FILE).exists():
+        return output_dir
+
+    ort_models = _require_optimum()
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    logger.info(f"Export ONNX int8 di {model_name} in {output_dir}")
+    fp32_dir = output_dir / "fp32"
+    model = getattr(ort_models, TASK_CLASSES[task]).from_pretrained(model_name, export=True)
+    model.save_pretrained(fp32_dir)
+
+    # Quantizzazione dinamica: pesi int8, attivazioni quantizzate a runtime
+    quantizer = ort_models.ORTQuantizer.from_pretrained(fp32_dir)
+    quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=output_dir, quantization_config=quantization_config)
+
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(output_dir)
+    shutil.rmtree(fp32_dir, ignore_errors=True)
+    return output_dir
+
+
+def load_quantized_model(model_name: str, task: str):
+    """Modello ONNX int8 e tokenizer, esportandoli se necessario"""
+    ort_models = _require_optimum()
+    from transformers import AutoTokenizer
+
+    model_dir = export_quantized_model(model_name, task)
+    model = getattr(ort_models, TASK_CLASSES[task]).from_pretrained(model_dir, file_name=QUANTIZED_FILE)
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    return model, tokenizer
+
+
+class OnnxCrossEncoder:
+    """
+    Cross-encoder ONNX int8 con la stessa interfaccia predict di
+    sentence_transformers.CrossEncoder.
+    """
+
+    def __init__(self, model_name: str, max_length: int = 512):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.model, self.tokenizer = load_quantized_model(model_name, "text-classification")
+
+        # Stessa attivazione di sentence-transformers: sigmoid per un solo label,
+        # salvo modelli (es. ms-marco) che dichiarano Identity nella config
+        activation = getattr(self.model.config, "sbert_ce_default_activation_function", None)
+        self.apply_sigmoid = self.model.config.num_labels == 1 and (activation is None or "Sigmoid" in activation)
+        logger.info(f"Cross-encoder ONNX int8 caricato: {model_name}")
+
+    def predict(self, pairs: List[Tuple[str, str]], batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        scores = []
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            inputs = self.tokenizer(
+                [query for query, _ in batch], [text for _, text in batch],
+                padding=True, truncation=True, max_length=self.max_length, return_tensors="np"
+            )
+            logits = np.asarray(self.model(**inputs).logits, dtype=np.float32)
+            scores.append(logits[:, 0] if logits.shape[1] == 1 else logits)
+        if not scores:
+            return np.zeros(0, dtype=np.float32)
+        scores = np.concatenate(scores)
+        return 1.0 / (1.0 + np.exp(-scores)) if self.apply_sigmoid else scores
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Embedding ONNX int8 con mean pooling, equivalenti a HuggingFaceEmbeddings
+    per i modelli sentence-transformers con pooling medio (es. il modello di default).
+    """
+
+    def __init__(self, model_name: str = None, max_length: int = None, batch_size: int = None):
+        self.model_name = model_name or settings.embedding_model_name
+        self.max_length = max_length or settings.onnx_embedding_max_length
+        self.batch_size = batch_size or settings.embedding_batch_size
+        self.model, self.tokenizer = load_quantized_model(self.model_name, "feature-extraction")
+        logger.info(f"Modello di embedding ONNX int8 caricato: {self.model_name}")
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        """Embedding come matrice float32 (una riga per testo)"""
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True, truncation=True, max_length=self.max_length, return_tensors="np"
+            )
+            hidden = np.asarray(self.model(**inputs).last_hidden_state, dtype=np.float32)
+            mask = inputs["attention_mask"][:, :, np.newaxis].astype(np.float32)
+            vectors.append((hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9))
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack(vectors)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text])[0].tolist()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Analisi dell'intento delle query (date, clienti, tipi di file) e indice dei
+metadati dei chunk, condivisi da HybridRetriever e SimpleRAG.
+
+I pattern vengono compilati una sola volta a livello di modulo e le
+risoluzioni (filename, cliente, data del Journal) sono lookup su dizionari
+precalcolati al caricamento dell'indice.
+"""
+
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+from langchain_core.documents import Document
+
+from config import settings
+
+
+MESI = {
+    'gennaio': '01', 'febbraio': '02', 'marzo': '03', 'aprile': '04',
+    'maggio': '05', 'giugno': '06', 'luglio': '07', 'agosto': '08',
+    'settembre': '09', 'ottobre': '10', 'novembre': '11', 'dicembre': '12'
+}
+_MESI_RE = '|'.join(MESI)
+
+# Pattern di date, nell'ordine di priorità usato per la data principale
+DATE_FULL_RE = re.compile(r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})')                        # DD/MM/YYYY
+DATE_PARTIAL_RE = re.compile(r'(\d{1,2})[/-](\d{1,2})(?!\d)')                          # DD/MM
+DATE_RELATIVE_RE = re.compile(r'\b(oggi|ieri|domani)\b')                                # oggi, ieri, domani
+DATE_WEEKDAY_RE = re.compile(r'\b(lunedì|martedì|mercoledì|giovedì|venerdì|sabato|domenica)\b')
+DATE_DAY_MONTH_YEAR_RE = re.compile(rf'\b(\d{{1,2}})\s+({_MESI_RE})\s+(\d{{4}})\b')     # 17 luglio 2025
+DATE_MONTH_YEAR_RE = re.compile(rf'\b({_MESI_RE})\s+(\d{{4}})\b')                       # luglio 2025
+DATE_DAY_MONTH_RE = re.compile(rf'\b(\d{{1,2}})\s+({_MESI_RE})\b')                      # 15 luglio
+
+JOURNAL_FILENAME_RE = re.compile(r'(\d{2}-\d{2}-\d{4})\.md')
+
+FILE_SEARCH_PATTERNS = [
+    re.compile(r'quali clienti.*\b(corpus|concorrenti|dati|analisi|interventi)\b'),
+    re.compile(r'per quali.*\b(corpus|concorrenti|dati|analisi|interventi)\b'),
+    re.compile(r'elenco.*clienti.*\b(corpus|concorrenti|dati|analisi|interventi)\b'),
+    re.compile(r'lista.*clienti.*\b(corpus|concorrenti|dati|analisi|interventi)\b'),
+    re.compile(r'tutti.*\b(corpus|concorrenti|dati|analisi|interventi)\b.*clienti'),
+]
+
+CALENDAR_KEYWORDS = ['data', 'calendario', 'attività', 'appuntamento', 'meeting', 'riunione', 'impegno']
+LIST_KEYWORDS = ['quali', 'elenco', 'lista', 'tutti', 'ogni', 'ciascun']
+ENUMERATION_KEYWORDS = ['cosa ho fatto', 'cosa ho segnato', 'attività', 'journal']
+PRICE_KEYWORDS = ['€', 'costo', 'prezzo', 'proposta', 'mese']
+GENERAL_INFO_KEYWORDS = ['informazioni generali', 'generale', 'ditta', 'azienda', 'che tipo']
+
+# Keyword nella query -> cliente
+CLIENTI_KEYWORDS = {
+    'didonè': 'Didonè Comacchio',
+    'comacchio': 'Didonè Comacchio',
+    'fis': 'Fis',
+    'maffeis': 'Maffeis Engineering',
+    'progeo': 'Progeo',
+    'maspe': 'Maspe'
+}
+
+# Keyword nella query -> file specifico
+FILE_KEYWORDS = {
+    'concorrent': 'concorrenti.md',
+    'competitor': 'concorrenti.md',
+    'corpus': 'corpus.md',
+    'dati': 'dati.md',
+    'account': 'dati.md'
+}
+
+
+def _format_date(day: str, month: str, year) -> str:
+    return f"{day.zfill(2)}-{month.zfill(2)}-{year}"
+
+
+def journal_date(metadata: Dict) -> Optional[str]:
+    """Data (DD-MM-YYYY) di un chunk Journal, None per gli altri documenti"""
+    if metadata.get('tipo') != 'journal' and 'Journal/' not in metadata.get('source', ''):
+        return None
+    filename_match = JOURNAL_FILENAME_RE.match(metadata.get('filename', ''))
+    return filename_match.group(1) if filename_match else None
+
+
+def _relative_date(word: str) -> str:
+    oggi = datetime.now()
+    if word == 'ieri':
+        return (oggi - timedelta(days=1)).strftime("%d-%m-%Y")
+    if word == 'domani':
+        return (oggi + timedelta(days=1)).strftime("%d-%m-%Y")
+    return oggi.strftime("%d-%m-%Y")
+
+
+class QueryAnalysis:
+    """Risultato dell'analisi di una query"""
+
+    def __init__(self, query: str):
+        self.query = query
+        self.query_lower = query.lower()
+
+        # Date
+        self.has_date_reference = False         # Qualsiasi riferimento temporale (anche giorno/mese generico)
+        self.target_date: Optional[str] = None  # Prima data risolvibile (DD-MM-YYYY) per il boost Journal
+        self.target_dates: List[str] = []       # Tutte le date esplicite per il lookup dei Journal
+        self.journal_date: Optional[str] = None # Data usata per filtrare i Journal nelle query elenco
+        self.is_calendar_query = False
+
+        # Clienti e file
+        self.mentioned_clienti: Set[str] = set()  # Nomi clienti in lowercase
+        self.mentioned_files: Set[str] = set()    # Filename (es. corpus.md)
+        self.asks_general_info = False
+        self.asks_prices = False
+
+        # Tipo di query
+        self.is_file_search = False
+        self.target_file_type: Optional[str] = None
+        self.has_list_keyword = False
+        self.has_enumeration = False
+
+    @property
+    def is_journal_list_query(self) -> bool:
+        return bool(self.journal_date) and self.has_list_keyword
+
+    def cliente_in_query(self, doc_cliente: str) -> bool:
+        """Verifica se una parola del nome cliente compare nella query"""
+        return any(word in self.query_lower for word in doc_cliente.split())
+
+
+class QueryAnalyzer:
+    """Rileva date, clienti, tipi di file e tipo di query con pattern precompilati"""
+
+    def analyze(self, query: str) -> QueryAnalysis:
+        analysis = QueryAnalysis(query)
+        query_lower = analysis.query_lower
+
+        self._analyze_dates(analysis)
+        analysis.is_calendar_query = any(keyword in query_lower for keyword in CALENDAR_KEYWORDS)
+
+        analysis.mentioned_clienti = {
+            cliente.lower() for keyword, cliente in CLIENTI_KEYWORDS.items() if keyword in query_lower
+        }
+        analysis.mentioned_files = {
+            filename for keyword, filename in FILE_KEYWORDS.items() if keyword in query_lower
+        }
+        analysis.asks_general_info = any(term in query_lower for term in GENERAL_INFO_KEYWORDS)
+        analysis.asks_prices = any(term in query_lower for term in PRICE_KEYWORDS)
+
+        for pattern in FILE_SEARCH_PATTERNS:
+            match = pattern.search(query_lower)
+            if match:
+                analysis.is_file_search = True
+                analysis.target_file_type = match.group(1)
+                break
+
+        if not analysis.is_file_search:
+            analysis.has_list_keyword = any(keyword in query_lower for keyword in LIST_KEYWORDS)
+            analysis.has_enumeration = any(keyword in query_lower for keyword in ENUMERATION_KEYWORDS)
+
+        return analysis
+
+    def _analyze_dates(self, analysis: QueryAnalysis):
+        query_lower = analysis.query_lower
+        current_year = datetime.now().year
+
+        full = DATE_FULL_RE.findall(query_lower)
+        partial = DATE_PARTIAL_RE.findall(query_lower)
+        relative = DATE_RELATIVE_RE.findall(query_lower)
+        day_month_year = DATE_DAY_MONTH_YEAR_RE.findall(query_lower)
+
+        # Tutte le date esplicite (lookup dei Journal)
+        target_dates = [_format_date(d, m, y) for d, m, y in full]
+        target_dates += [_format_date(d, m, current_year) for d, m in partial]
+        target_dates += [_relative_date(word) for word in relative]
+        target_dates += [_format_date(d, MESI[name], y) for d, name, y in day_month_year]
+        analysis.target_dates = target_dates
+
+        # Data principale: primo pattern che trova corrispondenza
+        if full:
+            date = _format_date(*full[0])
+        elif partial:
+            date = _format_date(*partial[0], current_year)
+        elif relative:
+            date = _relative_date(relative[0])
+        else:
+            date = None
+
+        if date:
+            analysis.has_date_reference = True
+            analysis.target_date = date
+            analysis.journal_date = date
+        elif DATE_WEEKDAY_RE.search(query_lower):
+            # Giorno della settimana: riferimento temporale senza data esatta
+            analysis.has_date_reference = True
+            if day_month_year:
+                analysis.journal_date = _format_date(day_month_year[0][0], MESI[day_month_year[0][1]],
+                                                     day_month_year[0][2])
+        elif day_month_year:
+            d, name, y = day_month_year[0]
+            analysis.has_date_reference = True
+            analysis.target_date = _format_date(d, MESI[name], y)
+            analysis.journal_date = analysis.target_date
+        elif DATE_MONTH_YEAR_RE.search(query_lower) or DATE_DAY_MONTH_RE.search(query_lower):
+            analysis.has_date_reference = True
+
+
+class MetadataIndex:
+    """
+    Indice dei metadati dei chunk per posizione FAISS.
+
+    Oltre ai dizionari per i lookup (filename, cliente, data Journal) espone
+    array NumPy allineati alle posizioni FAISS con i flag usati dal boosting;
+    cliente, filename e data Journal sono codificati come interi (-1 se assenti).
+    """
+
+    def __init__(self, documents: List[Document], recent_year: int = None):
+        self.by_filename: Dict[str, List[int]] = {}
+        self.by_cliente: Dict[str, List[int]] = {}
+        self.journal_by_date: Dict[str, List[int]] = {}  # Solo chunk con tipo 'journal'
+
+        self.filename_codes: Dict[str, int] = {}
+        self.cliente_codes: Dict[str, int] = {}
+        self.journal_date_codes: Dict[str, int] = {}
+
+        recent_year = str(settings.boost_recent_year if recent_year is None else recent_year)
+        n_docs = len(documents)
+        self.is_short_file = np.zeros(n_docs, dtype=bool)
+        self.has_prices = np.zeros(n_docs, dtype=bool)
+        self.mentions_recent_year = np.zeros(n_docs, dtype=bool)  # date_mentioned cita recent_year
+        self.filename_code = np.full(n_docs, -1, dtype=np.int32)
+        self.cliente_code = np.full(n_docs, -1, dtype=np.int32)
+        self.journal_date_code = np.full(n_docs, -1, dtype=np.int32)  # Chunk Journal (tipo o path)
+
+        for i, doc in enumerate(documents):
+            metadata = getattr(doc, 'metadata', None) or {}
+            filename = metadata.get('filename', '').lower()
+            cliente = metadata.get('cliente', '').lower()
+
+            if filename:
+                self.by_filename.setdefault(filename, []).append(i)
+                self.filename_code[i] = self.filename_codes.setdefault(filename, len(self.filename_codes))
+            if cliente:
+                self.by_cliente.setdefault(cliente, []).append(i)
+                self.cliente_code[i] = self.cliente_codes.setdefault(cliente, len(self.cliente_codes))
+
+            self.is_short_file[i] = bool(metadata.get('is_short_file', False))
+            self.has_prices[i] = bool(metadata.get('prices'))
+            self.mentions_recent_year[i] = recent_year in (metadata.get('date_mentioned') or '')
+
+            doc_date = journal_date(metadata)
+            if doc_date:
+                self.journal_date_code[i] = self.journal_date_codes.setdefault(doc_date, len(self.journal_date_codes))
+                if metadata.get('tipo') == 'journal':
+                    self.journal_by_date.setdefault(doc_date, []).append(i)
+
+        # Nomi clienti ordinati per codice
+        self.cliente_names = sorted(self.cliente_codes, key=self.cliente_codes.get)
+
+    def find_journal_docs(self, dates: List[str]) -> List[int]:
+        """Posizioni dei chunk Journal per le date indicate"""
+        indices = []
+        for date in dict.fromkeys(dates):
+            indices.extend(self.journal_by_date.get(date, []))
+        return sorted(indices)
@@ -1,23 +1,292 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import json
+import uuid
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Optional, Dict, Any
+from typing import List, Tuple, Optional, Dict, Any, Iterable, Callable, Sequence
 from pathlib import Path
 import numpy as np
+import faiss
 
 from langchain_core.documents import Document
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
-import chromadb
+try:
+    import chromadb
+except ImportError:  # Opzionale: non presente nell'installazione minimale
+    chromadb = None
 
 from utils.logger import StructuredLogger
 from config import settings
+from core.embeddings import CachedEmbeddings
 
 
 logger = StructuredLogger(__name__)
 
+INDEX_PARAMS_FILE = "index_params.json"  # Spec e parametri di ricerca salvati accanto a index.faiss
+
+
+def build_faiss_index(
+    documents: List[Document], 
+    embeddings, 
+    index_spec: str = "Flat", 
+    ids: List[str] = None
+) -> FAISS:
+    """
+    Crea un index FAISS di LangChain con la struttura indicata
+    
+    Args:
+        documents: Chunk da indicizzare
+        embeddings: Modello di embedding
+        index_spec: Stringa di faiss.index_factory ("Flat", "HNSW32",
+            "IVF256,Flat", "IVF256,PQ16", ...)
+        ids: ID docstore (opzionali)
+    
+    Gli index IVF/PQ vengono addestrati sugli embedding dei chunk stessi e
+    richiedono almeno tanti chunk quante sono le liste IVF.
+    """
+    if index_spec == "Flat":
+        return FAISS.from_documents(documents, embeddings, ids=ids)
+    
+    texts = [doc.page_content for doc in documents]
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    index = faiss.index_factory(vectors.shape[1], index_spec, faiss.METRIC_L2)
+    
+    if not index.is_trained:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None and len(vectors) < ivf.nlist:
+            raise ValueError(f"Index {index_spec}: servono almeno {ivf.nlist} chunk per il training, "
+                             f"disponibili {len(vectors)}")
+        logger.info(f"Training index {index_spec} su {len(vectors)} vettori")
+        index.train(vectors)
+    
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # Mappa diretta: consente reconstruct (ricerca filtrata, eliminazioni, shard)
+        ivf.set_direct_map_type(faiss.DirectMap.Array)
+    
+    vector_store = FAISS(embeddings, index, InMemoryDocstore(), {})
+    vector_store.add_embeddings(
+        list(zip(texts, vectors)),
+        metadatas=[doc.metadata for doc in documents],
+        ids=ids
+    )
+    logger.info(f"Creato index {index_spec} con {len(documents)} documenti")
+    return vector_store
+
+
+def set_search_params(index: faiss.Index, nprobe: int = None, ef_search: int = None) -> None:
+    """Imposta nprobe (IVF) ed efSearch (HNSW) sull'index, se applicabili"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    
+    hnsw_index = faiss.downcast_index(index)
+    if hasattr(hnsw_index, "hnsw") and ef_search:
+        hnsw_index.hnsw.efSearch = ef_search
+
+
+def save_index_params(path: Path, params: Dict[str, Any]) -> None:
+    with open(Path(path) / INDEX_PARAMS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(params, f, indent=2)
+
+
+def load_index_params(path: Path) -> Dict[str, Any]:
+    """Parametri salvati con l'index ({} per gli index Flat creati senza spec)"""
+    params_path = Path(path) / INDEX_PARAMS_FILE
+    if not params_path.exists():
+        return {}
+    with open(params_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_faiss_index(path: Path, embeddings, nprobe: int = None, ef_search: int = None) -> FAISS:
+    """
+    Carica un index FAISS salvato applicando i parametri di ricerca
+    (argomenti espliciti, altrimenti quelli salvati, altrimenti settings)
+    """
+    # Nota: in produzione, rimuovere allow_dangerous_deserialization
+    # e usare un formato di serializzazione sicuro
+    vector_store = FAISS.load_local(str(path), embeddings, allow_dangerous_deserialization=True)
+    ivf = faiss.try_extract_index_ivf(vector_store.index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    params = load_index_params(path)
+    set_search_params(
+        vector_store.index,
+        nprobe=nprobe or params.get("nprobe") or settings.faiss_nprobe,
+        ef_search=ef_search or params.get("ef_search") or settings.faiss_ef_search
+    )
+    return vector_store
+
+
+def delete_from_faiss(vector_store: FAISS, ids: List[str]) -> None:
+    """
+    Elimina chunk per ID docstore mantenendo le posizioni FAISS contigue
+    
+    Gli index Flat usano FAISS.delete di LangChain (remove_ids ricompatta le
+    posizioni). IVF e HNSW non rinumerano gli id dopo remove_ids (HNSW non lo
+    supporta affatto), quindi l'index viene ricostruito dai vettori rimanenti
+    su una copia vuota dell'index già addestrato.
+    """
+    index = vector_store.index
+    if isinstance(faiss.downcast_index(index), faiss.IndexFlat):
+        vector_store.delete(ids)
+        return
+    
+    removed = set(ids)
+    mapping = vector_store.index_to_docstore_id
+    keep = np.array([position for position in range(index.ntotal) if mapping[position] not in removed],
+                    dtype=np.int64)
+    vectors = index.reconstruct_batch(keep) if len(keep) else np.empty((0, index.d), dtype=np.float32)
+    
+    rebuilt = faiss.clone_index(index)
+    rebuilt.reset()
+    rebuilt.add(vectors)
+    
+    vector_store.index = rebuilt
+    vector_store.index_to_docstore_id = {new: mapping[int(old)] for new, old in enumerate(keep)}
+    vector_store.docstore.delete(list(removed))
+
+
+def faiss_ids_by_source(vector_store: FAISS) -> Dict[str, List[str]]:
+    """ID docstore dei chunk indicizzati, raggruppati per file sorgente (in ordine di posizione)"""
+    ids_by_source: Dict[str, List[str]] = {}
+    docstore = vector_store.docstore
+    for position in sorted(vector_store.index_to_docstore_id):
+        doc_id = vector_store.index_to_docstore_id[position]
+        source = docstore.search(doc_id).metadata.get("source", "")
+        ids_by_source.setdefault(source, []).append(doc_id)
+    return ids_by_source
+
+
+class MetadataPositionIndex:
+    """
+    Indice metadato -> posizioni FAISS per la ricerca pre-filtrata.
+    
+    Le posizioni di ogni chiave (es. client_name, file_type, subfolder)
+    vengono raggruppate per valore al primo utilizzo della chiave; un filtro
+    diventa l'intersezione degli array di posizioni dei valori richiesti.
+    """
+    
+    def __init__(self, documents: Sequence[Document]):
+        self.documents = documents  # In ordine di posizione FAISS
+        self._by_key: Dict[str, Dict[Any, np.ndarray]] = {}
+    
+    def __len__(self) -> int:
+        return len(self.documents)
+    
+    def positions_by_value(self, key: str) -> Dict[Any, np.ndarray]:
+        """Valore -> posizioni ordinate dei chunk con quel valore per la chiave"""
+        if key not in self._by_key:
+            groups: Dict[Any, List[int]] = {}
+            for position, doc in enumerate(self.documents):
+                value = doc.metadata.get(key)
+                if value is None or isinstance(value, (list, dict, set)):
+                    continue
+                groups.setdefault(value, []).append(position)
+            self._by_key[key] = {value: np.array(positions, dtype=np.int64) for value, positions in groups.items()}
+        return self._by_key[key]
+    
+    def positions_matching(self, key: str, predicate: Callable[[Any], bool]) -> np.ndarray:
+        """Posizioni dei chunk il cui valore per la chiave soddisfa il predicato"""
+        matches = [positions for value, positions in self.positions_by_value(key).items() if predicate(value)]
+        if not matches:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(matches))
+    
+    def filter(
+        self, 
+        metadata_filter: Dict[str, Any] = None, 
+        contains_filter: Dict[str, str] = None
+    ) -> Optional[np.ndarray]:
+        """
+        Posizioni dei chunk che soddisfano tutti i filtri
+        
+        Args:
+            metadata_filter: Chiave -> valore esatto
+            contains_filter: Chiave -> sottostringa contenuta nel valore
+            
+        Returns:
+            Array ordinato di posizioni, None se non ci sono filtri
+        """
+        selections = [
+            self.positions_by_value(key).get(value, np.empty(0, dtype=np.int64))
+            for key, value in (metadata_filter or {}).items()
+        ]
+        selections += [
+            self.positions_matching(key, lambda value, part=part: part in str(value))
+            for key, part in (contains_filter or {}).items()
+        ]
+        if not selections:
+            return None
+        
+        # Interseca partendo dalla selezione più stretta
+        selections.sort(key=len)
+        positions = selections[0]
+        for other in selections[1:]:
+            if not len(positions):
+                break
+            positions = np.intersect1d(positions, other, assume_unique=True)
+        return positions
+
+
+def compact_faiss(vector_store: FAISS, drop_missing_sources: bool = False) -> Dict[str, int]:
+    """
+    Compatta un index FAISS di LangChain
+    
+    - rimuove i chunk duplicati (stessa sorgente e stesso testo), tenendo
+      il più recente, lasciati dagli aggiornamenti che accodavano senza
+      eliminare la versione precedente;
+    - opzionalmente rimuove i chunk di file sorgente non più esistenti;
+    - elimina dal docstore i documenti non più referenziati dall'index.
+    
+    La rimozione dei vettori avviene con un'unica chiamata a delete, che
+    ricompatta le posizioni FAISS.
+    
+    Returns:
+        Dict con chunk prima/dopo e rimossi per categoria
+    """
+    docstore = vector_store.docstore
+    before = vector_store.index.ntotal
+    
+    duplicate_ids = []
+    missing_ids = []
+    for source, doc_ids in faiss_ids_by_source(vector_store).items():
+        if drop_missing_sources and source and not Path(source).exists():
+            missing_ids.extend(doc_ids)
+            continue
+        
+        # Scorre dal più recente: le copie precedenti dello stesso testo sono duplicati
+        seen = set()
+        for doc_id in reversed(doc_ids):
+            content = docstore.search(doc_id).page_content
+            if content in seen:
+                duplicate_ids.append(doc_id)
+            else:
+                seen.add(content)
+    
+    if duplicate_ids or missing_ids:
+        delete_from_faiss(vector_store, duplicate_ids + missing_ids)
+    
+    referenced = set(vector_store.index_to_docstore_id.values())
+    orphan_ids = [doc_id for doc_id in list(docstore._dict) if doc_id not in referenced]
+    if orphan_ids:
+        docstore.delete(orphan_ids)
+    
+    stats = {
+        "chunks_before": before,
+        "chunks_after": vector_store.index.ntotal,
+        "duplicates_removed": len(duplicate_ids),
+        "missing_sources_removed": len(missing_ids),
+        "orphans_removed": len(orphan_ids)
+    }
+    logger.info("Index FAISS compattato", **stats)
+    return stats
+
 
 class VectorStore(ABC):
     """Abstract base class per vector stores"""
@@ -51,26 +320,80 @@ class VectorStore(ABC):
     def delete(self, ids: List[str]) -> None:
         """Elimina documenti per ID"""
         pass
+    
+    @abstractmethod
+    def similarity_search_with_filter(
+        self, 
+        query: str, 
+        k: int = 4, 
+        metadata_filter: Dict[str, Any] = None, 
+        contains_filter: Dict[str, str] = None
+    ) -> List[Tuple[Document, float]]:
+        """Cerca documenti simili tra quelli che soddisfano i filtri sui metadata"""
+        pass
+    
+    @abstractmethod
+    def get_ids_by_source(self, source: str) -> List[str]:
+        """ID dei chunk di un file sorgente"""
+        pass
+    
+    def delete_sources(self, sources: Iterable[str]) -> int:
+        """Elimina tutti i chunk dei file sorgente indicati, restituisce il numero di chunk rimossi"""
+        ids = [doc_id for source in dict.fromkeys(sources) for doc_id in self.get_ids_by_source(source)]
+        if ids:
+            self.delete(ids)
+        return len(ids)
+    
+    def replace_documents(self, documents: List[Document]) -> int:
+        """
+        Sostituisce i chunk dei file sorgente presenti in documents
+        
+        Returns:
+            Numero di chunk precedenti rimossi
+        """
+        removed = self.delete_sources(doc.metadata.get("source", "") for doc in documents)
+        self.add_documents(documents)
+        return removed
 
 
 class FAISSVectorStore(VectorStore):
     """Implementazione FAISS del vector store"""
     
-    def __init__(self, embedding_model_name: str = None):
+    def __init__(
+        self, 
+        embedding_model_name: str = None, 
+        embeddings: CachedEmbeddings = None, 
+        index_spec: str = None, 
+        nprobe: int = None, 
+        ef_search: int = None
+    ):
         self.embedding_model_name = embedding_model_name or settings.embedding_model_name
-        self.embeddings = HuggingFaceEmbeddings(model_name=self.embedding_model_name)
+        # embeddings condivisi evitano di caricare il modello per ogni index (es. shard per cliente)
+        self.embeddings = embeddings or CachedEmbeddings(self.embedding_model_name)
         self.vector_store: Optional[FAISS] = None
+        # Struttura dell'index per i nuovi index e parametri di ricerca (None: salvati o settings)
+        self.index_spec = index_spec or settings.faiss_index_spec
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.ids_by_source: Dict[str, List[str]] = {}  # Sorgente -> ID docstore dei suoi chunk
+        self._metadata_index: Optional[MetadataPositionIndex] = None  # Ricostruito dopo ogni modifica
         logger.info(f"Inizializzato FAISS vector store con modello: {self.embedding_model_name}")
     
     def add_documents(self, documents: List[Document]) -> None:
         """Aggiunge documenti al vector store"""
+        ids = [str(uuid.uuid4()) for _ in documents]
         try:
             if self.vector_store is None:
-                self.vector_store = FAISS.from_documents(documents, self.embeddings)
+                self.vector_store = build_faiss_index(documents, self.embeddings, self.index_spec, ids=ids)
+                set_search_params(self.vector_store.index, **self.search_params)
                 logger.info(f"Creato nuovo FAISS index con {len(documents)} documenti")
             else:
-                self.vector_store.add_documents(documents)
+                self.vector_store.add_documents(documents, ids=ids)
                 logger.info(f"Aggiunti {len(documents)} documenti all'index esistente")
+            
+            for doc, doc_id in zip(documents, ids):
+                self.ids_by_source.setdefault(doc.metadata.get("source", ""), []).append(doc_id)
+            self._metadata_index = None
         except Exception as e:
             logger.error(f"Errore nell'aggiunta documenti", exception=e)
             raise
@@ -111,6 +434,7 @@ class FAISSVectorStore(VectorStore):
         
         try:
             self.vector_store.save_local(str(path))
+            save_index_params(path, {"index_spec": self.index_spec, **self.search_params})
             logger.info(f"Vector store salvato in: {path}")
         except Exception as e:
             logger.error(f"Errore nel salvataggio", exception=e, path=str(path))
@@ -119,22 +443,156 @@ class FAISSVectorStore(VectorStore):
     def load(self, path: Path) -> None:
         """Carica il vector store"""
         try:
-            # Nota: in produzione, rimuovere allow_dangerous_deserialization
-            # e usare un formato di serializzazione sicuro
-            self.vector_store = FAISS.load_local(
-                str(path), 
-                self.embeddings,
-                allow_dangerous_deserialization=True
-            )
+            self.vector_store = load_faiss_index(path, self.embeddings, self.nprobe, self.ef_search)
+            params = load_index_params(path)
+            self.index_spec = params.get("index_spec", "Flat")
+            self.nprobe = self.nprobe or params.get("nprobe")
+            self.ef_search = self.ef_search or params.get("ef_search")
+            self.ids_by_source = faiss_ids_by_source(self.vector_store)
+            self._metadata_index = None
             logger.info(f"Vector store caricato da: {path}")
         except Exception as e:
             logger.error(f"Errore nel caricamento", exception=e, path=str(path))
             raise
     
+    @property
+    def search_params(self) -> Dict[str, int]:
+        return {
+            "nprobe": self.nprobe or settings.faiss_nprobe,
+            "ef_search": self.ef_search or settings.faiss_ef_search
+        }
+    
     def delete(self, ids: List[str]) -> None:
-        """FAISS non supporta eliminazione diretta"""
-        logger.warning("FAISS non supporta l'eliminazione di documenti singoli")
-        raise NotImplementedError("FAISS non supporta l'eliminazione di documenti")
+        """Elimina chunk per ID docstore (i vettori vengono rimossi dall'index)"""
+        if self.vector_store is None:
+            logger.warning("Vector store non inizializzato")
+            return
+        
+        try:
+            docstore = self.vector_store.docstore
+            sources = {docstore.search(doc_id).metadata.get("source", "") for doc_id in ids}
+            delete_from_faiss(self.vector_store, ids)
+            self._metadata_index = None
+            
+            removed = set(ids)
+            for source in sources:
+                remaining = [doc_id for doc_id in self.ids_by_source.get(source, []) if doc_id not in removed]
+                if remaining:
+                    self.ids_by_source[source] = remaining
+                else:
+                    self.ids_by_source.pop(source, None)
+            logger.info(f"Eliminati {len(ids)} chunk da FAISS")
+        except Exception as e:
+            logger.error(f"Errore nell'eliminazione documenti", exception=e)
+            raise
+    
+    def get_ids_by_source(self, source: str) -> List[str]:
+        """ID dei chunk di un file sorgente"""
+        return list(self.ids_by_source.get(source, []))
+    
+    def compact(self, drop_missing_sources: bool = False) -> Dict[str, int]:
+        """Compatta l'index (duplicati, sorgenti mancanti, documenti orfani); vedi compact_faiss"""
+        if self.vector_store is None:
+            logger.warning("Vector store non inizializzato")
+            return {}
+        
+        stats = compact_faiss(self.vector_store, drop_missing_sources)
+        self.ids_by_source = faiss_ids_by_source(self.vector_store)
+        self._metadata_index = None
+        return stats
+    
+    @property
+    def metadata_index(self) -> MetadataPositionIndex:
+        """Indice metadato -> posizioni, allineato alle posizioni FAISS correnti"""
+        if self._metadata_index is None:
+            docstore = self.vector_store.docstore
+            mapping = self.vector_store.index_to_docstore_id
+            self._metadata_index = MetadataPositionIndex(
+                [docstore.search(mapping[position]) for position in range(self.vector_store.index.ntotal)]
+            )
+        return self._metadata_index
+    
+    def similarity_search_with_filter(
+        self, 
+        query: str, 
+        k: int = 4, 
+        metadata_filter: Dict[str, Any] = None, 
+        contains_filter: Dict[str, str] = None
+    ) -> List[Tuple[Document, float]]:
+        """
+        Ricerca ristretta ai chunk che soddisfano i filtri sui metadata
+        
+        Le posizioni ammesse vengono risolte con il MetadataPositionIndex e la
+        ricerca avviene solo su quei vettori: il risultato è esatto e contiene
+        min(k, chunk ammessi) documenti, con costo proporzionale alla selezione.
+        
+        Args:
+            query: Query di ricerca
+            k: Numero di risultati
+            metadata_filter: Chiave -> valore esatto (es. {"client_name": "Maspe"})
+            contains_filter: Chiave -> sottostringa (es. {"subfolder": "proposte"})
+        """
+        if self.vector_store is None:
+            logger.warning("Vector store non inizializzato")
+            return []
+        
+        positions = self.metadata_index.filter(metadata_filter, contains_filter)
+        if positions is None:
+            return self.similarity_search_with_score(query, k=k)
+        if not len(positions):
+            return []
+        
+        try:
+            query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32).reshape(1, -1)
+            if getattr(self.vector_store, "_normalize_L2", False):
+                faiss.normalize_L2(query_vector)
+            
+            top_positions, scores = self._search_positions(query_vector, positions, min(k, len(positions)))
+            documents = self.metadata_index.documents
+            results = [(documents[position], float(score)) for position, score in zip(top_positions, scores)]
+            logger.debug(f"Trovati {len(results)} documenti su {len(positions)} ammessi dal filtro")
+            return results
+        except Exception as e:
+            logger.error(f"Errore nella ricerca filtrata", exception=e, query=query)
+            return []
+    
+    def _search_positions(self, query_vector: np.ndarray, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k tra le sole posizioni ammesse (distanze come FAISS: L2 al quadrato o inner product)"""
+        index = self.vector_store.index
+        inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+        try:
+            # Ricostruisce solo i vettori ammessi e li confronta direttamente
+            vectors = index.reconstruct_batch(positions)
+        except RuntimeError:
+            # Index senza ricostruzione diretta: ricerca FAISS limitata da un selettore
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(len(positions), faiss.swig_ptr(positions)))
+            scores, found = index.search(query_vector, k, params=params)
+            valid = found[0] >= 0
+            return found[0][valid], scores[0][valid]
+        
+        if inner_product:
+            scores = vectors @ query_vector[0]
+            order = np.argsort(-scores, kind='stable')[:k]
+        else:
+            scores = ((vectors - query_vector[0]) ** 2).sum(axis=1)
+            order = np.argsort(scores, kind='stable')[:k]
+        return positions[order], scores[order]
+    
+    def metadata_values(self, key: str) -> Dict[Any, int]:
+        """Valori presenti per una chiave di metadata, con numero di chunk"""
+        if self.vector_store is None:
+            return {}
+        return {value: len(positions) for value, positions in self.metadata_index.positions_by_value(key).items()}
+    
+    def get_documents(self, metadata_filter: Dict[str, Any] = None) -> List[Document]:
+        """Chunk che soddisfano il filtro (tutti se il filtro è vuoto), senza ricerca semantica"""
+        if self.vector_store is None:
+            return []
+        documents = self.metadata_index.documents
+        positions = self.metadata_index.filter(metadata_filter)
+        if positions is None:
+            return list(documents)
+        return [documents[position] for position in positions]
 
 
 class ChromaVectorStore(VectorStore):
@@ -145,6 +603,9 @@ class ChromaVectorStore(VectorStore):
         self.embeddings = HuggingFaceEmbeddings(model_name=self.embedding_model_name)
         self.persist_directory = persist_directory
         
+        if chromadb is None:
+            raise ImportError("Il pacchetto chromadb è richiesto per ChromaVectorStore")
+        
         # Inizializza Chroma client
         self.chroma_client = chromadb.PersistentClient(path=persist_directory)
         self.collection_name = "rag_collection"
@@ -200,6 +661,39 @@ class ChromaVectorStore(VectorStore):
         except Exception as e:
             logger.error(f"Errore nell'eliminazione documenti", exception=e)
             raise
+    
+    def get_ids_by_source(self, source: str) -> List[str]:
+        """ID dei chunk di un file sorgente"""
+        return self.vector_store.get(where={"source": source}).get("ids", [])
+    
+    def similarity_search_with_filter(
+        self, 
+        query: str, 
+        k: int = 4, 
+        metadata_filter: Dict[str, Any] = None, 
+        contains_filter: Dict[str, str] = None
+    ) -> List[Tuple[Document, float]]:
+        """Filtri esatti applicati da Chroma (where); i filtri per sottostringa sui risultati"""
+        conditions = [{key: value} for key, value in (metadata_filter or {}).items()]
+        where = None
+        if len(conditions) == 1:
+            where = conditions[0]
+        elif conditions:
+            where = {"$and": conditions}
+        
+        try:
+            fetch_k = k * 3 if contains_filter else k
+            results = self.vector_store.similarity_search_with_score(query, k=fetch_k, filter=where)
+        except Exception as e:
+            logger.error(f"Errore nella ricerca filtrata Chroma", exception=e)
+            return []
+        
+        if contains_filter:
+            results = [
+                (doc, score) for doc, score in results
+                if all(part in str(doc.metadata.get(key, '')) for key, part in contains_filter.items())
+            ]
+        return results[:k]
 
 
 class VectorStoreFactory:
@@ -231,25 +725,12 @@ class VectorStoreManager:
         k: int = 4, 
         metadata_filter: Dict[str, Any] = None
     ) -> List[Document]:
-        """Cerca con filtri sui metadata"""
-        # Prima ottieni tutti i risultati
-        results = self.vector_store.similarity_search(query, k=k*3)  # Prendi più risultati
-        
+        """Cerca con filtri sui metadata (la ricerca è ristretta ai documenti ammessi)"""
         if not metadata_filter:
-            return results[:k]
-        
-        # Filtra per metadata
-        filtered_results = []
-        for doc in results:
-            match = True
-            for key, value in metadata_filter.items():
-                if key not in doc.metadata or doc.metadata[key] != value:
-                    match = False
-                    break
-            if match:
-                filtered_results.append(doc)
+            return self.vector_store.similarity_search(query, k=k)
         
-        return filtered_results[:k]
+        results = self.vector_store.similarity_search_with_filter(query, k=k, metadata_filter=metadata_filter)
+        return [doc for doc, _ in results]
     
     def hybrid_search(
         self,
@@ -2,14 +2,38 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from rank_bm25 import BM25Okapi
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.documents import Document
 from config import settings
-import re
+from core.embeddings import CachedEmbeddings
+from core.bm25_index import load_or_sync, tokenize
+from core.query_analyzer import QueryAnalyzer, MetadataIndex
+from core.boosting import MetadataBooster
+from core.vector_store import load_faiss_index
 import os
 
 
+def _first_occurrences(ids: np.ndarray) -> np.ndarray:
+    """Indici della prima occorrenza di ogni id, nell'ordine originale"""
+    _, first = np.unique(ids, return_index=True)
+    return np.sort(first)
+
+
+def _rank_positions(candidate_ids: np.ndarray, ranked_ids: np.ndarray) -> np.ndarray:
+    """Posizione di ogni candidato in ranked_ids (-1 se assente)"""
+    ranks = np.full(len(candidate_ids), -1, dtype=np.int64)
+    _, candidate_pos, ranked_pos = np.intersect1d(candidate_ids, ranked_ids, return_indices=True)
+    ranks[candidate_pos] = ranked_pos
+    return ranks
+
+
+def _gather_by_rank(values: np.ndarray, ranks: np.ndarray) -> np.ndarray:
+    """Valori per posizione nella lista (0.0 per i candidati assenti, rank -1)"""
+    gathered = np.zeros(len(ranks), dtype=np.float64)
+    present = ranks >= 0
+    gathered[present] = values[ranks[present]]
+    return gathered
+
+
 class HybridRetriever:
     """
     Retriever ibrido che combina semantic search (FAISS) con keyword search (BM25)
@@ -18,61 +42,77 @@ class HybridRetriever:
     
     def __init__(self, faiss_index_path="obsidian_index"):
         self.faiss_index_path = faiss_index_path
-        self.embeddings = HuggingFaceEmbeddings(model_name=settings.embedding_model_name)
+        self.embeddings = CachedEmbeddings(settings.embedding_model_name)  # Query ripetute non vengono ri-embeddate
         self.vector_store = None
         self.bm25 = None
         self.documents = []
         self.doc_texts = []
+        self.query_analyzer = QueryAnalyzer()
+        self.metadata_index = None
+        self.booster = None
         
     def load_index(self):
         """Carica l'indice FAISS e prepara BM25"""
         print("Caricamento indice FAISS...")
-        self.vector_store = FAISS.load_local(
-            self.faiss_index_path,
-            self.embeddings,
-            allow_dangerous_deserialization=True
-        )
+        # Applica anche nprobe/efSearch salvati con l'indice (indici IVF/HNSW)
+        self.vector_store = load_faiss_index(self.faiss_index_path, self.embeddings)
         
-        # Ottieni tutti i documenti per BM25
+        # Documenti allineati alle posizioni FAISS (posizione i -> self.documents[i])
         print("Preparazione indice BM25...")
-        all_docs = []
-        all_texts = []
-        
-        # Estrai tutti i documenti dal docstore
         docstore = self.vector_store.docstore
         index_to_docstore_id = self.vector_store.index_to_docstore_id
+        doc_keys = [index_to_docstore_id[i] for i in range(self.vector_store.index.ntotal)]
         
-        for i in range(self.vector_store.index.ntotal):
-            try:
-                # Ottieni l'ID del documento
-                doc_id = index_to_docstore_id[i]
-                # Ottieni il documento dal docstore
-                doc = docstore.search(doc_id)
-                if doc:
-                    all_docs.append(doc)
-                    all_texts.append(doc.page_content)
-            except Exception as e:
-                # Ignore errori di accesso a documenti specifici
-                continue
-        
-        self.documents = all_docs
-        self.doc_texts = all_texts
-        
-        # Prepara BM25
-        tokenized_docs = [self._tokenize(text) for text in all_texts]
-        self.bm25 = BM25Okapi(tokenized_docs)
+        # InMemoryDocstore.search restituisce una stringa di errore per gli ID
+        # mancanti: si usa un Document vuoto per non perdere l'allineamento
+        self.documents = []
+        missing = 0
+        for doc_id in doc_keys:
+            doc = docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                doc = Document(page_content="", metadata={})
+                missing += 1
+            self.documents.append(doc)
+        if missing:
+            print(f"⚠️  {missing} ID FAISS senza documento nel docstore (sostituiti da placeholder vuoti)")
+        self.doc_texts = [getattr(doc, 'page_content', '') for doc in self.documents]
+        
+        # Indice BM25 persistito accanto all'indice FAISS: viene ricostruito
+        # solo per i chunk nuovi rispetto all'ultimo salvataggio
+        self.bm25 = load_or_sync(self.faiss_index_path, doc_keys, lambda i: self.doc_texts[i])
+        
+        # Indice metadati (filename, cliente, data Journal) per lookup O(1)
+        self.metadata_index = MetadataIndex(self.documents)
+        self.booster = MetadataBooster(self.metadata_index)
         
         print(f"✅ Hybrid retriever pronto con {len(self.documents)} documenti")
         
+    def create_reranker(self, reranker_type="lightweight", **kwargs):
+        """
+        Reranker per i risultati di search
+        
+        Il reranker leggero usa il modello di embedding e l'indice FAISS già
+        caricati: i vettori dei chunk candidati vengono letti dall'indice
+        invece di essere ricalcolati.
+        
+        Args:
+            reranker_type: "lightweight" o "cross-encoder"
+            **kwargs: Argomenti passati a reranker.create_reranker
+        """
+        if not self.vector_store:
+            raise RuntimeError("Carica prima l'indice con load_index()")
+        
+        from reranker import create_reranker  # Import lazy: carica sentence-transformers solo se serve
+        if reranker_type == "lightweight":
+            kwargs.setdefault("embeddings", self.embeddings)
+            kwargs.setdefault("vector_store", self.vector_store)
+        return create_reranker(reranker_type, **kwargs)
+    
     def _tokenize(self, text):
         """Tokenizza il testo per BM25"""
-        # Pulizia e tokenizzazione semplice
-        text = text.lower()
-        text = re.sub(r'[^\w\s]', ' ', text)  # Rimuovi punteggiatura
-        tokens = text.split()
-        return tokens
+        return tokenize(text)
     
-    def search(self, query, k=5, alpha=0.8):
+    def search(self, query, k=5, alpha=0.8, analysis=None, fusion=None):
         """
         Ricerca ibrida che combina semantic search e keyword search
         
@@ -80,175 +120,30 @@ class HybridRetriever:
             query: Query di ricerca
             k: Numero di documenti da restituire
             alpha: Peso per semantic search (1-alpha per BM25)
+            analysis: QueryAnalysis già calcolata (opzionale)
+            fusion: 'weighted' (somma pesata dei punteggi) o 'rrf' (reciprocal rank
+                fusion); default da settings.hybrid_fusion
         """
         if not self.vector_store or not self.bm25:
             raise RuntimeError("Carica prima l'indice con load_index()")
         
-        # 1. Semantic search con FAISS
+        if analysis is None:
+            analysis = self.query_analyzer.analyze(query)
+        
+        # 1. Semantic search con FAISS (posizioni nell'indice + distanze)
         print("🔍 Semantic search...")
-        semantic_docs = self.vector_store.similarity_search_with_score(query, k=k*4)  # Aumentiamo k per avere più possibilità
+        semantic_ids, semantic_distances = self._semantic_search(query, k*4)  # Aumentiamo k per avere più possibilità
         
-        # 2. Keyword search con BM25
+        # 2. Keyword search con BM25 (solo documenti che contengono i termini della query)
         print("🔍 Keyword search...")
-        query_tokens = self._tokenize(query)
-        bm25_scores = self.bm25.get_scores(query_tokens)
+        bm25_results = self.bm25.top_k(self._tokenize(query), k*4)  # Aumentiamo anche qui
         
-        # Ottieni i migliori documenti da BM25
-        bm25_indices = np.argsort(bm25_scores)[::-1][:k*4]  # Aumentiamo anche qui
+        # 2.5. Date-specific search e unione dei candidati
+        candidates = self._merge_candidates(analysis, semantic_ids, semantic_distances, *bm25_results)
         
-        # 2.5. Date-specific search - se la query contiene date, cerca documenti Journal corrispondenti
-        date_specific_indices = self._find_date_specific_docs(query.lower())
-        if date_specific_indices:
-            print(f"🗓️ Found {len(date_specific_indices)} date-specific Journal entries")
-            # Aggiungi questi indici ai risultati BM25 con priorità
-            bm25_indices = np.concatenate([date_specific_indices, bm25_indices])
-            bm25_indices = np.unique(bm25_indices)  # Rimuovi duplicati
-        
-        # 3. Fusion dei risultati
+        # 3-4. Fusion dei risultati con boost sui metadati e riordino
         print("🔄 Fusion dei risultati...")
-        doc_scores = {}
-        
-        # Aggiungi punteggi semantic (inverti la distanza)
-        for doc, distance in semantic_docs:
-            doc_key = doc.page_content[:100]  # Usa i primi 100 caratteri come chiave
-            semantic_score = 1 / (1 + distance)  # Converti distanza in score
-            doc_scores[doc_key] = {
-                'doc': doc,
-                'semantic_score': semantic_score,
-                'bm25_score': 0.0
-            }
-        
-        # Aggiungi punteggi BM25
-        for idx in bm25_indices:
-            if idx < len(self.documents):
-                doc = self.documents[idx]
-                doc_key = doc.page_content[:100]
-                bm25_score = bm25_scores[idx]
-                
-                # Boost artificiale per documenti date-specific
-                if idx in date_specific_indices:
-                    bm25_score = max(bm25_scores) * 2.0  # Score molto alto per date match
-                
-                if doc_key in doc_scores:
-                    doc_scores[doc_key]['bm25_score'] = bm25_score
-                else:
-                    doc_scores[doc_key] = {
-                        'doc': doc,
-                        'semantic_score': 0.0,
-                        'bm25_score': bm25_score
-                    }
-        
-        # 4. Calcola punteggio finale con boost per file corti e riordina
-        final_results = []
-        for doc_key, scores in doc_scores.items():
-            # Normalizza i punteggi
-            semantic_norm = scores['semantic_score']
-            bm25_norm = scores['bm25_score'] / (max(bm25_scores) + 1e-10)
-            
-            # Combina con alpha
-            final_score = alpha * semantic_norm + (1 - alpha) * bm25_norm
-            
-            # BOOST PER FILE CORTI E RECENTI
-            doc = scores['doc']
-            boost_factor = 1.0
-            
-            # Boost per file corti (maggiore precisione)
-            if doc.metadata.get('is_short_file', False):
-                boost_factor += 0.3
-                
-            # Boost per documenti del cliente menzionato nella query
-            doc_cliente = doc.metadata.get('cliente', '').lower()
-            query_lower = query.lower()
-            
-            # Lista di clienti comuni da cercare
-            clienti_keywords = {
-                'didonè': 'Didonè Comacchio',
-                'comacchio': 'Didonè Comacchio', 
-                'fis': 'Fis',
-                'maffeis': 'Maffeis Engineering',
-                'progeo': 'Progeo',
-                'maspe': 'Maspe'
-            }
-            
-            # Cerca se un cliente è menzionato nella query
-            for keyword, cliente_name in clienti_keywords.items():
-                if keyword in query_lower and doc_cliente == cliente_name.lower():
-                    boost_factor += 0.8
-                    break
-                
-            # Boost per documenti recenti (2025)
-            if doc.metadata.get('date_mentioned') and '2025' in doc.metadata.get('date_mentioned', ''):
-                boost_factor += 0.2
-                
-            # Boost per documenti con prezzi se la query contiene termini di costo
-            if any(term in query.lower() for term in ['€', 'costo', 'prezzo', 'proposta', 'mese']) and doc.metadata.get('prices'):
-                boost_factor += 0.4
-                
-            # Boost per query con date specifiche - priorità per file Journal
-            date_boost = self._detect_date_query(query_lower, doc)
-            if date_boost > 0:
-                boost_factor += date_boost
-            
-            # Boost per file specifici menzionati nella query
-            file_keywords = {
-                'concorrent': 'concorrenti.md',
-                'competitor': 'concorrenti.md',
-                'corpus': 'corpus.md',
-                'dati': 'dati.md',
-                'account': 'dati.md'
-            }
-            
-            doc_filename = doc.metadata.get('filename', '').lower()
-            
-            # BOOST SPECIALE per query che chiedono informazioni generali SUL CLIENTE GIUSTO
-            if any(term in query_lower for term in ['informazioni generali', 'generale', 'ditta', 'azienda', 'che tipo']):
-                if doc_filename == 'corpus.md':
-                    # Verifica che sia il corpus del cliente menzionato nella query
-                    cliente_in_query = False
-                    for keyword, cliente_name in clienti_keywords.items():
-                        if keyword in query_lower and doc_cliente == cliente_name.lower():
-                            cliente_in_query = True
-                            break
-                    
-                    if cliente_in_query:
-                        boost_factor += 3.5  # Boost molto alto per corpus.md del cliente giusto
-                    else:
-                        # Piccolo boost per corpus in generale, ma non del cliente sbagliato
-                        boost_factor += 0.2
-            
-            for keyword, target_file in file_keywords.items():
-                if keyword in query_lower and doc_filename == target_file:
-                    boost_factor += 0.9
-                    break
-                    
-            # SUPER BOOST quando la query contiene sia il cliente che un tipo di file
-            if doc_cliente:
-                # Check se il cliente è nella query
-                cliente_in_query = any(word in query_lower for word in doc_cliente.split())
-                
-                # Check se un tipo di file è nella query
-                file_type_in_query = any(keyword in query_lower for keyword in file_keywords.keys())
-                
-                # Se entrambi sono presenti e il doc è del cliente giusto con il file giusto
-                if cliente_in_query and file_type_in_query:
-                    for keyword, target_file in file_keywords.items():
-                        if keyword in query_lower and doc_filename == target_file:
-                            boost_factor += 2.0  # Super boost!
-                            break
-            
-            # Applica boost
-            final_score *= boost_factor
-            
-            final_results.append({
-                'doc': scores['doc'],
-                'final_score': final_score,
-                'semantic_score': semantic_norm,
-                'bm25_score': bm25_norm,
-                'boost_factor': boost_factor
-            })
-        
-        # Ordina per punteggio finale
-        final_results.sort(key=lambda x: x['final_score'], reverse=True)
+        final_results = self._rank_candidates(candidates, analysis, alpha, fusion)
         
         # Restituisci i migliori k documenti
         best_docs = [result['doc'] for result in final_results[:k]]
@@ -273,180 +168,170 @@ class HybridRetriever:
         
         return best_docs
     
-    def _detect_date_query(self, query_lower, doc):
+    def search_batch(self, queries, k=5, alpha=0.8, analyses=None, fusion=None):
         """
-        Rileva se la query contiene riferimenti a date specifiche e boost documenti Journal corrispondenti
+        Ricerca ibrida su più query insieme
+        
+        Gli embedding delle query sono calcolati con una sola chiamata al modello,
+        FAISS riceve un'unica matrice e BM25 accumula gli score di tutte le query
+        in un solo passaggio; fusion e boost restano per query.
         
         Args:
-            query_lower: Query in lowercase
-            doc: Documento da valutare
+            queries: Lista di query
+            k: Numero di documenti da restituire per query
+            alpha: Peso per semantic search (1-alpha per BM25)
+            analyses: Lista di QueryAnalysis già calcolate (opzionale)
+            fusion: 'weighted' o 'rrf'; default da settings.hybrid_fusion
             
         Returns:
-            float: Valore di boost (0.0 se nessun boost, >0 se boost applicabile)
+            list: Per ogni query, la lista dei migliori k documenti
         """
-        import re
-        from datetime import datetime, timedelta
-        
-        # Controlla se il documento è dalla directory Journal
-        doc_path = doc.metadata.get('source', '')
-        is_journal = 'Journal/' in doc_path or doc.metadata.get('tipo') == 'journal'
-        
-        if not is_journal:
-            return 0.0
-        
-        # Pattern di date da cercare nella query
-        date_patterns = [
-            # Formato DD/MM/YYYY o DD-MM-YYYY
-            r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})',
-            # Formato DD/MM o DD-MM
-            r'(\d{1,2})[/-](\d{1,2})(?!\d)',
-            # Formato "oggi", "ieri", "domani"
-            r'\b(oggi|ieri|domani)\b',
-            # Formato "lunedì", "martedì", etc.
-            r'\b(lunedì|martedì|mercoledì|giovedì|venerdì|sabato|domenica)\b',
-            # Formato "DD mese YYYY" es. "17 luglio 2025" - DEVE ESSERE PRIMA degli altri pattern mese
-            r'\b(\d{1,2})\s+(gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre)\s+(\d{4})\b',
-            # Formato "mese anno" es. "luglio 2025"
-            r'\b(gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre)\s+(\d{4})\b',
-            # Formato "DD mese" es. "15 luglio"  
-            r'\b(\d{1,2})\s+(gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre)\b'
+        queries = list(queries)
+        batch_docs = []
+        for analysis, candidates in self.collect_candidates(queries, k, analyses):
+            final_results = self._rank_candidates(candidates, analysis, alpha, fusion)
+            batch_docs.append([result['doc'] for result in final_results[:k]])
+        
+        print(f"📊 Hybrid batch search completata su {len(queries)} query")
+        return batch_docs
+    
+    def collect_candidates(self, queries, k=5, analyses=None):
+        """
+        Candidati semantic + BM25 di più query, senza fusion
+        
+        Permette di rifare fusion e boost con parametri diversi (alpha, pesi)
+        senza ripetere embedding, FAISS e BM25.
+        
+        Returns:
+            list: Per ogni query, tupla (QueryAnalysis, candidati di _merge_candidates)
+        """
+        if not self.vector_store or not self.bm25:
+            raise RuntimeError("Carica prima l'indice con load_index()")
+        
+        queries = list(queries)
+        if analyses is None:
+            analyses = [self.query_analyzer.analyze(query) for query in queries]
+        
+        semantic_results = self._semantic_search_batch(queries, k*4)
+        bm25_results = self.bm25.top_k_batch([self._tokenize(query) for query in queries], k*4)
+        return [
+            (analysis, self._merge_candidates(analysis, semantic_ids, semantic_distances, *bm25_result, verbose=False))
+            for analysis, (semantic_ids, semantic_distances), bm25_result in zip(analyses, semantic_results, bm25_results)
         ]
+    
+    def _merge_candidates(self, analysis, semantic_ids, semantic_distances, bm25_ids, bm25_scores, bm25_max,
+                          verbose=True):
+        """
+        Unisce i candidati semantic e BM25 sugli id interi dei chunk
         
-        # Cerca pattern di date nella query
-        date_found = False
-        target_date = None
-        
-        for pattern in date_patterns:
-            matches = re.findall(pattern, query_lower)
-            if matches:
-                date_found = True
-                # Per semplicità, prendiamo il primo match
-                match = matches[0]
-                
-                if pattern == r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})':
-                    # Formato completo DD/MM/YYYY
-                    day, month, year = match
-                    target_date = f"{day.zfill(2)}-{month.zfill(2)}-{year}"
-                elif pattern == r'(\d{1,2})[/-](\d{1,2})(?!\d)':
-                    # Formato DD/MM (assumiamo anno corrente)
-                    day, month = match
-                    current_year = datetime.now().year
-                    target_date = f"{day.zfill(2)}-{month.zfill(2)}-{current_year}"
-                elif pattern == r'\b(oggi|ieri|domani)\b':
-                    # Relativi temporali
-                    oggi = datetime.now()
-                    if match == 'oggi':
-                        target_date = oggi.strftime("%d-%m-%Y")
-                    elif match == 'ieri':
-                        ieri = oggi - timedelta(days=1)
-                        target_date = ieri.strftime("%d-%m-%Y")
-                    elif match == 'domani':
-                        domani = oggi + timedelta(days=1)
-                        target_date = domani.strftime("%d-%m-%Y")
-                elif pattern == r'\b(\d{1,2})\s+(gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre)\s+(\d{4})\b':
-                    # Formato "DD mese YYYY"
-                    day, month_name, year = match
-                    # Converti nome mese in numero
-                    mesi = {
-                        'gennaio': '01', 'febbraio': '02', 'marzo': '03', 'aprile': '04',
-                        'maggio': '05', 'giugno': '06', 'luglio': '07', 'agosto': '08',
-                        'settembre': '09', 'ottobre': '10', 'novembre': '11', 'dicembre': '12'
-                    }
-                    month_num = mesi[month_name]
-                    target_date = f"{day.zfill(2)}-{month_num}-{year}"
-                break
-        
-        if not date_found:
-            return 0.0
-        
-        # Estrai la data dal filename del documento Journal
-        doc_filename = doc.metadata.get('filename', '')
-        filename_match = re.match(r'(\d{2}-\d{2}-\d{4})\.md', doc_filename)
-        
-        if not filename_match:
-            return 0.0
-            
-        doc_date = filename_match.group(1)
+        Gli id sono le posizioni FAISS, condivise da BM25 e indice metadati:
+        prima i candidati semantici, poi quelli trovati solo da BM25.
+        
+        Returns:
+            dict: id dei candidati con rank/distanza semantica e rank/score BM25
+                (-1 se il candidato non compare nella lista)
+        """
+        # Date-specific search - se la query contiene date, cerca documenti Journal corrispondenti
+        date_specific_ids = self._find_date_specific_docs(analysis)
+        if len(date_specific_ids):
+            if verbose:
+                print(f"🗓️ Found {len(date_specific_ids)} date-specific Journal entries")
+            # I Journal della data richiesta precedono i risultati BM25 con score molto alto
+            merged_ids = np.concatenate([date_specific_ids, bm25_ids])
+            merged_scores = np.concatenate([np.full(len(date_specific_ids), bm25_max * 2.0), bm25_scores])
+            keep = _first_occurrences(merged_ids)
+            bm25_ids, bm25_scores = merged_ids[keep], merged_scores[keep]
+        
+        candidate_ids = np.concatenate([semantic_ids, bm25_ids[~np.isin(bm25_ids, semantic_ids)]])
+        return {
+            'ids': candidate_ids,
+            'semantic_rank': _rank_positions(candidate_ids, semantic_ids),
+            'semantic_distances': semantic_distances,
+            'bm25_rank': _rank_positions(candidate_ids, bm25_ids),
+            'bm25_scores': bm25_scores,
+            'bm25_max': bm25_max
+        }
+    
+    def _fusion_scores(self, candidates, fusion=None):
+        """
+        Componenti semantic e BM25 normalizzate dei candidati
         
-        # Se abbiamo una data target specifica, controlla corrispondenza esatta
-        if target_date and target_date == doc_date:
-            return 1.5  # Boost alto per corrispondenza esatta
+        Returns:
+            tuple: (semantic_norm, bm25_norm) allineati a candidates['ids']
+        """
+        fusion = fusion or settings.hybrid_fusion
+        semantic_rank = candidates['semantic_rank']
+        bm25_rank = candidates['bm25_rank']
+        
+        if fusion == 'rrf':
+            # Reciprocal rank fusion: conta solo la posizione nelle due liste
+            rrf_k = settings.rrf_k
+            semantic_norm = np.where(semantic_rank >= 0, 1.0 / (rrf_k + semantic_rank + 1), 0.0)
+            bm25_norm = np.where(bm25_rank >= 0, 1.0 / (rrf_k + bm25_rank + 1), 0.0)
+        elif fusion == 'weighted':
+            # Distanza L2 convertita in score, BM25 normalizzato sul massimo
+            semantic_scores = 1 / (1 + np.asarray(candidates['semantic_distances'], dtype=np.float64))
+            semantic_norm = _gather_by_rank(semantic_scores, semantic_rank)
+            bm25_norm = _gather_by_rank(candidates['bm25_scores'], bm25_rank) / (candidates['bm25_max'] + 1e-10)
+        else:
+            raise ValueError(f"Metodo di fusion non supportato: {fusion}")
+        return semantic_norm, bm25_norm
+    
+    def _rank_candidates(self, candidates, analysis, alpha, fusion=None):
+        """Punteggio finale con boost sui metadati, ordinato in modo decrescente"""
+        candidate_ids = candidates['ids']
+        semantic_norm, bm25_norm = self._fusion_scores(candidates, fusion)
+        boost_factors = self.booster.boost_factors(candidate_ids, analysis)
+        final_scores = (alpha * semantic_norm + (1 - alpha) * bm25_norm) * boost_factors
+        
+        # Ordina per punteggio finale (stabile: a parità vince l'ordine di arrivo)
+        order = np.argsort(-final_scores, kind='stable')
+        return [{
+            'doc': self.documents[candidate_ids[i]],
+            'index': int(candidate_ids[i]),
+            'final_score': final_scores[i],
+            'semantic_score': semantic_norm[i],
+            'bm25_score': bm25_norm[i],
+            'boost_factor': boost_factors[i]
+        } for i in order.tolist()]
+    
+    def _semantic_search(self, query, k):
+        """
+        Semantic search diretta sull'indice FAISS
         
-        # Se la query menziona genericamente "data", "calendario", "attività", boost Journal files
-        calendar_keywords = ['data', 'calendario', 'attività', 'appuntamento', 'meeting', 'riunione', 'impegno']
-        if any(keyword in query_lower for keyword in calendar_keywords):
-            return 0.7  # Boost moderato per query generiche di calendario
+        Returns:
+            tuple: (posizioni FAISS, distanze L2) dei k chunk più vicini
+        """
+        query_vector = self.embeddings.embed_query_array(query)[np.newaxis, :]
+        distances, indices = self.vector_store.index.search(query_vector, k)
+        valid = indices[0] >= 0  # FAISS restituisce -1 se k supera i documenti indicizzati
+        return indices[0][valid].astype(np.int64), distances[0][valid]
+    
+    def _semantic_search_batch(self, queries, k):
+        """
+        Semantic search di più query con un'unica chiamata a FAISS
         
-        return 0.0
+        Returns:
+            list: Per ogni query, tupla (posizioni FAISS, distanze L2)
+        """
+        if not queries:
+            return []
+        query_vectors = self.embeddings.embed_queries_array(queries)
+        distances, indices = self.vector_store.index.search(query_vectors, k)
+        valid = indices >= 0
+        return [(indices[i][valid[i]].astype(np.int64), distances[i][valid[i]]) for i in range(len(queries))]
     
-    def _find_date_specific_docs(self, query_lower):
+    def _find_date_specific_docs(self, analysis):
         """
         Trova documenti Journal specifici per date menzionate nella query
         
         Args:
-            query_lower: Query in lowercase
+            analysis: QueryAnalysis della query
             
         Returns:
-            list: Indici dei documenti Journal che corrispondono alle date nella query
+            np.ndarray: Indici dei documenti Journal che corrispondono alle date nella query
         """
-        import re
-        from datetime import datetime, timedelta
-        
-        # Pattern di date (usa gli stessi della detection)
-        date_patterns = [
-            r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})',
-            r'(\d{1,2})[/-](\d{1,2})(?!\d)',
-            r'\b(oggi|ieri|domani)\b',
-            r'\b(\d{1,2})\s+(gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre)\s+(\d{4})\b',
-        ]
-        
-        target_dates = []
-        
-        # Estrai tutte le date dalla query
-        for pattern in date_patterns:
-            matches = re.findall(pattern, query_lower)
-            for match in matches:
-                if pattern == r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})':
-                    day, month, year = match
-                    target_dates.append(f"{day.zfill(2)}-{month.zfill(2)}-{year}")
-                elif pattern == r'(\d{1,2})[/-](\d{1,2})(?!\d)':
-                    day, month = match
-                    current_year = datetime.now().year
-                    target_dates.append(f"{day.zfill(2)}-{month.zfill(2)}-{current_year}")
-                elif pattern == r'\b(oggi|ieri|domani)\b':
-                    oggi = datetime.now()
-                    if match == 'oggi':
-                        target_dates.append(oggi.strftime("%d-%m-%Y"))
-                    elif match == 'ieri':
-                        ieri = oggi - timedelta(days=1)
-                        target_dates.append(ieri.strftime("%d-%m-%Y"))
-                    elif match == 'domani':
-                        domani = oggi + timedelta(days=1)
-                        target_dates.append(domani.strftime("%d-%m-%Y"))
-                elif pattern == r'\b(\d{1,2})\s+(gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre)\s+(\d{4})\b':
-                    # Formato "DD mese YYYY"
-                    day, month_name, year = match
-                    # Converti nome mese in numero
-                    mesi = {
-                        'gennaio': '01', 'febbraio': '02', 'marzo': '03', 'aprile': '04',
-                        'maggio': '05', 'giugno': '06', 'luglio': '07', 'agosto': '08',
-                        'settembre': '09', 'ottobre': '10', 'novembre': '11', 'dicembre': '12'
-                    }
-                    month_num = mesi[month_name]
-                    target_dates.append(f"{day.zfill(2)}-{month_num}-{year}")
-        
-        if not target_dates:
-            return []
+        if not analysis.target_dates:
+            return np.zeros(0, dtype=np.int64)
         
-        # Cerca documenti Journal con queste date
-        matching_indices = []
-        for i, doc in enumerate(self.documents):
-            if doc.metadata.get('tipo') == 'journal':
-                doc_filename = doc.metadata.get('filename', '')
-                filename_match = re.match(r'(\d{2}-\d{2}-\d{4})\.md', doc_filename)
-                if filename_match:
-                    doc_date = filename_match.group(1)
-                    if doc_date in target_dates:
-                        matching_indices.append(i)
-        
-        return np.array(matching_indices)
\ No newline at end of file
+        return np.array(self.metadata_index.find_journal_docs(analysis.target_dates), dtype=np.int64)
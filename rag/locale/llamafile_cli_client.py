@@ -13,7 +13,7 @@ class LlamafileCLIClient:
     
     def __init__(self, llamafile_path: str = None, model_gguf: str = None):
         # Percorso del llamafile
-        self.llamafile_path = Path(llamafile_path or "/opt/llm/llamafiles/google_gemma-3-4b-it-Q6_K.llamafile")
+        self.llamafile_path = Path(llamafile_path or settings.llamafile_path)
         
         # Modello GGUF (opzionale, il llamafile dovrebbe averne uno built-in)
         self.model_gguf = model_gguf or "google_gemma-3-4b-it-Q6_K.gguf"
@@ -45,7 +45,7 @@ class LlamafileCLIClient:
                 "--cli",
                 "--gpu", "disable",  # Disabilita GPU per evitare crash
                 "-ngl", "0",  # Nessun layer su GPU
-                "-c", "8192",
+                "-c", str(settings.llamafile_ctx_size),
                 "-t", "8",
                 "--temp", str(kwargs.get("temperature", settings.temperature)),
                 "-n", str(kwargs.get("max_tokens", settings.llamafile_max_tokens)),
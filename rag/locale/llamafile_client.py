@@ -1,66 +1,238 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import requests
 import json
-from typing import Optional, Dict, Any
+import threading
+import time
+from typing import Optional, Dict, Any, Iterator, AsyncIterator, List, Tuple
+from requests.adapters import HTTPAdapter
 from config import settings
 
-class LlamafileClient:
-    """Client per interagire con il server llamafile"""
+try:
+    import httpx
+except ImportError:  # Opzionale: serve solo per AsyncLlamafileClient
+    httpx = None
+
+
+class HealthState:
+    """
+    Stato di salute del server condiviso tra le richieste
+    
+    Uno stato sano resta valido per settings.llamafile_health_ttl secondi e
+    ogni richiesta riuscita lo rinnova; dopo un errore di connessione (o se il
+    server non era sano) /health viene ricontrollato alla richiesta successiva.
+    """
+    
+    def __init__(self, ttl: float = None):
+        self.ttl = settings.llamafile_health_ttl if ttl is None else ttl
+        self.healthy: Optional[bool] = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+    
+    def is_fresh(self) -> bool:
+        """Il server risultava sano entro il TTL"""
+        return bool(self.healthy) and time.monotonic() - self.checked_at < self.ttl
+    
+    def mark(self, healthy: bool) -> bool:
+        with self.lock:
+            self.healthy = healthy
+            self.checked_at = time.monotonic()
+        return healthy
+
+
+class BaseLlamafileClient:
+    """Parametri e lettura delle risposte comuni ai client sincrono e asincrono"""
     
     def __init__(self, base_url: str = None, timeout: int = None):
-        self.base_url = base_url or settings.llamafile_base_url
+        self.base_url = (base_url or settings.llamafile_base_url).rstrip("/")
         self.timeout = timeout or settings.llamafile_timeout
+        self.health = HealthState()
+        self.last_usage: Optional[Dict[str, Any]] = None
+    
+    def _build_params(self, prompt: str, stream: bool, **kwargs) -> Dict[str, Any]:
+        """Parametri di default per l'endpoint completion"""
+        params = {
+            "prompt": prompt,
+            "temperature": kwargs.get("temperature", settings.temperature),
+            "max_tokens": kwargs.get("max_tokens", settings.llamafile_max_tokens),
+            "stop": kwargs.get("stop", []),
+            "stream": stream,
+            "cache_prompt": kwargs.get("cache_prompt", settings.llamafile_cache_prompt)
+        }
+        
+        # Slot dedicato per prefisso (con più slot paralleli sul server): prompt con
+        # istruzioni diverse non si sovrascrivono a vicenda la KV cache
+        prefix_key = kwargs.get("prefix_key")
+        if prefix_key is not None and settings.llamafile_parallel > 1:
+            slot = sum(prefix_key.encode()) % settings.llamafile_parallel
+            params["id_slot"] = slot
+            params["slot_id"] = slot  # Nome del parametro nelle versioni llamafile meno recenti
+        return params
+    
+    @staticmethod
+    def _content(result: Dict[str, Any]) -> str:
+        # Il formato di risposta del llamafile è diverso da quello che mi aspettavo
+        content = result.get("content", result.get("choices", [{}])[0].get("text", "")).strip()
         
-    def is_available(self) -> bool:
-        """Controlla se il server è disponibile"""
+        # Rimuovi token di fine turno specifici di Gemma
+        return content.replace("<end_of_turn>", "").strip()
+    
+    @staticmethod
+    def _stream_event(line: str) -> Optional[Dict[str, Any]]:
+        """Evento SSE "data: {...}" del server, None per le altre righe"""
+        if not line or not line.startswith("data:"):
+            return None
+        return json.loads(line[len("data:"):].strip())
+    
+    @staticmethod
+    def _usage(result: Dict[str, Any]) -> Dict[str, Any]:
+        """Token del prompt valutati/riusati e token generati dalla risposta del server"""
+        timings = result.get("timings") or {}
+        prompt_tokens = result.get("tokens_evaluated", 0)
+        evaluated = timings.get("prompt_n", prompt_tokens)  # Solo i token non presenti nella KV cache
+        return {
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_evaluated": evaluated,
+            "prompt_tokens_cached": max(prompt_tokens - evaluated, 0),
+            "completion_tokens": result.get("tokens_predicted", timings.get("predicted_n", 0)),
+            "prompt_ms": timings.get("prompt_ms"),
+            "predicted_ms": timings.get("predicted_ms")
+        }
+
+
+class LlamafileClient(BaseLlamafileClient):
+    """
+    Client per interagire con il server llamafile
+    
+    Le richieste passano da una requests.Session con pool di connessioni
+    keep-alive e lo stato di /health è in cache (HealthState), quindi una
+    generazione costa una sola richiesta HTTP.
+    
+    Le richieste usano "cache_prompt": il server riusa la KV cache dello slot
+    per il prefisso comune con la richiesta precedente (istruzioni statiche
+    del prompt RAG) e valuta solo la parte nuova. last_usage riporta per
+    l'ultima richiesta i token del prompt valutati e quelli riusati.
+    """
+    
+    def __init__(self, base_url: str = None, timeout: int = None):
+        super().__init__(base_url, timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.llamafile_pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+    
+    def is_available(self, force: bool = False) -> bool:
+        """Controlla se il server è disponibile (stato in cache se non scaduto)"""
+        if not force and self.health.is_fresh():
+            return self.health.healthy
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/health",
                 timeout=2
             )
-            return response.status_code == 200
+            return self.health.mark(response.status_code == 200)
         except requests.exceptions.RequestException:
-            return False
+            return self.health.mark(False)
     
     def generate(self, prompt: str, **kwargs) -> str:
         """Genera una risposta dal prompt"""
+        return self.generate_with_usage(prompt, **kwargs)[0]
+    
+    def generate_with_usage(self, prompt: str, **kwargs) -> Tuple[str, Dict[str, Any]]:
+        """
+        Genera una risposta restituendo anche l'uso dei token
+        
+        Returns:
+            Tupla (risposta, usage) con prompt_tokens, prompt_tokens_evaluated,
+            prompt_tokens_cached, completion_tokens e tempi in ms
+        """
         if not self.is_available():
             raise ConnectionError("Server llamafile non disponibile")
         
-        # Parametri di default
-        params = {
-            "prompt": prompt,
-            "temperature": kwargs.get("temperature", settings.temperature),
-            "max_tokens": kwargs.get("max_tokens", settings.llamafile_max_tokens),
-            "stop": kwargs.get("stop", []),
-            "stream": False
-        }
+        params = self._build_params(prompt, stream=False, **kwargs)
         
         try:
             # Usa l'endpoint completion di llamafile
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/completion",
                 json=params,
-                timeout=self.timeout,
-                headers={"Content-Type": "application/json"}
+                timeout=self.timeout
             )
             
             response.raise_for_status()
             result = response.json()
+            self.health.mark(True)
             
-            # Il formato di risposta del llamafile è diverso da quello che mi aspettavo
-            content = result.get("content", result.get("choices", [{}])[0].get("text", "")).strip()
-            
-            # Rimuovi token di fine turno specifici di Gemma
-            content = content.replace("<end_of_turn>", "").strip()
-            
-            return content
-            
+            self.last_usage = self._usage(result)
+            return self._content(result), self.last_usage
+        
+        except requests.exceptions.ConnectionError as e:
+            self.health.mark(False)
+            raise Exception(f"Errore nella richiesta al server llamafile: {e}")
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Errore nella richiesta al server llamafile: {e}")
+    
+    def generate_stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        """
+        Genera la risposta in streaming (modalità "stream": true del server)
+        
+        Il server invia eventi SSE "data: {...}" con il testo generato in
+        "content" e "stop": true sull'ultimo evento.
+        
+        Yields:
+            Frammenti di testo man mano che vengono generati
+        """
+        if not self.is_available():
+            raise ConnectionError("Server llamafile non disponibile")
+        
+        params = self._build_params(prompt, stream=True, **kwargs)
+        
+        try:
+            with self.session.post(
+                f"{self.base_url}/completion",
+                json=params,
+                timeout=self.timeout,
+                stream=True
+            ) as response:
+                response.raise_for_status()
+                self.health.mark(True)
+                
+                for line in response.iter_lines(decode_unicode=True):
+                    event = self._stream_event(line)
+                    if event is None:
+                        continue
+                    
+                    # Rimuovi token di fine turno specifici di Gemma
+                    content = event.get("content", "").replace("<end_of_turn>", "")
+                    if content:
+                        yield content
+                    if event.get("stop"):
+                        # L'ultimo evento contiene gli stessi contatori della risposta completa
+                        self.last_usage = self._usage(event)
+                        break
+        
+        except requests.exceptions.ConnectionError as e:
+            self.health.mark(False)
+            raise Exception(f"Errore nella richiesta al server llamafile: {e}")
         except requests.exceptions.RequestException as e:
             raise Exception(f"Errore nella richiesta al server llamafile: {e}")
     
+    def tokenize(self, text: str) -> List[int]:
+        """Token del testo secondo il tokenizer del modello caricato (endpoint /tokenize)"""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/tokenize",
+                json={"content": text},
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            return response.json()["tokens"]
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Errore nella tokenizzazione sul server llamafile: {e}")
+    
     def invoke(self, prompt: str) -> str:
         """Compatibilità con l'interfaccia LangChain"""
         return self.generate(prompt)
@@ -68,11 +240,145 @@ class LlamafileClient:
     def get_info(self) -> Dict[str, Any]:
         """Ottieni informazioni sul modello"""
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/v1/models",
                 timeout=self.timeout
             )
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
-            return {"error": str(e)}
\ No newline at end of file
+            return {"error": str(e)}
+    
+    def close(self):
+        self.session.close()
+
+
+class AsyncLlamafileClient(BaseLlamafileClient):
+    """
+    Client asyncio per il server llamafile (httpx)
+    
+    Più generazioni possono essere in corso insieme sullo stesso pool di
+    connessioni (fino a settings.llamafile_pool_size). Lo stato di /health è
+    in cache: quando scade viene aggiornato in background senza bloccare la
+    richiesta, e dopo un errore di connessione viene ricontrollato subito.
+    """
+    
+    def __init__(self, base_url: str = None, timeout: int = None):
+        if httpx is None:
+            raise ImportError("AsyncLlamafileClient richiede httpx: pip install httpx")
+        super().__init__(base_url, timeout)
+        self._client: Optional["httpx.AsyncClient"] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+    
+    @property
+    def client(self) -> "httpx.AsyncClient":
+        # Creato al primo uso, dentro l'event loop che lo userà
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=settings.llamafile_pool_size,
+                    max_keepalive_connections=settings.llamafile_pool_size
+                ),
+                headers={"Content-Type": "application/json"}
+            )
+        return self._client
+    
+    async def is_available(self, force: bool = False) -> bool:
+        """
+        Controlla se il server è disponibile (stato in cache se non scaduto)
+        
+        Le richieste concorrenti condividono un unico controllo di /health in corso.
+        """
+        if not force and self.health.is_fresh():
+            return self.health.healthy
+        return await asyncio.shield(self._refresh())
+    
+    def _refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._check_health())
+        return self._refresh_task
+    
+    async def _check_health(self) -> bool:
+        try:
+            response = await self.client.get("/health", timeout=2)
+            return self.health.mark(response.status_code == 200)
+        except httpx.HTTPError:
+            return self.health.mark(False)
+    
+    async def _ensure_available(self):
+        if self.health.healthy and not self.health.is_fresh():
+            # Stato scaduto ma l'ultimo era sano: aggiornamento in background
+            self._refresh()
+            return
+        if not await self.is_available():
+            raise ConnectionError("Server llamafile non disponibile")
+    
+    async def generate(self, prompt: str, **kwargs) -> str:
+        """Genera una risposta dal prompt"""
+        return (await self.generate_with_usage(prompt, **kwargs))[0]
+    
+    async def generate_with_usage(self, prompt: str, **kwargs) -> Tuple[str, Dict[str, Any]]:
+        """
+        Genera una risposta restituendo anche l'uso dei token
+        
+        Returns:
+            Tupla (risposta, usage) come LlamafileClient.generate_with_usage
+        """
+        await self._ensure_available()
+        params = self._build_params(prompt, stream=False, **kwargs)
+        
+        try:
+            response = await self.client.post("/completion", json=params)
+            response.raise_for_status()
+            result = response.json()
+            self.health.mark(True)
+        except httpx.TransportError as e:
+            self.health.mark(False)
+            raise Exception(f"Errore nella richiesta al server llamafile: {e}")
+        except httpx.HTTPError as e:
+            raise Exception(f"Errore nella richiesta al server llamafile: {e}")
+        
+        usage = self._usage(result)
+        self.last_usage = usage
+        return self._content(result), usage
+    
+    async def generate_stream(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        """
+        Genera la risposta in streaming (modalità "stream": true del server)
+        
+        Yields:
+            Frammenti di testo man mano che vengono generati
+        """
+        await self._ensure_available()
+        params = self._build_params(prompt, stream=True, **kwargs)
+        
+        try:
+            async with self.client.stream("POST", "/completion", json=params) as response:
+                response.raise_for_status()
+                self.health.mark(True)
+                
+                async for line in response.aiter_lines():
+                    event = self._stream_event(line)
+                    if event is None:
+                        continue
+                    
+                    # Rimuovi token di fine turno specifici di Gemma
+                    content = event.get("content", "").replace("<end_of_turn>", "")
+                    if content:
+                        yield content
+                    if event.get("stop"):
+                        self.last_usage = self._usage(event)
+                        break
+        
+        except httpx.TransportError as e:
+            self.health.mark(False)
+            raise Exception(f"Errore nella richiesta al server llamafile: {e}")
+        except httpx.HTTPError as e:
+            raise Exception(f"Errore nella richiesta al server llamafile: {e}")
+    
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -1,18 +1,43 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from typing import Any, Dict, Optional
+import asyncio
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
 from langchain_community.llms import LlamaCpp
-from llamafile_client import LlamafileClient
+from llamafile_client import AsyncLlamafileClient, LlamafileClient
 from llamafile_cli_client import LlamafileCLIClient
+from start_llamafile_server import get_local_server
 from config import settings
 
+# Opzioni della cache del prompt, significative solo per il server llamafile
+PROMPT_CACHE_KWARGS = ("cache_prompt", "prefix_key")
+
 class LLMAdapter:
-    """Adapter per supportare LlamaCpp, Llamafile API e Llamafile CLI"""
+    """
+    Adapter per supportare server llamafile gestito, LlamaCpp, Llamafile API e Llamafile CLI
+    
+    Con il server llamafile ainvoke/astream usano il client asyncio, così il
+    layer FastAPI può avere più generazioni in corso senza occupare thread;
+    le altre modalità vengono eseguite in un thread.
+    """
     
     def __init__(self):
         self.client = None
         self.llm_type = None
+        self.server = None
+        self._async_client: Optional[AsyncLlamafileClient] = None
+        self.last_usage = None  # Token del prompt valutati/riusati dell'ultima chiamata (solo server llamafile)
+        
+        # Server persistente: il modello resta caricato tra una query e l'altra
+        if settings.use_llamafile_server:
+            try:
+                self.server = get_local_server()
+                self.client = LlamafileClient(base_url=self.server.base_url)
+                self.llm_type = "llamafile_server"
+                return
+            except Exception as e:
+                print(f"⚠️  Server llamafile gestito non disponibile, uso la modalità successiva: {e}")
+                self.server = None
         
         try:
             # Priorità: CLI > API > LlamaCpp
@@ -42,23 +67,30 @@ class LLMAdapter:
         if self.client is None:
             raise Exception("Modello LLM non inizializzato correttamente")
         
+        self.last_usage = None
         try:
-            if self.llm_type == "llamafile_cli":
+            if self.llm_type == "llamafile_server":
+                result = self._invoke_server(prompt, **kwargs)
+                self.last_usage = self.client.last_usage
+                return result
+            elif self.llm_type == "llamafile_cli":
                 # Modalità CLI diretta - non richiede server
                 result = self.client.generate(prompt, **kwargs)
                 if result is None:
                     raise Exception("Llamafile CLI ha restituito None")
                 return result
             elif self.llm_type == "llamafile_api":
-                # Controlla se il server è disponibile
-                if not self.client.is_available():
+                # Stato di /health in cache nel client: nessuna richiesta extra per generazione
+                try:
+                    result = self.client.generate(prompt, **kwargs)
+                except ConnectionError:
                     raise ConnectionError("Server llamafile non disponibile. Avvia con: python start_llamafile_server.py start")
-                
-                result = self.client.generate(prompt, **kwargs)
                 if result is None:
                     raise Exception("Il server llamafile ha restituito None")
+                self.last_usage = self.client.last_usage
                 return result
             else:
+                kwargs = {key: value for key, value in kwargs.items() if key not in PROMPT_CACHE_KWARGS}
                 result = self.client.invoke(prompt, **kwargs)
                 if result is None:
                     raise Exception("LlamaCpp ha restituito None")
@@ -66,9 +98,151 @@ class LLMAdapter:
         except Exception as e:
             raise Exception(f"Errore nell'invocazione del modello LLM ({self.llm_type}): {e}")
     
+    def _invoke_server(self, prompt: str, **kwargs) -> str:
+        """Generazione sul server gestito, con un nuovo tentativo dopo il riavvio se è caduto"""
+        if not self.server.ensure_running():
+            raise ConnectionError("Server llamafile gestito non disponibile")
+        try:
+            result = self.client.generate(prompt, **kwargs)
+        except Exception:
+            if self.server.is_healthy() or not self.server.recover():
+                raise
+            result = self.client.generate(prompt, **kwargs)
+        if result is None:
+            raise Exception("Il server llamafile ha restituito None")
+        return result
+    
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        """
+        Invoca il modello LLM restituendo il testo man mano che viene generato
+        
+        Il server llamafile usa la modalità "stream": true e LlamaCpp il suo
+        stream nativo; la modalità CLI non supporta lo streaming e restituisce
+        la risposta completa in un unico frammento.
+        """
+        if self.client is None:
+            raise Exception("Modello LLM non inizializzato correttamente")
+        
+        try:
+            if self.llm_type in ["llamafile_server", "llamafile_api"]:
+                if self.server is not None and not self.server.ensure_running():
+                    raise ConnectionError("Server llamafile gestito non disponibile")
+                yield from self.client.generate_stream(prompt, **kwargs)
+            elif self.llm_type == "llamacpp":
+                kwargs = {key: value for key, value in kwargs.items() if key not in PROMPT_CACHE_KWARGS}
+                yield from self.client.stream(prompt, **kwargs)
+            else:
+                yield self.invoke(prompt, **kwargs)
+        except Exception as e:
+            raise Exception(f"Errore nello streaming del modello LLM ({self.llm_type}): {e}")
+    
+    @property
+    def context_window(self) -> int:
+        """Token della finestra di contesto del modello in uso"""
+        if self.llm_type == "llamafile_server":
+            return settings.llamafile_ctx_size // settings.llamafile_parallel  # Contesto diviso tra gli slot
+        elif self.llm_type == "llamacpp":
+            return settings.n_ctx
+        return settings.llamafile_ctx_size
+    
+    @property
+    def max_answer_tokens(self) -> int:
+        """Token massimi richiesti per la risposta (max_tokens inviato al modello)"""
+        if self.llm_type == "llamacpp":
+            return self.client.max_tokens
+        return settings.llamafile_max_tokens
+    
+    def count_tokens(self, text: str) -> Optional[int]:
+        """
+        Token del testo con il tokenizer del modello
+        
+        Returns:
+            Numero di token, None se la modalità non espone il tokenizer (CLI)
+        """
+        if self.llm_type in ["llamafile_server", "llamafile_api"]:
+            return len(self.client.tokenize(text))
+        elif self.llm_type == "llamacpp":
+            return len(self.client.client.tokenize(text.encode("utf-8"), add_bos=False))
+        return None
+    
+    @property
+    def has_tokenizer(self) -> bool:
+        return self.llm_type in ["llamafile_server", "llamafile_api", "llamacpp"]
+    
+    @property
+    def async_client(self) -> AsyncLlamafileClient:
+        """Client asyncio verso lo stesso server del client sincrono (creato al primo uso)"""
+        if self._async_client is None:
+            self._async_client = AsyncLlamafileClient(base_url=self.client.base_url)
+        return self._async_client
+    
+    async def ainvoke_with_usage(self, prompt: str, **kwargs) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Versione asyncio di invoke che restituisce anche l'uso dei token
+        
+        Returns:
+            Tupla (risposta, usage); usage è None per CLI e LlamaCpp
+        """
+        if self.client is None:
+            raise Exception("Modello LLM non inizializzato correttamente")
+        
+        if self.llm_type not in ["llamafile_server", "llamafile_api"]:
+            result = await asyncio.to_thread(self.invoke, prompt, **kwargs)
+            return result, None
+        
+        try:
+            if self.server is not None and not self.server.ensure_running():
+                raise ConnectionError("Server llamafile gestito non disponibile")
+            try:
+                return await self.async_client.generate_with_usage(prompt, **kwargs)
+            except Exception:
+                # Server gestito caduto: riavvio (in un thread, è bloccante) e nuovo tentativo
+                if self.server is None or await asyncio.to_thread(self.server.is_healthy):
+                    raise
+                if not await asyncio.to_thread(self.server.recover):
+                    raise
+                return await self.async_client.generate_with_usage(prompt, **kwargs)
+        except Exception as e:
+            raise Exception(f"Errore nell'invocazione del modello LLM ({self.llm_type}): {e}")
+    
+    async def ainvoke(self, prompt: str, **kwargs) -> str:
+        """Versione asyncio di invoke"""
+        result, usage = await self.ainvoke_with_usage(prompt, **kwargs)
+        self.last_usage = usage
+        return result
+    
+    async def astream(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        """Versione asyncio di stream"""
+        if self.client is None:
+            raise Exception("Modello LLM non inizializzato correttamente")
+        
+        if self.llm_type not in ["llamafile_server", "llamafile_api"]:
+            yield await asyncio.to_thread(self.invoke, prompt, **kwargs)
+            return
+        
+        try:
+            if self.server is not None and not self.server.ensure_running():
+                raise ConnectionError("Server llamafile gestito non disponibile")
+            async for content in self.async_client.generate_stream(prompt, **kwargs):
+                yield content
+        except Exception as e:
+            raise Exception(f"Errore nello streaming del modello LLM ({self.llm_type}): {e}")
+    
+    async def aclose(self):
+        """Chiude le connessioni del client asyncio"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+    
     def get_info(self) -> Dict[str, Any]:
         """Ottieni informazioni sul modello"""
-        if self.llm_type == "llamafile_cli":
+        if self.llm_type == "llamafile_server":
+            return {
+                "type": "llamafile_server",
+                "server": self.server.get_info(),
+                "model_info": self.client.get_info()
+            }
+        elif self.llm_type == "llamafile_cli":
             return {
                 "type": "llamafile_cli",
                 "model_info": self.client.get_info()
@@ -92,7 +266,9 @@ class LLMAdapter:
         if self.client is None:
             return False
         
-        if self.llm_type in ["llamafile_cli", "llamafile_api"]:
+        if self.llm_type == "llamafile_server":
+            return self.server.ensure_running()
+        elif self.llm_type in ["llamafile_cli", "llamafile_api"]:
             return self.client.is_available()
         else:
             return True  # LlamaCpp è sempre disponibile se caricato correttamente
\ No newline at end of file
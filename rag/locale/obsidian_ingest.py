@@ -8,9 +8,11 @@ Indicizza il vault Obsidian preservando struttura e metadati
 
 import os
 import re
+import argparse
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from concurrent.futures import ProcessPoolExecutor
 
 from langchain_community.document_loaders import TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
@@ -18,17 +20,47 @@ from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 from config import settings
+from core.bm25_index import load_or_sync
+from core.vector_store import (
+    build_faiss_index, compact_faiss, delete_from_faiss, faiss_ids_by_source, load_faiss_index,
+    save_index_params
+)
+from core.file_tracker import FileTracker
+
+
+# Istanza per i processi worker del pool di parsing (inizializzata una volta per processo)
+_worker_ingest = None
+
+
+def _init_worker(vault_path: str):
+    global _worker_ingest
+    _worker_ingest = ObsidianIngest(vault_path)
+
+
+def _load_and_split_worker(file_path: Path) -> List[Document]:
+    return _worker_ingest.load_and_split_file(file_path)
 
 
 class ObsidianIngest:
     def __init__(self, vault_path: str = "/opt/obsidian/appunti"):
         self.vault_path = Path(vault_path)
-        self.embeddings = HuggingFaceEmbeddings(model_name=settings.embedding_model_name)
+        self._embeddings = None  # Caricato solo quando serve (non nei worker di parsing)
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=settings.chunk_size,
             chunk_overlap=settings.chunk_overlap
         )
         self.min_chunk_size = 100  # Chunk minimo per file molto corti
+        self.parallel_threshold = 8  # Sotto questa soglia il parsing resta nel processo principale
+    
+    @property
+    def embeddings(self) -> HuggingFaceEmbeddings:
+        if self._embeddings is None:
+            # Batch grandi: in ingestion si codificano molti chunk insieme
+            self._embeddings = HuggingFaceEmbeddings(
+                model_name=settings.embedding_model_name,
+                encode_kwargs={"batch_size": settings.embedding_batch_size}
+            )
+        return self._embeddings
         
     def extract_metadata(self, file_path: Path) -> Dict[str, Any]:
         """Estrae metadati dal percorso file e contenuto"""
@@ -137,20 +169,21 @@ class ObsidianIngest:
             print(f"Errore caricamento {file_path}: {e}")
             return []
     
+    def list_vault_files(self) -> List[Path]:
+        """Elenca i file markdown del vault (esclusi i file di sistema)"""
+        return [file_path for file_path in sorted(self.vault_path.rglob("*.md"))
+                if not file_path.name.startswith('.')]
+    
     def load_vault(self) -> List[Document]:
         """Carica tutto il vault Obsidian"""
         documents = []
         
         # Trova tutti i file markdown
-        md_files = list(self.vault_path.rglob("*.md"))
+        md_files = self.list_vault_files()
         
         print(f"📚 Trovati {len(md_files)} file markdown nel vault")
         
         for file_path in md_files:
-            # Salta file di sistema
-            if file_path.name.startswith('.'):
-                continue
-                
             # Carica documento
             docs = self.load_markdown_with_metadata(file_path)
             documents.extend(docs)
@@ -161,30 +194,60 @@ class ObsidianIngest:
         print(f"✅ Caricati {len(documents)} documenti totali")
         return documents
     
+    def split_document(self, doc: Document) -> List[Document]:
+        """Divide un documento in chunk (i file molto corti restano interi)"""
+        # Se il documento è molto corto, mantienilo intero
+        if len(doc.page_content.strip()) <= self.min_chunk_size:
+            # Aggiungi metadati per identificare chunk piccoli
+            doc.metadata["is_short_file"] = True
+            doc.metadata["original_length"] = len(doc.page_content)
+            print(f"📄 File corto mantenuto intero: {doc.metadata.get('filename', 'N/A')} ({len(doc.page_content)} char)")
+            return [doc]
+        
+        # Chunking normale per file lunghi
+        return self.text_splitter.split_documents([doc])
+    
+    def load_and_split_file(self, file_path: Path) -> List[Document]:
+        """Carica un file markdown e lo divide in chunk"""
+        chunks = []
+        for doc in self.load_markdown_with_metadata(file_path):
+            chunks.extend(self.split_document(doc))
+        return chunks
+    
+    def load_and_split_files(self, files: List[Path], max_workers: Optional[int] = None) -> Dict[Path, List[Document]]:
+        """
+        Carica e divide in chunk i file indicati, in un pool di processi
+        
+        Returns:
+            Dizionario file -> chunk, nell'ordine dei file
+        """
+        if len(files) < self.parallel_threshold:
+            return {file_path: self.load_and_split_file(file_path) for file_path in files}
+        
+        max_workers = max_workers or settings.ingest_workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(str(self.vault_path),)) as executor:
+            results = executor.map(_load_and_split_worker, files, chunksize=8)
+            return dict(zip(files, results))
+    
+    def get_file_tracker(self, output_path: str = "obsidian_index") -> FileTracker:
+        """Tracker dei file indicizzati, salvato accanto all'indice FAISS"""
+        Path(output_path).mkdir(parents=True, exist_ok=True)
+        return FileTracker(Path(output_path) / "file_tracker.db")
+    
     def create_index(self, output_path: str = "obsidian_index"):
         """Crea indice FAISS dal vault Obsidian"""
         print("🔍 Caricamento vault Obsidian...")
-        documents = self.load_vault()
-        
-        if not documents:
-            print("❌ Nessun documento caricato")
-            return
+        md_files = self.list_vault_files()
+        print(f"📚 Trovati {len(md_files)} file markdown nel vault")
         
         print("✂️ Chunking documenti...")
-        chunks = []
+        file_chunks = self.load_and_split_files(md_files)
+        chunks = [chunk for doc_chunks in file_chunks.values() for chunk in doc_chunks]
         
-        for doc in documents:
-            # Se il documento è molto corto, mantienilo intero
-            if len(doc.page_content.strip()) <= self.min_chunk_size:
-                # Aggiungi metadati per identificare chunk piccoli
-                doc.metadata["is_short_file"] = True
-                doc.metadata["original_length"] = len(doc.page_content)
-                chunks.append(doc)
-                print(f"📄 File corto mantenuto intero: {doc.metadata.get('filename', 'N/A')} ({len(doc.page_content)} char)")
-            else:
-                # Chunking normale per file lunghi
-                doc_chunks = self.text_splitter.split_documents([doc])
-                chunks.extend(doc_chunks)
+        if not chunks:
+            print("❌ Nessun documento caricato")
+            return
         
         print(f"📊 Creati {len(chunks)} chunk totali")
         
@@ -193,17 +256,133 @@ class ObsidianIngest:
             chunk.metadata["chunk_id"] = i
             chunk.metadata["chunk_index"] = i
         
-        print("🧮 Creazione embeddings...")
-        vector_store = FAISS.from_documents(chunks, self.embeddings)
+        print(f"🧮 Creazione embeddings (index {settings.faiss_index_spec})...")
+        vector_store = build_faiss_index(chunks, self.embeddings, settings.faiss_index_spec)
         
         print(f"💾 Salvataggio indice in {output_path}...")
         vector_store.save_local(output_path)
+        save_index_params(output_path, {
+            "index_spec": settings.faiss_index_spec,
+            "nprobe": settings.faiss_nprobe,
+            "ef_search": settings.faiss_ef_search
+        })
+        
+        print("🔤 Aggiornamento indice BM25...")
+        self.update_bm25_index(vector_store, output_path)
+        
+        # Stato dei file per i successivi aggiornamenti incrementali
+        tracker = self.get_file_tracker(output_path)
+        tracker.reset_all()
+        self.track_files(tracker, file_chunks)
         
         print("✅ Indice Obsidian creato con successo!")
+        self.print_stats(file_chunks)
+    
+    def update_index(self, output_path: str = "obsidian_index"):
+        """
+        Aggiorna l'indice FAISS esistente solo per le note nuove, modificate o rimosse
+        
+        I vettori delle note modificate o rimosse vengono eliminati dall'indice,
+        i chunk delle note nuove o modificate vengono embeddati in un unico batch
+        e aggiunti; BM25 e tracker vengono riallineati di conseguenza.
+        """
+        if not (Path(output_path) / "index.faiss").exists():
+            print("ℹ️ Nessun indice esistente, creazione completa")
+            return self.create_index(output_path)
         
-        # Statistiche
+        tracker = self.get_file_tracker(output_path)
+        vector_store = load_faiss_index(output_path, self.embeddings)
+        
+        print("🔍 Ricerca note modificate...")
+        md_files = self.list_vault_files()
+        current_sources = {str(file_path) for file_path in md_files}
+        changed_files = tracker.scan_files(md_files)
+        
+        # Vettori da rimuovere: note modificate e note non più presenti nel vault
+        ids_by_source = faiss_ids_by_source(vector_store)
+        stale_sources = {str(file_path) for file_path in changed_files}
+        stale_sources |= {source for source in ids_by_source if source not in current_sources}
+        stale_ids = [doc_id for source in stale_sources for doc_id in ids_by_source.get(source, [])]
+        removed_records = [Path(row["file_path"]) for row in tracker.get_processed_files()
+                           if row["file_path"] not in current_sources]
+        
+        if not changed_files and not stale_ids and not removed_records:
+            print("✅ Indice già aggiornato, nessuna nota modificata")
+            return
+        
+        print(f"📝 Note nuove/modificate: {len(changed_files)}, chunk obsoleti: {len(stale_ids)}")
+        
+        if stale_ids:
+            delete_from_faiss(vector_store, stale_ids)
+        
+        print("✂️ Chunking documenti...")
+        file_chunks = self.load_and_split_files(changed_files)
+        new_chunks = [chunk for doc_chunks in file_chunks.values() for chunk in doc_chunks]
+        
+        if new_chunks:
+            # Continua la numerazione dei chunk già indicizzati
+            next_chunk_id = max((doc.metadata.get("chunk_id", -1) for doc in self._iter_documents(vector_store)),
+                                default=-1) + 1
+            for i, chunk in enumerate(new_chunks, start=next_chunk_id):
+                chunk.metadata["chunk_id"] = i
+                chunk.metadata["chunk_index"] = i
+            
+            print(f"🧮 Creazione embeddings per {len(new_chunks)} chunk...")
+            vector_store.add_documents(new_chunks)
+        
+        print(f"💾 Salvataggio indice in {output_path}...")
+        vector_store.save_local(output_path)
+        
+        print("🔤 Aggiornamento indice BM25...")
+        self.update_bm25_index(vector_store, output_path)
+        
+        self.track_files(tracker, file_chunks)
+        for file_path in removed_records:
+            tracker.remove_file_record(file_path)
+        
+        print(f"✅ Indice aggiornato: {vector_store.index.ntotal} chunk totali")
+    
+    def compact_index(self, output_path: str = "obsidian_index", drop_missing_sources: bool = True):
+        """
+        Compatta l'indice esistente: elimina chunk duplicati, chunk di note non
+        più presenti nel vault e documenti orfani del docstore, poi riallinea BM25
+        """
+        if not (Path(output_path) / "index.faiss").exists():
+            print(f"❌ Nessun indice in {output_path}")
+            return
+        
+        vector_store = load_faiss_index(output_path, self.embeddings)
+        
+        print("🧹 Compattazione indice...")
+        stats = compact_faiss(vector_store, drop_missing_sources)
+        removed = stats["duplicates_removed"] + stats["missing_sources_removed"] + stats["orphans_removed"]
+        if not removed:
+            print(f"✅ Indice già compatto: {stats['chunks_after']} chunk")
+            return stats
+        
+        print(f"💾 Salvataggio indice in {output_path}...")
+        vector_store.save_local(output_path)
+        
+        print("🔤 Aggiornamento indice BM25...")
+        self.update_bm25_index(vector_store, output_path)
+        
+        print(f"✅ Indice compattato: {stats['chunks_before']} -> {stats['chunks_after']} chunk "
+              f"(duplicati: {stats['duplicates_removed']}, note rimosse: {stats['missing_sources_removed']}, "
+              f"orfani: {stats['orphans_removed']})")
+        return stats
+    
+    def track_files(self, tracker: FileTracker, file_chunks: Dict[Path, List[Document]]):
+        """Registra i file indicizzati nel tracker"""
+        tracker.mark_files_processed([
+            (file_path, len(doc_chunks), doc_chunks[0].metadata.get("cliente") if doc_chunks else None)
+            for file_path, doc_chunks in file_chunks.items()
+        ])
+    
+    def print_stats(self, file_chunks: Dict[Path, List[Document]]):
+        """Statistiche dell'indice creato"""
         clients = set()
         types = set()
+        documents = [doc_chunks[0] for doc_chunks in file_chunks.values() if doc_chunks]
         for doc in documents:
             if "cliente" in doc.metadata:
                 clients.add(doc.metadata["cliente"])
@@ -214,15 +393,40 @@ class ObsidianIngest:
         print(f"  - Clienti: {len(clients)} ({', '.join(sorted(clients))})")
         print(f"  - Tipi: {len(types)} ({', '.join(sorted(types))})")
         print(f"  - Documenti: {len(documents)}")
-        print(f"  - Chunk: {len(chunks)}")
+        print(f"  - Chunk: {sum(len(doc_chunks) for doc_chunks in file_chunks.values())}")
+    
+    @staticmethod
+    def _iter_documents(vector_store: FAISS):
+        docstore = vector_store.docstore
+        for doc_id in vector_store.index_to_docstore_id.values():
+            yield docstore.search(doc_id)
+    
+    def update_bm25_index(self, vector_store: FAISS, output_path: str = "obsidian_index"):
+        """Allinea l'indice BM25 persistito al docstore FAISS (tokenizza solo i chunk nuovi)"""
+        doc_keys = [vector_store.index_to_docstore_id[i] for i in range(vector_store.index.ntotal)]
+        docstore = vector_store.docstore
+        return load_or_sync(output_path, doc_keys, lambda i: docstore.search(doc_keys[i]).page_content)
 
 
 def main():
     """Script principale"""
+    parser = argparse.ArgumentParser(description="Indicizzazione del vault Obsidian")
+    parser.add_argument("--full", action="store_true",
+                        help="Ricostruisce l'indice da zero invece dell'aggiornamento incrementale")
+    parser.add_argument("--compact", action="store_true",
+                        help="Compatta l'indice esistente (duplicati e note rimosse) senza reindicizzare")
+    parser.add_argument("--output", default="obsidian_index", help="Directory dell'indice")
+    args = parser.parse_args()
+    
     print("=== Obsidian RAG Ingest ===")
     
     ingest = ObsidianIngest()
-    ingest.create_index()
+    if args.compact:
+        ingest.compact_index(args.output)
+    elif args.full:
+        ingest.create_index(args.output)
+    else:
+        ingest.update_index(args.output)
 
 
 if __name__ == "__main__":
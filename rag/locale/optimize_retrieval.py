@@ -2,12 +2,54 @@
 
 """
 Script per ottimizzare i parametri di retrieval per Gemma 3-4B
+
+I candidati semantic + BM25 vengono calcolati una sola volta per query;
+ogni combinazione di alpha e pesi di boost rifà solo fusion e ordinamento
+in NumPy, quindi si possono provare centinaia di configurazioni.
 """
 
-import os
+import argparse
+import json
+from itertools import product
+
+import numpy as np
+
 from hybrid_retriever import HybridRetriever
+from retrieval_evaluation import RetrievalEvaluator
+from evaluation_dataset import EVALUATION_DATASET
+from core.boosting import MetadataBooster
 from config import settings
 
+# Griglia di default per lo sweep
+ALPHA_GRID = [round(alpha, 2) for alpha in np.arange(0.0, 1.0001, 0.05)]
+BOOST_GRID = {
+    "boost_cliente": [0.4, 0.8, 1.2],
+    "boost_file": [0.5, 0.9, 1.3],
+    "boost_corpus_cliente": [2.0, 3.5, 5.0],
+}
+BASELINE_ALPHA = 0.8  # Default di HybridRetriever.search
+
+
+def _prepare_candidates(retriever, queries, k, fusion=None):
+    """Candidati e componenti normalizzate semantic/BM25, indipendenti da alpha e boost"""
+    prepared = []
+    for analysis, candidates in retriever.collect_candidates(queries, k=k):
+        semantic_norm, bm25_norm = retriever._fusion_scores(candidates, fusion)
+        prepared.append({
+            "analysis": analysis,
+            "ids": candidates["ids"],
+            "semantic": semantic_norm,
+            "bm25": bm25_norm
+        })
+    return prepared
+
+
+def _rank(candidate, alpha, boost, k):
+    """Posizioni dei migliori k candidati per alpha e boost dati"""
+    final_scores = (alpha * candidate["semantic"] + (1 - alpha) * candidate["bm25"]) * boost
+    return np.argsort(-final_scores, kind='stable')[:k]
+
+
 def test_retrieval_parameters():
     """Testa diversi parametri per ottimizzare il retrieval"""
     
@@ -37,17 +79,25 @@ def test_retrieval_parameters():
     print("🔍 OTTIMIZZAZIONE PARAMETRI RETRIEVAL")
     print("="*60)
     
+    # Candidati calcolati una volta per k (il pool di search dipende da k) e riusati per ogni alpha
+    queries = [tc["query"] for tc in test_cases]
+    prepared_by_k = {k: _prepare_candidates(retriever, queries, k=k) for k in k_values}
+    boosts_by_k = {
+        k: [retriever.booster.boost_factors(c["ids"], c["analysis"]) for c in prepared]
+        for k, prepared in prepared_by_k.items()
+    }
+    
     for alpha in alpha_values:
         for k in k_values:
             print(f"\nTest: α={alpha}, k={k}")
             
             total_accuracy = 0
-            for test_case in test_cases:
+            for test_case, candidate, boost in zip(test_cases, prepared_by_k[k], boosts_by_k[k]):
                 query = test_case["query"]
                 expected_client = test_case["expected_client"]
                 expected_files = test_case["expected_files"]
                 
-                docs = retriever.search(query, k=k, alpha=alpha)
+                docs = [retriever.documents[candidate["ids"][i]] for i in _rank(candidate, alpha, boost, k)]
                 
                 # Verifica se il primo documento è quello giusto
                 if docs:
@@ -83,5 +133,119 @@ def test_retrieval_parameters():
     
     return best_config
 
+
+def sweep_fusion_parameters(alpha_values=None, boost_grid=None, k_values=[1, 3, 5, 10],
+                            fusion=None, output_file="alpha_optimization_results.json"):
+    """
+    Sweep di alpha e pesi di boost sul dataset di valutazione
+    
+    Args:
+        alpha_values: Valori di alpha da provare (default ALPHA_GRID)
+        boost_grid: Dizionario peso -> valori da provare (default BOOST_GRID)
+        k_values: k per Precision/Recall@k
+        fusion: 'weighted' o 'rrf'; default da settings.hybrid_fusion
+        output_file: File JSON dei risultati
+    
+    Returns:
+        dict: Risultati ordinati per MRR e MAP, con configurazione migliore
+    """
+    alpha_values = alpha_values or ALPHA_GRID
+    boost_grid = boost_grid if boost_grid is not None else BOOST_GRID
+    max_k = max(k_values)
+    
+    evaluator = RetrievalEvaluator()
+    retriever = evaluator.hybrid_retriever
+    dataset = EVALUATION_DATASET
+    
+    # 1. Candidati e file path calcolati una sola volta per query
+    print(f"🔍 Calcolo candidati per {len(dataset)} query...")
+    prepared = _prepare_candidates(retriever, [item["query"] for item in dataset], k=max_k, fusion=fusion)
+    for candidate in prepared:
+        candidate["paths"] = np.array(
+            [evaluator.extract_file_path(retriever.documents[i]) for i in candidate["ids"]], dtype=object
+        )
+    
+    def evaluate(alpha, boosts):
+        query_results = [
+            evaluator.evaluate_single_query(
+                query_data, k_values,
+                retrieved_files=candidate["paths"][_rank(candidate, alpha, boost, max_k)].tolist()
+            )
+            for query_data, candidate, boost in zip(dataset, prepared, boosts)
+        ]
+        return evaluator.summarize_results(query_results, k_values)
+    
+    # 2. Re-fusion per ogni combinazione di pesi e alpha
+    weight_names = list(boost_grid)
+    weight_combinations = list(product(*(boost_grid[name] for name in weight_names)))
+    print(f"🔄 Valutazione di {len(weight_combinations) * len(alpha_values)} configurazioni...")
+    
+    optimization_results = []
+    for values in weight_combinations:
+        weights = dict(zip(weight_names, values))
+        booster = MetadataBooster(retriever.metadata_index, weights)
+        boosts = [booster.boost_factors(c["ids"], c["analysis"]) for c in prepared]
+        for alpha in alpha_values:
+            summary = evaluate(alpha, boosts)
+            optimization_results.append({
+                "alpha": alpha,
+                "boost_weights": weights,
+                **summary
+            })
+    
+    optimization_results.sort(key=lambda r: (r["mean_reciprocal_rank"], r["mean_average_precision"]), reverse=True)
+    
+    # Baseline: alpha di default e pesi correnti di config.settings
+    baseline_boosts = [retriever.booster.boost_factors(c["ids"], c["analysis"]) for c in prepared]
+    baseline = evaluate(BASELINE_ALPHA, baseline_boosts)
+    
+    best = optimization_results[0]
+    improvement = best["mean_reciprocal_rank"] - baseline["mean_reciprocal_rank"]
+    if improvement > 0.05:
+        recommendation = (f"✅ RACCOMANDAZIONE: Usare alpha={best['alpha']} con pesi {best['boost_weights']}. "
+                          f"Miglioramento MRR: +{improvement:.3f}")
+    else:
+        recommendation = (f"➡️ RACCOMANDAZIONE: Mantenere alpha corrente ({BASELINE_ALPHA}). "
+                          f"Differenza massima: {improvement:.3f}")
+    
+    # Dettagli per query solo per la configurazione migliore
+    for result in optimization_results[1:]:
+        del result["detailed_results"]
+    
+    results = {
+        "optimization_results": optimization_results,
+        "best_alpha": best["alpha"],
+        "best_boost_weights": best["boost_weights"],
+        "best_mrr": best["mean_reciprocal_rank"],
+        "baseline_mrr": baseline["mean_reciprocal_rank"],
+        "improvement_over_baseline": improvement,
+        "recommendation": recommendation
+    }
+    
+    print(f"\n🏆 MIGLIORI CONFIGURAZIONI:")
+    for i, result in enumerate(optimization_results[:5]):
+        print(f"   {i+1}. α={result['alpha']} {result['boost_weights']} -> "
+              f"MRR={result['mean_reciprocal_rank']:.3f}, MAP={result['mean_average_precision']:.3f}, "
+              f"P@{k_values[0]}={result['mean_precision_at_k'][k_values[0]]:.3f}")
+    print(f"   Baseline (α={BASELINE_ALPHA}): MRR={baseline['mean_reciprocal_rank']:.3f}")
+    print(recommendation)
+    
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"💾 Risultati salvati in {output_file}")
+    
+    return results
+
+
 if __name__ == "__main__":
-    test_retrieval_parameters()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Ottimizzazione parametri di retrieval")
+    parser.add_argument("--sweep", action="store_true",
+                        help="Sweep di alpha e pesi di boost sul dataset di valutazione")
+    parser.add_argument("--fusion", choices=["weighted", "rrf"], default=None,
+                        help=f"Metodo di fusion (default: {settings.hybrid_fusion})")
+    args = parser.parse_args()
+    
+    if args.sweep:
+        sweep_fusion_parameters(fusion=args.fusion)
+    else:
+        test_retrieval_parameters()
@@ -14,6 +14,7 @@ from typing import List, Dict, Optional
 sys.path.insert(0, str(Path(__file__).parent))
 
 from core.vector_store import VectorStoreFactory
+from core.client_manager import ClientMetadataManager, ClientShardRouter
 from config import settings
 from utils.logger import StructuredLogger
 
@@ -23,10 +24,19 @@ logger = StructuredLogger(__name__)
 class ClientQuerySystem:
     """Sistema di query con filtering per cliente"""
     
-    def __init__(self, faiss_index_path: Path = None):
+    def __init__(self, faiss_index_path: Path = None, use_shards: bool = None):
         self.faiss_index_path = faiss_index_path or settings.faiss_index_path
         self.vector_store = None
-        self._load_vector_store()
+        self.router = None
+        
+        use_shards = settings.client_shards_enabled if use_shards is None else use_shards
+        if use_shards and ClientShardRouter.is_available():
+            # Indici per cliente: l'indice globale non viene caricato
+            self.router = ClientShardRouter()
+        else:
+            if use_shards:
+                logger.warning(f"Shard non disponibili in {settings.client_shards_path}, uso indice globale")
+            self._load_vector_store()
     
     def _load_vector_store(self):
         """Carica il vector store"""
@@ -53,66 +63,56 @@ class ClientQuerySystem:
             file_type_filter: Tipo file (pdf, docx, etc.)
             folder_filter: Sottocartella per filtrare
         """
-        if not self.vector_store:
+        if not self.vector_store and not self.router:
             raise RuntimeError("Vector store non caricato")
         
-        # Esegui ricerca base
-        results = self.vector_store.similarity_search(query, k=k*3)  # Prendi più risultati per filtering
+        # Filtri risolti sull'indice dei metadata: la ricerca avviene solo sui chunk ammessi
+        metadata_filter = {}
+        if file_type_filter:
+            metadata_filter['file_type'] = file_type_filter
+        contains_filter = {'subfolder': folder_filter} if folder_filter else None
         
-        # Applica filtri
-        filtered_results = []
-        
-        for result in results:
-            metadata = result.metadata
-            
-            # Filtro per cliente
-            if client_filter and metadata.get('client_name') != client_filter:
-                continue
-            
-            # Filtro per tipo file
-            if file_type_filter and metadata.get('file_type') != file_type_filter:
-                continue
-            
-            # Filtro per sottocartella
-            if folder_filter and folder_filter not in metadata.get('subfolder', ''):
-                continue
-            
-            filtered_results.append({
-                'content': result.page_content,
-                'metadata': metadata,
-                'score': getattr(result, 'score', 0.0)
-            })
-            
-            if len(filtered_results) >= k:
-                break
+        if self.router:
+            # Il cliente seleziona lo shard; senza cliente ricerca su tutti gli shard in parallelo
+            results = self.router.search(
+                query, k=k, client_filter=client_filter,
+                metadata_filter=metadata_filter, contains_filter=contains_filter
+            )
+        else:
+            if client_filter:
+                metadata_filter['client_name'] = client_filter
+            results = self.vector_store.similarity_search_with_filter(
+                query, k=k, metadata_filter=metadata_filter, contains_filter=contains_filter
+            )
         
-        return filtered_results
+        return [
+            {
+                'content': doc.page_content,
+                'metadata': doc.metadata,
+                'score': score
+            }
+            for doc, score in results
+        ]
     
     def get_available_clients(self) -> List[str]:
         """Ottiene lista clienti disponibili nell'indice"""
+        if self.router:
+            return self.router.clients
         if not self.vector_store:
             return []
         
-        # Questo è un po' costoso ma fornisce info utile
-        all_docs = self.vector_store.similarity_search("", k=10000)
-        clients = set()
-        
-        for doc in all_docs:
-            client_name = doc.metadata.get('client_name')
-            if client_name:
-                clients.add(client_name)
-        
-        return sorted(list(clients))
+        return sorted(self.vector_store.metadata_values('client_name'))
     
     def get_client_stats(self, client_name: str) -> Dict:
         """Ottiene statistiche per un cliente specifico"""
-        if not self.vector_store:
+        if self.router:
+            client_docs = self.router.get_documents(client_name)
+        elif self.vector_store:
+            # Chunk del cliente dall'indice dei metadata
+            client_docs = self.vector_store.get_documents({'client_name': client_name})
+        else:
             return {}
         
-        # Cerca tutti i documenti del cliente
-        all_docs = self.vector_store.similarity_search("", k=10000)
-        client_docs = [doc for doc in all_docs if doc.metadata.get('client_name') == client_name]
-        
         if not client_docs:
             return {}
         
@@ -134,6 +134,14 @@ class ClientQuerySystem:
             'folders': folders,
             'unique_sources': len(set(doc.metadata.get('source', '') for doc in client_docs))
         }
+    
+    def build_shards(self) -> Dict[str, int]:
+        """Crea gli indici per cliente dall'indice globale"""
+        if not self.vector_store or self.vector_store.vector_store is None:
+            raise RuntimeError("Indice globale non caricato")
+        
+        client_manager = ClientMetadataManager(settings.documents_path)
+        return client_manager.build_shards(self.vector_store, settings.client_shards_path, self.faiss_index_path)
 
 
 def main():
@@ -146,16 +154,33 @@ def main():
     parser.add_argument('--list-clients', action='store_true', help='Mostra clienti disponibili')
     parser.add_argument('--client-stats', help='Mostra statistiche per cliente')
     parser.add_argument('--interactive', '-i', action='store_true', help='Modalità interattiva')
+    parser.add_argument('--build-shards', action='store_true',
+                        help='Crea un indice per cliente (più uno globale) dall\'indice FAISS')
+    parser.add_argument('--shards', action='store_true', help='Usa gli indici per cliente')
     
     args = parser.parse_args()
     
     # Inizializza sistema
     try:
-        query_system = ClientQuerySystem()
+        use_shards = False if args.build_shards else (args.shards or None)
+        query_system = ClientQuerySystem(use_shards=use_shards)
     except Exception as e:
         print(f"❌ Errore inizializzazione: {e}")
         return 1
     
+    # Creazione shard per cliente
+    if args.build_shards:
+        print(f"🧩 Creazione shard per cliente in {settings.client_shards_path}...")
+        try:
+            shards = query_system.build_shards()
+        except Exception as e:
+            print(f"❌ Errore creazione shard: {e}")
+            return 1
+        for name, chunks in sorted(shards.items()):
+            print(f"  - {name}: {chunks} chunks")
+        print(f"✅ Creati {len(shards)} shard")
+        return 0
+    
     # Lista clienti
     if args.list_clients:
         print("👥 Clienti disponibili:")
@@ -5,31 +5,99 @@ Usa un Cross-Encoder per riordinare i documenti recuperati dal hybrid search.
 """
 
 import numpy as np
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from sentence_transformers import CrossEncoder
 from langchain.schema import Document
 import time
+import hashlib
+from config import settings
+from utils.cache import RerankScoreCache, get_rerank_cache
 from utils.logger import StructuredLogger
 
 logger = StructuredLogger(__name__)
 
+def chunk_id(doc: Document) -> str:
+    """Identificativo del chunk per la cache degli score (id del docstore o hash del contenuto)"""
+    doc_id = getattr(doc, 'id', None)
+    if doc_id:
+        return str(doc_id)
+    key = f"{doc.metadata.get('source', '')}\0{doc.page_content}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+
 class CrossEncoderReranker:
     """
     Reranker basato su Cross-Encoder per riordinare documenti
     in base alla rilevanza rispetto alla query.
+    
+    Gli score delle coppie (query, chunk) già valutate vengono presi dalla
+    cache LRU condivisa; solo le coppie nuove passano dal modello. Con top_n
+    vengono riordinati solo i primi N candidati della fusion, gli altri
+    restano in coda nell'ordine originale.
     """
     
-    def __init__(self, model_name: str = 'cross-encoder/ms-marco-MiniLM-L-6-v2'):
+    def __init__(self, model_name: str = None, batch_size: int = None, max_length: int = None,
+                 top_n: int = None, cache: RerankScoreCache = None, backend: str = None):
         """
         Inizializza il reranker con un modello cross-encoder.
         
         Args:
-            model_name: Nome del modello HuggingFace da usare
+            model_name: Nome del modello HuggingFace da usare (default da config)
+            batch_size: Coppie per batch di predict (default da config)
+            max_length: Token massimi per coppia, oltre i quali il testo viene troncato
+            top_n: Candidati da riordinare (0 = tutti)
+            cache: Cache degli score (default singleton condiviso)
+            backend: "torch" (sentence-transformers) o "onnx" (int8 quantizzato); default da config
+        """
+        self.model_name = model_name or settings.reranker_model_name
+        self.batch_size = batch_size or settings.reranker_batch_size
+        self.max_length = max_length or settings.reranker_max_length
+        self.top_n = settings.reranker_top_n if top_n is None else top_n
+        self.cache = cache or get_rerank_cache()
+        self.backend = backend or settings.reranker_backend
+        self.cache_namespace = f"{self.model_name}:{self.backend}:{self.max_length}"
+        self.last_timing: Dict[str, float] = {}
+        
+        logger.info(f"Inizializzazione Cross-Encoder reranker con modello: {self.model_name} ({self.backend})")
+        if self.backend == "onnx":
+            from core.onnx_models import OnnxCrossEncoder
+            self.model = OnnxCrossEncoder(self.model_name, max_length=self.max_length)
+        else:
+            self.model = CrossEncoder(self.model_name, max_length=self.max_length)
+        
+    def score(self, query: str, documents: List[Document]) -> np.ndarray:
         """
-        logger.info(f"Inizializzazione Cross-Encoder reranker con modello: {model_name}")
-        self.model = CrossEncoder(model_name)
-        self.model_name = model_name
+        Score di rilevanza di ogni documento, usando la cache per le coppie già valutate.
         
+        Args:
+            query: Query di ricerca
+            documents: Documenti da valutare
+            
+        Returns:
+            Array degli score, allineato a documents
+        """
+        ids = [chunk_id(doc) for doc in documents]
+        cached = self.cache.get_many(self.cache_namespace, query, ids)
+        scores = np.array([np.nan if value is None else value for value in cached], dtype=np.float32)
+        
+        missing = np.flatnonzero(np.isnan(scores))
+        predict_time = 0.0
+        if len(missing):
+            pairs = [(query, documents[i].page_content) for i in missing]
+            start_time = time.time()
+            predicted = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+            predict_time = time.time() - start_time
+            scores[missing] = predicted
+            self.cache.set_many(self.cache_namespace, query, [ids[i] for i in missing], predicted)
+        
+        self.last_timing.update({
+            'candidates': len(documents),
+            'cache_hits': len(documents) - len(missing),
+            'pairs_scored': len(missing),
+            'predict_seconds': predict_time
+        })
+        return scores
+    
     def rerank(self, query: str, documents: List[Document], top_k: int = 5) -> List[Document]:
         """
         Riordina i documenti in base alla rilevanza rispetto alla query.
@@ -42,42 +110,21 @@ class CrossEncoderReranker:
         Returns:
             Lista dei top_k documenti riordinati
         """
-        if not documents:
-            return []
-            
-        start_time = time.time()
-        
-        # Prepara coppie query-documento
-        pairs = [(query, doc.page_content) for doc in documents]
-        
-        # Calcola scores di rilevanza
-        logger.info(f"Calcolo scores per {len(pairs)} documenti...")
-        scores = self.model.predict(pairs)
-        
-        # Riordina per score decrescente
-        sorted_indices = np.argsort(scores)[::-1]
-        
-        # Prendi solo i top_k
-        top_indices = sorted_indices[:min(top_k, len(documents))]
-        reranked_docs = [documents[i] for i in top_indices]
-        
-        # Log dei risultati
-        elapsed_time = time.time() - start_time
-        logger.info(f"Reranking completato in {elapsed_time:.2f}s")
+        results = self.rerank_with_scores(query, documents, top_k)
         
         # Debug: mostra top scores
-        for i, idx in enumerate(top_indices[:3]):
-            score = scores[idx]
-            doc = documents[idx]
+        for i, (doc, score) in enumerate(results[:3]):
             source = doc.metadata.get('source', 'unknown')
             logger.debug(f"  {i+1}. Score: {score:.3f} - {source}")
         
-        return reranked_docs
+        return [doc for doc, _ in results]
     
     def rerank_with_scores(self, query: str, documents: List[Document], top_k: int = 5) -> List[Tuple[Document, float]]:
         """
         Riordina i documenti restituendo anche gli scores.
         
+        I documenti oltre top_n (non riordinati) seguono i riordinati con score -inf.
+        
         Args:
             query: Query di ricerca
             documents: Lista di documenti da riordinare
@@ -89,18 +136,24 @@ class CrossEncoderReranker:
         if not documents:
             return []
             
-        # Prepara coppie query-documento
-        pairs = [(query, doc.page_content) for doc in documents]
+        start_time = time.time()
         
-        # Calcola scores
-        scores = self.model.predict(pairs)
+        # Early exit: solo i primi top_n candidati della fusion passano dal modello
+        n_rerank = min(self.top_n, len(documents)) if self.top_n else len(documents)
+        scores = self.score(query, documents[:n_rerank])
         
         # Riordina per score decrescente
-        sorted_indices = np.argsort(scores)[::-1]
+        sorted_indices = np.argsort(-scores, kind='stable')
+        results = [(documents[i], float(scores[i])) for i in sorted_indices[:top_k]]
+        if len(results) < top_k:
+            results += [(doc, float('-inf')) for doc in documents[n_rerank:n_rerank + top_k - len(results)]]
         
-        # Prendi solo i top_k con scores
-        top_indices = sorted_indices[:min(top_k, len(documents))]
-        results = [(documents[i], scores[i]) for i in top_indices]
+        # Timing della chiamata
+        self.last_timing['total_seconds'] = time.time() - start_time
+        logger.info(
+            f"Reranking completato in {self.last_timing['total_seconds']:.2f}s "
+            f"({self.last_timing['pairs_scored']} coppie valutate, {self.last_timing['cache_hits']} dalla cache)"
+        )
         
         return results
 
@@ -109,14 +162,77 @@ class LightweightReranker:
     """
     Reranker leggero basato su similarità semantica migliorata.
     Alternativa più veloce al Cross-Encoder per sistemi con vincoli di risorse.
+    
+    Gli embedding dei chunk già presenti nell'indice FAISS vengono ricostruiti
+    dall'index invece di essere ricalcolati; i restanti vengono codificati con
+    un'unica chiamata embed_documents e tutti gli scores si ottengono con un
+    solo prodotto matrice-vettore.
     """
     
-    def __init__(self):
-        """Inizializza il reranker leggero."""
-        from langchain_huggingface import HuggingFaceEmbeddings
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-        )
+    def __init__(self, embeddings=None, vector_store=None, backend: str = None):
+        """
+        Inizializza il reranker leggero.
+        
+        Args:
+            embeddings: Embeddings da usare (default CachedEmbeddings del modello in config);
+                        deve essere lo stesso modello dell'indice per riusarne i vettori
+            vector_store: Vector store LangChain FAISS opzionale da cui riusare gli embedding dei chunk
+                          (HybridRetriever.create_reranker passa quello già caricato)
+            backend: Backend delle CachedEmbeddings di default ("torch" o "onnx")
+        """
+        if embeddings is None:
+            from core.embeddings import CachedEmbeddings
+            embeddings = CachedEmbeddings(backend=backend)
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self._positions = None  # (source, testo) -> posizione FAISS, costruita al primo uso
+        
+    def _position_map(self) -> Dict[Tuple[str, str], int]:
+        """Posizioni FAISS dei chunk indicizzati, per source e testo"""
+        if self._positions is None:
+            docstore = self.vector_store.docstore
+            self._positions = {}
+            for position, doc_id in self.vector_store.index_to_docstore_id.items():
+                doc = docstore.search(doc_id)
+                if isinstance(doc, Document):
+                    self._positions[(doc.metadata.get('source', ''), doc.page_content)] = position
+        return self._positions
+    
+    def _query_vector(self, query: str) -> np.ndarray:
+        if hasattr(self.embeddings, 'embed_query_array'):
+            return np.asarray(self.embeddings.embed_query_array(query), dtype=np.float32)
+        return np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+    
+    def _document_vectors(self, documents: List[Document]) -> np.ndarray:
+        """Matrice degli embedding dei documenti (una riga per documento)"""
+        vectors = [None] * len(documents)
+        
+        # 1. Vettori già presenti nell'indice FAISS
+        if self.vector_store is not None:
+            positions = self._position_map()
+            found = [(i, positions.get((doc.metadata.get('source', ''), doc.page_content)))
+                     for i, doc in enumerate(documents)]
+            found = [(i, position) for i, position in found if position is not None]
+            if found:
+                try:
+                    stored = self.vector_store.index.reconstruct_batch(
+                        np.array([position for _, position in found], dtype=np.int64)
+                    )
+                    for (i, _), vector in zip(found, stored):
+                        vectors[i] = vector
+                except RuntimeError as e:
+                    # Index senza reconstruct (es. IVF senza mappa diretta): si ricalcola
+                    logger.debug(f"Embedding dall'indice non disponibili: {e}")
+        
+        # 2. Tutti gli altri in un'unica chiamata al modello
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Testo completo, come i vettori dell'indice: gli scores dei due percorsi restano confrontabili
+            computed = self.embeddings.embed_documents([documents[i].page_content for i in missing])
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        
+        return np.asarray(vectors, dtype=np.float32)
         
     def rerank(self, query: str, documents: List[Document], top_k: int = 5) -> List[Document]:
         """
@@ -130,59 +246,61 @@ class LightweightReranker:
         Returns:
             Lista dei top_k documenti riordinati
         """
+        return [doc for doc, _ in self.rerank_with_scores(query, documents, top_k)]
+    
+    def rerank_with_scores(self, query: str, documents: List[Document], top_k: int = 5) -> List[Tuple[Document, float]]:
+        """
+        Riordina i documenti restituendo anche gli scores.
+        
+        Args:
+            query: Query di ricerca
+            documents: Lista di documenti da riordinare
+            top_k: Numero di documenti top da restituire
+            
+        Returns:
+            Lista di tuple (documento, score)
+        """
         if not documents:
             return []
             
-        # Calcola embedding della query
-        query_embedding = self.embeddings.embed_query(query)
-        
-        # Calcola scores per ogni documento
-        doc_scores = []
-        for doc in documents:
-            # Embedding del documento
-            doc_embedding = self.embeddings.embed_query(doc.page_content[:500])
-            
-            # Similarità coseno
-            similarity = np.dot(query_embedding, doc_embedding) / (
-                np.linalg.norm(query_embedding) * np.linalg.norm(doc_embedding)
-            )
-            
-            # Boost basati su metadata
-            boost = 1.0
-            metadata = doc.metadata
-            
-            # Boost per documenti recenti
-            if metadata.get('modified_time'):
-                # Implementa logica per boost temporale
-                pass
-                
-            # Boost per match esatti nel titolo/filename
-            filename = metadata.get('filename', '').lower()
-            if any(term in filename for term in query.lower().split()):
-                boost *= 1.5
-                
-            final_score = similarity * boost
-            doc_scores.append((doc, final_score))
+        query_embedding = self._query_vector(query)
+        doc_embeddings = self._document_vectors(documents)
+        
+        # Similarità coseno di tutti i documenti con un solo prodotto matrice-vettore
+        norms = np.linalg.norm(doc_embeddings, axis=1) * np.linalg.norm(query_embedding)
+        similarities = (doc_embeddings @ query_embedding) / np.maximum(norms, 1e-12)
+        
+        # Boost per match esatti nel titolo/filename
+        query_terms = query.lower().split()
+        boosts = np.array([
+            1.5 if any(term in doc.metadata.get('filename', '').lower() for term in query_terms) else 1.0
+            for doc in documents
+        ], dtype=np.float32)
+        
+        final_scores = similarities * boosts
         
         # Ordina per score e restituisci top_k
-        doc_scores.sort(key=lambda x: x[1], reverse=True)
-        return [doc for doc, _ in doc_scores[:top_k]]
+        top_indices = np.argsort(-final_scores, kind='stable')[:top_k]
+        return [(documents[i], float(final_scores[i])) for i in top_indices]
 
 
-def create_reranker(reranker_type: str = "cross-encoder") -> object:
+def create_reranker(reranker_type: str = "cross-encoder", backend: str = None, **kwargs) -> object:
     """
     Factory function per creare il reranker appropriato.
     
     Args:
         reranker_type: Tipo di reranker ("cross-encoder" o "lightweight")
+        backend: "torch" o "onnx" (int8 quantizzato); default da config.settings
+        **kwargs: Argomenti passati al costruttore (es. embeddings e vector_store
+                  di HybridRetriever per il reranker leggero)
         
     Returns:
         Istanza del reranker
     """
     if reranker_type == "cross-encoder":
-        return CrossEncoderReranker()
+        return CrossEncoderReranker(backend=backend, **kwargs)
     elif reranker_type == "lightweight":
-        return LightweightReranker()
+        return LightweightReranker(backend=backend, **kwargs)
     else:
         raise ValueError(f"Tipo di reranker non supportato: {reranker_type}")
 
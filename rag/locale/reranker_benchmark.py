@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark del backend ONNX int8 rispetto a PyTorch per reranker ed embedding
+
+Sulle query del dataset di valutazione i candidati della ricerca ibrida vengono
+valutati da entrambi i backend del Cross-Encoder (senza cache degli score) e
+confrontati per:
+- latenza media e p95 per query
+- accordo del ranking: top-1 uguale, sovrapposizione dei top-k, correlazione
+  di Spearman degli score
+- MRR e MAP dopo il reranking
+
+Per il modello di embedding vengono riportate latenza di codifica dei candidati
+e similarità coseno tra i vettori dei due backend.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from retrieval_evaluation import RetrievalEvaluator
+from evaluation_dataset import EVALUATION_DATASET
+from reranker import CrossEncoderReranker
+from core.embeddings import CachedEmbeddings
+from utils.cache import EmbeddingCache, RerankScoreCache
+
+K_VALUES = [1, 3, 5, 10]
+BACKENDS = ["torch", "onnx"]
+
+
+def _ranks(scores):
+    return np.argsort(np.argsort(-scores, kind='stable'), kind='stable').astype(np.float64)
+
+
+def spearman(a, b):
+    """Correlazione di Spearman tra due vettori di score"""
+    if len(a) < 2:
+        return 1.0
+    ranks_a, ranks_b = _ranks(a), _ranks(b)
+    return float(np.corrcoef(ranks_a, ranks_b)[0, 1])
+
+
+def latency_stats(latencies):
+    return {
+        "latency_ms_mean": float(np.mean(latencies)),
+        "latency_ms_p95": float(np.percentile(latencies, 95))
+    }
+
+
+def benchmark_rerankers(evaluator, candidates, top_k):
+    """Latenza, accordo del ranking e metriche di retrieval per ogni backend"""
+    queries = [item["query"] for item in EVALUATION_DATASET]
+    scores = {}
+    results = {}
+    
+    for backend in BACKENDS:
+        # Cache vuota e senza capacità: ogni coppia passa dal modello
+        reranker = CrossEncoderReranker(backend=backend, top_n=0, cache=RerankScoreCache(0))
+        reranker.score(queries[0], candidates[0][:1])  # Warm-up (sessione/grafo)
+        
+        latencies = []
+        scores[backend] = []
+        query_results = []
+        for query_data, query, docs in zip(EVALUATION_DATASET, queries, candidates):
+            start = time.perf_counter()
+            query_scores = reranker.score(query, docs)
+            latencies.append((time.perf_counter() - start) * 1000)
+            scores[backend].append(query_scores)
+            
+            order = np.argsort(-query_scores, kind='stable')
+            retrieved = [evaluator.extract_file_path(docs[i]) for i in order]
+            query_results.append(evaluator.evaluate_single_query(query_data, K_VALUES, retrieved_files=retrieved))
+        
+        summary = evaluator.summarize_results(query_results, K_VALUES)
+        results[backend] = {
+            **latency_stats(latencies),
+            "mean_reciprocal_rank": summary["mean_reciprocal_rank"],
+            "mean_average_precision": summary["mean_average_precision"]
+        }
+    
+    # Accordo tra i ranking dei due backend
+    top1_agreement = []
+    topk_overlap = []
+    correlations = []
+    for reference, candidate in zip(scores["torch"], scores["onnx"]):
+        if len(reference) == 0:
+            continue
+        reference_top = np.argsort(-reference, kind='stable')[:top_k]
+        candidate_top = np.argsort(-candidate, kind='stable')[:top_k]
+        top1_agreement.append(reference_top[0] == candidate_top[0])
+        topk_overlap.append(len(np.intersect1d(reference_top, candidate_top)) / len(reference_top))
+        correlations.append(spearman(reference, candidate))
+    
+    results["agreement"] = {
+        "top1_agreement": float(np.mean(top1_agreement)),
+        f"top{top_k}_overlap": float(np.mean(topk_overlap)),
+        "spearman_mean": float(np.mean(correlations))
+    }
+    results["speedup"] = results["torch"]["latency_ms_mean"] / results["onnx"]["latency_ms_mean"]
+    return results
+
+
+def benchmark_embeddings(candidates):
+    """Latenza di codifica dei candidati e similarità coseno tra i backend"""
+    texts = [[doc.page_content for doc in docs] for docs in candidates]
+    vectors = {}
+    results = {}
+    
+    for backend in BACKENDS:
+        embeddings = CachedEmbeddings(backend=backend, cache=EmbeddingCache(0))
+        embeddings.embed_documents(texts[0][:1])  # Warm-up
+        
+        latencies = []
+        vectors[backend] = []
+        for query_texts in texts:
+            start = time.perf_counter()
+            vectors[backend].append(np.asarray(embeddings.embed_documents(query_texts), dtype=np.float32))
+            latencies.append((time.perf_counter() - start) * 1000)
+        results[backend] = latency_stats(latencies)
+    
+    reference = np.vstack(vectors["torch"])
+    candidate = np.vstack(vectors["onnx"])
+    cosine = (reference * candidate).sum(axis=1) / np.maximum(
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1), 1e-12
+    )
+    results["cosine_mean"] = float(cosine.mean())
+    results["cosine_min"] = float(cosine.min())
+    results["speedup"] = results["torch"]["latency_ms_mean"] / results["onnx"]["latency_ms_mean"]
+    return results
+
+
+def run_benchmark(n_candidates=20, top_k=5, include_embeddings=True, output_file="reranker_benchmark_results.json"):
+    """
+    Confronta i backend PyTorch e ONNX int8 sul dataset di valutazione
+    
+    Args:
+        n_candidates: Candidati della ricerca ibrida da riordinare per query
+        top_k: k per la sovrapposizione dei top-k
+        include_embeddings: Confronta anche il modello di embedding
+        output_file: File JSON dei risultati
+    
+    Returns:
+        dict: Risultati per backend e accordo dei ranking
+    """
+    evaluator = RetrievalEvaluator()
+    candidates = evaluator.hybrid_retriever.search_batch(
+        [item["query"] for item in EVALUATION_DATASET], k=n_candidates
+    )
+    print(f"🔍 {len(candidates)} query, fino a {n_candidates} candidati ciascuna")
+    
+    output = {
+        "n_candidates": n_candidates,
+        "top_k": top_k,
+        "reranker": benchmark_rerankers(evaluator, candidates, top_k)
+    }
+    
+    reranker_results = output["reranker"]
+    print("\n🏁 CROSS-ENCODER")
+    for backend in BACKENDS:
+        result = reranker_results[backend]
+        print(f"   {backend:<6} lat={result['latency_ms_mean']:.1f}ms p95={result['latency_ms_p95']:.1f}ms "
+              f"MRR={result['mean_reciprocal_rank']:.3f} MAP={result['mean_average_precision']:.3f}")
+    agreement = reranker_results["agreement"]
+    print(f"   Speedup ONNX: {reranker_results['speedup']:.2f}x | top-1 uguale: {agreement['top1_agreement']:.1%} | "
+          f"top-{top_k} sovrapposti: {agreement[f'top{top_k}_overlap']:.1%} | "
+          f"Spearman: {agreement['spearman_mean']:.3f}")
+    
+    if include_embeddings:
+        output["embeddings"] = benchmark_embeddings(candidates)
+        embedding_results = output["embeddings"]
+        print("\n🏁 EMBEDDING")
+        for backend in BACKENDS:
+            result = embedding_results[backend]
+            print(f"   {backend:<6} lat={result['latency_ms_mean']:.1f}ms p95={result['latency_ms_p95']:.1f}ms")
+        print(f"   Speedup ONNX: {embedding_results['speedup']:.2f}x | coseno medio: "
+              f"{embedding_results['cosine_mean']:.4f} (min {embedding_results['cosine_min']:.4f})")
+    
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(output, f, indent=2, ensure_ascii=False)
+    print(f"💾 Risultati salvati in {output_file}")
+    
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark backend PyTorch vs ONNX int8 per reranker ed embedding")
+    parser.add_argument("--candidates", type=int, default=20, help="Candidati da riordinare per query")
+    parser.add_argument("--top-k", type=int, default=5, help="k per la sovrapposizione dei top-k")
+    parser.add_argument("--skip-embeddings", action="store_true", help="Confronta solo il cross-encoder")
+    args = parser.parse_args()
+    
+    run_benchmark(n_candidates=args.candidates, top_k=args.top_k, include_embeddings=not args.skip_embeddings)
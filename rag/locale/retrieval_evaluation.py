@@ -30,6 +30,11 @@ class RetrievalEvaluator:
         docs = self.hybrid_retriever.search(query, k=k)
         return [self.extract_file_path(doc) for doc in docs]
     
+    def retrieve_documents_batch(self, queries: List[str], k: int = 10) -> List[List[str]]:
+        """Recupera documenti per più query con una sola ricerca batch"""
+        batch_docs = self.hybrid_retriever.search_batch(queries, k=k)
+        return [[self.extract_file_path(doc) for doc in docs] for docs in batch_docs]
+    
     def calculate_precision_at_k(self, retrieved: List[str], relevant: List[str], k: int) -> float:
         """Calcola Precision@k"""
         if k == 0:
@@ -71,13 +76,15 @@ class RetrievalEvaluator:
         
         return score / len(relevant)
     
-    def evaluate_single_query(self, query_data: Dict, k_values: List[int] = [1, 3, 5, 10]) -> Dict[str, Any]:
-        """Valuta una singola query"""
+    def evaluate_single_query(self, query_data: Dict, k_values: List[int] = [1, 3, 5, 10],
+                              retrieved_files: List[str] = None) -> Dict[str, Any]:
+        """Valuta una singola query (retrieved_files se già recuperati in batch)"""
         query = query_data["query"]
         expected_files = query_data["expected_files"]
         
         # Recupera documenti
-        retrieved_files = self.retrieve_documents(query, k=max(k_values))
+        if retrieved_files is None:
+            retrieved_files = self.retrieve_documents(query, k=max(k_values))
         
         # Calcola metriche
         results = {
@@ -104,20 +111,27 @@ class RetrievalEvaluator:
         
         print(f"🔍 Valutazione su {len(dataset)} query...")
         
+        # Retrieval di tutte le query in un'unica ricerca batch
+        all_retrieved = self.retrieve_documents_batch([item["query"] for item in dataset], k=max(k_values))
+        
         all_results = []
+        for i, query_data in enumerate(dataset):
+            print(f"  Query {i+1}/{len(dataset)}: {query_data['query'][:50]}...")
+            
+            result = self.evaluate_single_query(query_data, k_values, retrieved_files=all_retrieved[i])
+            all_results.append(result)
         
+        return self.summarize_results(all_results, k_values)
+    
+    def summarize_results(self, all_results: List[Dict], k_values: List[int] = [1, 3, 5, 10]) -> Dict[str, Any]:
+        """Calcola le metriche medie a partire dai risultati delle singole query"""
         # Accumula metriche
         total_rr = 0.0
         total_ap = 0.0
         total_precision_at_k = {k: 0.0 for k in k_values}
         total_recall_at_k = {k: 0.0 for k in k_values}
         
-        for i, query_data in enumerate(dataset):
-            print(f"  Query {i+1}/{len(dataset)}: {query_data['query'][:50]}...")
-            
-            result = self.evaluate_single_query(query_data, k_values)
-            all_results.append(result)
-            
+        for result in all_results:
             # Accumula per medie
             total_rr += result["reciprocal_rank"]
             total_ap += result["average_precision"]
@@ -127,7 +141,7 @@ class RetrievalEvaluator:
                 total_recall_at_k[k] += result["recall_at_k"][k]
         
         # Calcola medie
-        n_queries = len(dataset)
+        n_queries = len(all_results)
         summary = {
             "total_queries": n_queries,
             "mean_reciprocal_rank": total_rr / n_queries,
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 import os
 import sys
-from langchain_community.vectorstores import FAISS
+from core.vector_store import load_faiss_index
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from llm_adapter import LLMAdapter
 from config import settings
 from hybrid_retriever import HybridRetriever
+from core.context_budget import TokenCounter, ContextBudgeter
 
 # Classe per gestire output colorato nel terminale
 class ColoredOutput:
@@ -151,6 +152,8 @@ class SimpleRAG:
         self.vector_store = None
         self.hybrid_retriever = HybridRetriever(faiss_index_path="obsidian_index")
         self.llm = None
+        self.token_counter = TokenCounter()  # Stima finché setup_llm non collega il tokenizer del modello
+        self.context_budgeter = None
         self.current_model = "llamafile"  # Default model
         self.token_count = {"prompt": 0, "completion": 0, "total": 0}
         
@@ -159,11 +162,7 @@ class SimpleRAG:
         if not os.path.exists(index_path):
             raise FileNotFoundError(f"Indice FAISS non trovato in {index_path}")
             
-        self.vector_store = FAISS.load_local(
-            index_path, 
-            self.embeddings, 
-            allow_dangerous_deserialization=True
-        )
+        self.vector_store = load_faiss_index(index_path, self.embeddings)
         ColoredOutput.print_success(f"Indice FAISS caricato da {index_path}")
         
         # Carica anche il hybrid retriever
@@ -177,118 +176,68 @@ class SimpleRAG:
             ColoredOutput.print_success(f"Modello locale inizializzato: {self.llm.llm_type}")
         else:
             raise RuntimeError("Modello locale non disponibile")
+        
+        # Conteggio con il tokenizer del modello (la modalità CLI non lo espone: stima)
+        self.token_counter = TokenCounter(self.llm.count_tokens if self.llm.has_tokenizer else None)
+        self.context_budgeter = ContextBudgeter(
+            self.token_counter,
+            self.llm.context_window,
+            answer_tokens=max(settings.answer_reserve_tokens, self.llm.max_answer_tokens)
+        )
+        if self.context_budgeter.answer_tokens * 2 > self.context_budgeter.n_ctx:
+            ColoredOutput.print_info(
+                f"La risposta riserva {self.context_budgeter.answer_tokens} token su {self.context_budgeter.n_ctx}: "
+                f"poco spazio per il contesto (ridurre llamafile_max_tokens o aumentare llamafile_ctx_size)"
+            )
     
     def estimate_tokens(self, text):
-        """Stima approssimativa dei token (1 token ≈ 4 caratteri)"""
-        # Per Mistral, questa è una stima rozza
-        # In produzione, usare il tokenizer ufficiale
-        return len(text) // 4
+        """Token del testo: esatti con il tokenizer del modello, altrimenti stima (1 token ≈ 4 caratteri)"""
+        return self.token_counter.count(text)
+    
+    def _prompt_cache_report(self, prompt_prefix):
+        """Token del prompt valutati e riusati dalla KV cache del server nell'ultima chiamata"""
+        usage = self.llm.last_usage
+        if not usage:
+            return None  # Modalità senza cache del prompt (CLI, LlamaCpp)
+        return {
+            "evaluated": usage["prompt_tokens_evaluated"],
+            "reused": usage["prompt_tokens_cached"],
+            "prompt_ms": usage["prompt_ms"],
+            "prefix_chars": len(prompt_prefix)
+        }
     
     def query(self, question, k=3):
         """Esegue una query RAG con k dinamico basato sul tipo di query"""
         if not self.vector_store or not self.llm:
             raise RuntimeError("Inizializza prima load_index() e setup_llm()")
             
-        # Rileva se la query riguarda attività/lista di un giorno specifico
-        import re
-        from datetime import datetime, timedelta
-        
-        is_journal_list_query = False
-        target_journal_date = None
-        query_lower = question.lower()
-        
-        # Pattern per query "quali clienti hanno file X"
-        file_search_patterns = [
-            r'quali clienti.*\b(corpus|concorrenti|dati|analisi|interventi)\b',
-            r'per quali.*\b(corpus|concorrenti|dati|analisi|interventi)\b',
-            r'elenco.*clienti.*\b(corpus|concorrenti|dati|analisi|interventi)\b',
-            r'lista.*clienti.*\b(corpus|concorrenti|dati|analisi|interventi)\b',
-            r'tutti.*\b(corpus|concorrenti|dati|analisi|interventi)\b.*clienti',
-        ]
-        
-        # Controlla se è una query di ricerca file specifici
-        is_file_search_query = False
-        target_file_type = None
-        for pattern in file_search_patterns:
-            match = re.search(pattern, query_lower)
-            if match:
-                is_file_search_query = True
-                target_file_type = match.group(1)
-                # Per query di elenco file, usa k gestibile + deduplicazione intelligente
-                k = 25
-                ColoredOutput.print_info(f"Query di ricerca file '{target_file_type}' rilevata - aumento k a {k}")
-                break
-        
-        # Pattern per query di elenco/lista generiche
-        list_keywords = ['quali', 'elenco', 'lista', 'tutti', 'ogni', 'ciascun']
-        enumeration_keywords = ['cosa ho fatto', 'cosa ho segnato', 'attività', 'journal']
-        
-        # Se contiene keywords di enumerazione e non è già una file search, aumenta k
-        if not is_file_search_query:
-            has_list_keyword = any(keyword in query_lower for keyword in list_keywords)
-            has_enumeration = any(keyword in query_lower for keyword in enumeration_keywords)
-            
-            if has_list_keyword or has_enumeration:
-                # Per query di tipo lista/elenco, usa k più alto
-                k = max(k, 10)
-                ColoredOutput.print_info(f"Query di tipo elenco rilevata - uso k={k}")
-        else:
-            has_list_keyword = False
-        
-        # Pattern di date
-        date_patterns = [
-            (r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})', 'full'),
-            (r'(\d{1,2})[/-](\d{1,2})(?!\d)', 'partial'),
-            (r'\b(oggi|ieri|domani)\b', 'relative'),
-            (r'\b(\d{1,2})\s+(gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre)\s+(\d{4})\b', 'month_year'),
-        ]
-        
-        # Cerca date nella query
-        for pattern, pattern_type in date_patterns:
-            matches = re.findall(pattern, query_lower)
-            if matches:
-                match = matches[0]
-                
-                if pattern_type == 'full':
-                    day, month, year = match
-                    target_journal_date = f"{day.zfill(2)}-{month.zfill(2)}-{year}"
-                    is_journal_list_query = has_list_keyword
-                elif pattern_type == 'partial':
-                    day, month = match
-                    current_year = datetime.now().year
-                    target_journal_date = f"{day.zfill(2)}-{month.zfill(2)}-{current_year}"
-                    is_journal_list_query = has_list_keyword
-                elif pattern_type == 'relative':
-                    oggi = datetime.now()
-                    if match == 'oggi':
-                        target_journal_date = oggi.strftime("%d-%m-%Y")
-                    elif match == 'ieri':
-                        ieri = oggi - timedelta(days=1)
-                        target_journal_date = ieri.strftime("%d-%m-%Y")
-                    elif match == 'domani':
-                        domani = oggi + timedelta(days=1)
-                        target_journal_date = domani.strftime("%d-%m-%Y")
-                    is_journal_list_query = has_list_keyword
-                elif pattern_type == 'month_year':
-                    day, month_name, year = match
-                    mesi = {
-                        'gennaio': '01', 'febbraio': '02', 'marzo': '03', 'aprile': '04',
-                        'maggio': '05', 'giugno': '06', 'luglio': '07', 'agosto': '08',
-                        'settembre': '09', 'ottobre': '10', 'novembre': '11', 'dicembre': '12'
-                    }
-                    month_num = mesi[month_name]
-                    target_journal_date = f"{day.zfill(2)}-{month_num}-{year}"
-                    is_journal_list_query = has_list_keyword
-                break
+        # Analisi intento (file search, elenco, date) con pattern precompilati
+        analysis = self.hybrid_retriever.query_analyzer.analyze(question)
+        
+        is_file_search_query = analysis.is_file_search
+        target_file_type = analysis.target_file_type
+        has_list_keyword = analysis.has_list_keyword
+        has_enumeration = analysis.has_enumeration
+        
+        if is_file_search_query:
+            # Per query di elenco file, usa k gestibile + deduplicazione intelligente
+            k = 25
+            ColoredOutput.print_info(f"Query di ricerca file '{target_file_type}' rilevata - aumento k a {k}")
+        elif has_list_keyword or has_enumeration:
+            # Per query di tipo lista/elenco, usa k più alto
+            k = max(k, 10)
+            ColoredOutput.print_info(f"Query di tipo elenco rilevata - uso k={k}")
         
         # Se è una query per lista Journal, aumenta k per recuperare tutti i chunk del giorno
-        if is_journal_list_query and target_journal_date:
+        is_journal_list_query = analysis.is_journal_list_query
+        target_journal_date = analysis.journal_date
+        if is_journal_list_query:
             # Usa un k molto più alto per essere sicuri di prendere tutti i chunk del giorno
             k = 20
             ColoredOutput.print_info(f"Query Journal rilevata per il {target_journal_date} - recupero tutti i chunk")
         
         # 1. Hybrid Retrieval (Semantic + BM25)
-        docs = self.hybrid_retriever.search(question, k=k)
+        docs = self.hybrid_retriever.search(question, k=k, analysis=analysis)
         
         # Per query di ricerca file specifici, deduplicazione intelligente
         if is_file_search_query and target_file_type:
@@ -328,6 +277,48 @@ class SimpleRAG:
                 docs = filtered_docs
                 ColoredOutput.print_success(f"Trovati {len(docs)} chunk per il Journal del {target_journal_date}")
         
+        # 2. Prompt ottimizzato per tipo di query: le istruzioni statiche vanno nel
+        # prefisso (riusato dalla KV cache del server llamafile), contesto e domanda in coda
+        if is_file_search_query and target_file_type:
+            # Prompt specifico e ottimizzato per query di ricerca file
+            prompt_prefix = f"""Basandoti sul contesto, elenca tutti i clienti che hanno un file {target_file_type}.md.
+
+Fornisci una risposta con formato:
+Ho scritto un file {target_file_type}.md per i seguenti clienti:
+1. [Nome Cliente]
+2. [Nome Cliente]
+...
+"""
+        elif has_list_keyword or has_enumeration:
+            # Prompt per query di tipo elenco
+            prompt_prefix = """Usa il contesto fornito per creare un ELENCO COMPLETO.
+
+IMPORTANTE:
+- Fornisci TUTTI gli elementi trovati, non solo alcuni esempi
+- Per liste di attività, includi lo stato [x] o [ ] di ogni voce
+- Usa un formato lista chiaro e leggibile
+"""
+        else:
+            # Prompt standard
+            prompt_prefix = """Usa SOLO il contesto fornito per rispondere. Sii preciso e conciso.
+
+ISTRUZIONI:
+- Rispondi SOLO basandoti sul contesto sotto
+- Se la domanda riguarda una lista di cose da fare, riporta TUTTE le voci della lista così come appaiono nel contesto
+- Se la domanda riguarda un cliente specifico, usa SOLO i suoi dati
+- Mantieni la risposta breve e diretta
+- Se non hai informazioni sufficienti, dillo chiaramente
+- Per liste di attività, includi lo stato [x] o [ ] di ogni voce
+"""
+        
+        prompt_tail = """
+CONTESTO:
+{context}
+
+DOMANDA: {question}
+
+RISPOSTA:"""
+        
         # Costruisci contesto con metadati per file Journal
         context_parts = []
         for doc in docs:
@@ -343,7 +334,20 @@ class SimpleRAG:
             else:
                 context_parts.append(doc.page_content)
         
-        context = "\n\n".join(context_parts)
+        # Contesto entro la finestra del modello: chunk in ordine di ranking finché c'è
+        # spazio, senza duplicati né il testo ripetuto dall'overlap tra chunk adiacenti
+        packed = self.context_budgeter.pack(
+            context_parts,
+            [doc.metadata.get('source', '') for doc in docs],
+            fixed_prompt=prompt_prefix + prompt_tail.format(context="", question=question)
+        )
+        context = packed["context"]
+        docs = [docs[i] for i in packed["indices"]]
+        if packed["chunks_dropped"] or packed["truncated"]:
+            ColoredOutput.print_info(
+                f"Contesto limitato a {packed['context_tokens']}/{packed['budget']} token: "
+                f"{len(docs)} chunk usati, {packed['chunks_dropped']} esclusi"
+            )
         
         # Debug: mostra chunks recuperati con source files (solo in modalità debug)
         source_files = []
@@ -409,73 +413,25 @@ class SimpleRAG:
                 
                 source_files.append(source_path)
         
-        # 2. Prompt ottimizzato per tipo di query
-        if is_file_search_query and target_file_type:
-            # Prompt specifico e ottimizzato per query di ricerca file
-            prompt_template = f"""Basandoti sul contesto, elenca tutti i clienti che hanno un file {target_file_type}.md.
-
-CONTESTO:
-{{context}}
-
-DOMANDA: {{question}}
-
-Fornisci una risposta con formato:
-Ho scritto un file {target_file_type}.md per i seguenti clienti:
-1. [Nome Cliente]
-2. [Nome Cliente]
-...
-
-RISPOSTA:"""
-        elif has_list_keyword or has_enumeration:
-            # Prompt per query di tipo elenco
-            prompt_template = """Usa il contesto fornito per creare un ELENCO COMPLETO.
-
-CONTESTO:
-{context}
-
-DOMANDA: {question}
-
-IMPORTANTE:
-- Fornisci TUTTI gli elementi trovati, non solo alcuni esempi
-- Per liste di attività, includi lo stato [x] o [ ] di ogni voce
-- Usa un formato lista chiaro e leggibile
-
-RISPOSTA:"""
-        else:
-            # Prompt standard
-            prompt_template = """Usa SOLO il contesto fornito per rispondere. Sii preciso e conciso.
-
-CONTESTO:
-{context}
-
-DOMANDA: {question}
-
-ISTRUZIONI:
-- Rispondi SOLO basandoti sul contesto sopra
-- Se la domanda riguarda una lista di cose da fare, riporta TUTTE le voci della lista così come appaiono nel contesto
-- Se la domanda riguarda un cliente specifico, usa SOLO i suoi dati
-- Mantieni la risposta breve e diretta
-- Se non hai informazioni sufficienti, dillo chiaramente
-- Per liste di attività, includi lo stato [x] o [ ] di ogni voce
-
-RISPOSTA:"""
-        
         # 3. Costruisci prompt finale
-        full_prompt = prompt_template.format(context=context, question=question)
-        
-        # 4. Calcola token del prompt
-        prompt_tokens = self.estimate_tokens(full_prompt)
-        self.token_count["prompt"] += prompt_tokens
+        full_prompt = prompt_prefix + prompt_tail.format(context=context, question=question)
         
-        # 5. Genera risposta direttamente con LLMAdapter
-        response = self.llm.invoke(full_prompt)
+        # 4. Genera risposta direttamente con LLMAdapter (slot scelto in base al prefisso)
+        response = self.llm.invoke(full_prompt, prefix_key=prompt_prefix)
         
-        # 6. Calcola token della risposta
-        completion_tokens = self.estimate_tokens(response)
+        # 5. Token di prompt e risposta: quelli riportati dal server, altrimenti dal tokenizer
+        usage = self.llm.last_usage
+        if usage and usage["prompt_tokens"]:
+            prompt_tokens = usage["prompt_tokens"]
+            completion_tokens = usage["completion_tokens"]
+        else:
+            prompt_tokens = self.estimate_tokens(full_prompt)
+            completion_tokens = self.estimate_tokens(response)
+        self.token_count["prompt"] += prompt_tokens
         self.token_count["completion"] += completion_tokens
         self.token_count["total"] = self.token_count["prompt"] + self.token_count["completion"]
         
-        # 7. Costo zero per modello locale
+        # 6. Costo zero per modello locale
         cost_input = 0.0
         cost_output = 0.0
         cost_total = 0.0
@@ -485,6 +441,18 @@ RISPOSTA:"""
             "completion_tokens": completion_tokens,
             "total_tokens": prompt_tokens + completion_tokens,
             "cumulative_total": self.token_count["total"],
+            "exact": bool(usage and usage["prompt_tokens"]) or self.token_counter.exact,
+            "prompt_cache": self._prompt_cache_report(prompt_prefix),
+            "context_budget": {
+                "n_ctx": self.context_budgeter.n_ctx,
+                "budget": packed["budget"],
+                "context_tokens": packed["context_tokens"],
+                "chunks_used": len(docs),
+                "chunks_dropped": packed["chunks_dropped"],
+                "duplicates_removed": packed["duplicates_removed"],
+                "overlap_chars_removed": packed["overlap_chars_removed"],
+                "truncated": packed["truncated"]
+            },
             "estimated_cost": {
                 "input": f"${cost_input:.6f}",
                 "output": f"${cost_output:.6f}",
@@ -506,7 +474,9 @@ def main():
     
     # Determina il modello in base alla configurazione
     from config import settings
-    if settings.use_llamafile_cli:
+    if settings.use_llamafile_server:
+        ColoredOutput.print_info("Modello: Gemma 3-4B (server locale persistente - gratuito)")
+    elif settings.use_llamafile_cli:
         ColoredOutput.print_info("Modello: Gemma 3-4B (CLI locale - gratuito)")
     elif settings.use_llamafile_api:
         ColoredOutput.print_info("Modello: Gemma 3-4B (Server locale - gratuito)")
@@ -604,8 +574,14 @@ def main():
                 if os.getenv('SHOW_TOKENS', '').lower() == 'true':
                     print()
                     print(ColoredOutput.colored("📊 Token Usage", ColoredOutput.DIM))
-                    print(ColoredOutput.colored(f"   Prompt: {tokens['prompt_tokens']} | Completion: {tokens['completion_tokens']} | Total: {tokens['total_tokens']}", ColoredOutput.DIM))
+                    approx = "" if tokens['exact'] else " (stima)"
+                    print(ColoredOutput.colored(f"   Prompt: {tokens['prompt_tokens']} | Completion: {tokens['completion_tokens']} | Total: {tokens['total_tokens']}{approx}", ColoredOutput.DIM))
                     print(ColoredOutput.colored(f"   Session total: {tokens['cumulative_total']} tokens", ColoredOutput.DIM))
+                    if tokens.get('prompt_cache'):
+                        cache = tokens['prompt_cache']
+                        print(ColoredOutput.colored(f"   Prompt cache: {cache['reused']} riusati | {cache['evaluated']} valutati", ColoredOutput.DIM))
+                    budget = tokens['context_budget']
+                    print(ColoredOutput.colored(f"   Contesto: {budget['context_tokens']}/{budget['budget']} token | {budget['chunks_used']} chunk, {budget['chunks_dropped']} esclusi, {budget['duplicates_removed']} duplicati", ColoredOutput.DIM))
                 
                 ColoredOutput.print_separator()
                 print()
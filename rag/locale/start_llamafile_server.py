@@ -1,104 +1,324 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+"""
+Server llamafile locale gestito come worker persistente.
+
+Il modello viene caricato una sola volta dal processo server; LLMAdapter lo
+avvia automaticamente (get_local_server) e un thread di supervisione ne
+controlla la salute, riavviandolo se il processo termina o smette di
+rispondere. Da riga di comando lo stesso supervisore gestisce start, stop,
+status e supervise (foreground con riavvio automatico).
+"""
+
+import atexit
+import os
+from collections import deque
+import signal
 import subprocess
 import sys
-import os
+import tempfile
+import threading
 import time
-import requests
 from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
 
-def start_llamafile_server():
-    """Avvia il server llamafile"""
-    
-    # Percorso del llamafile
-    llamafile_path = Path("/opt/llm/llamafiles/google_gemma-3-4b-it-Q6_K.llamafile")
-    
-    if not llamafile_path.exists():
-        print(f"❌ Llamafile non trovato: {llamafile_path}")
-        return False
-    
-    # Parametri per il server - ottimizzati per GPU ROCm
-    cmd = [
-        str(llamafile_path),
-        "--server",
-        "--nobrowser",
-        "--port", "8080",
-        "-ngl", "35",      # GPU layers - offload completo su GPU
-        "-c", "8192",      # Context window esteso
-        "--gpu", "AUTO",   # Auto-detect GPU (ROCm)
-        "-t", "8"          # Thread per CPU layers residui
-    ]
-    
-    print(f"🚀 Avvio del server llamafile...")
-    print(f"Comando: {' '.join(cmd)}")
-    
-    try:
-        # Avvia il processo usando shell=True per compatibilità
-        cmd_str = ' '.join(cmd)
-        process = subprocess.Popen(
-            cmd_str,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
-        
-        # Attendi che il server sia pronto
+import requests
+
+from config import settings
+
+
+class LlamafileServer:
+    """Avvio, health check e riavvio del server llamafile"""
+
+    def __init__(self, llamafile_path: str = None, base_url: str = None):
+        self.llamafile_path = Path(llamafile_path or settings.llamafile_path)
+        self.base_url = (base_url or settings.llamafile_base_url).rstrip("/")
+        parsed = urlparse(self.base_url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 8080
+        self.pid_file = Path(tempfile.gettempdir()) / f"llamafile_server_{self.port}.pid"
+        self.log_file = Path(tempfile.gettempdir()) / f"llamafile_server_{self.port}.log"
+
+        self.process: Optional[subprocess.Popen] = None
+        self.attached = False  # Server esterno già attivo, riusato senza avviarne un altro
+        self.restarts = 0  # Totale dall'avvio (informativo)
+        self.restart_times = deque()  # Riavvii nella finestra settings.llamafile_restart_window
+        self.lock = threading.RLock()
+        self._supervisor: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def build_command(self) -> str:
+        """Comando di avvio del server (stringa per shell=True)"""
+        cmd = [
+            str(self.llamafile_path),
+            "--server",
+            "--nobrowser",
+            "--host", self.host,
+            "--port", str(self.port),
+            "--gpu", settings.llamafile_gpu,
+            "-ngl", str(settings.llamafile_n_gpu_layers),
+            "-c", str(settings.llamafile_ctx_size),
+            "-np", str(settings.llamafile_parallel),  # Il contesto viene diviso tra gli slot
+            "-t", str(settings.llamafile_threads)
+        ]
+        return ' '.join(f'"{arg}"' if ' ' in str(arg) else str(arg) for arg in cmd)
+
+    def is_healthy(self, timeout: float = 2) -> bool:
+        """Controlla se il server risponde su /health"""
+        try:
+            response = requests.get(f"{self.base_url}/health", timeout=timeout)
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def is_running(self) -> bool:
+        """Il processo gestito è ancora attivo"""
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, wait: bool = True) -> bool:
+        """
+        Avvia il server se non è già in esecuzione
+
+        Un server già raggiungibile su base_url (es. avviato a mano) viene
+        riusato senza avviarne un altro.
+
+        Returns:
+            bool: True se il server è pronto
+        """
+        with self.lock:
+            if self.is_running():
+                return True
+            if self.is_healthy():
+                self.attached = True
+                return True
+            self.attached = False
+
+            if not self.llamafile_path.exists():
+                raise FileNotFoundError(f"Llamafile non trovato: {self.llamafile_path}")
+
+            cmd = self.build_command()
+            print(f"🚀 Avvio del server llamafile...")
+            print(f"Comando: {cmd}")
+
+            # Output su file: una PIPE non letta bloccherebbe il server una volta piena
+            log = open(self.log_file, "a", encoding="utf-8")
+            self.process = subprocess.Popen(
+                cmd,
+                shell=True,  # Necessario per i llamafile (sono boot sectors)
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True  # Gruppo di processi proprio: stop termina anche il figlio della shell
+            )
+            log.close()
+            self.pid_file.write_text(str(self.process.pid))
+
+        return self.wait_until_ready() if wait else True
+
+    def wait_until_ready(self, timeout: int = None) -> bool:
+        """Attende che /health risponda (caricamento del modello)"""
+        timeout = timeout or settings.llamafile_startup_timeout
         print("⏳ Attendo che il server sia pronto...")
-        max_attempts = 30
-        for attempt in range(max_attempts):
-            try:
-                response = requests.get("http://127.0.0.1:8080/health", timeout=2)
-                if response.status_code == 200:
-                    print("✅ Server llamafile avviato con successo!")
-                    print("🔗 Endpoint: http://127.0.0.1:8080")
-                    return True
-            except requests.exceptions.RequestException:
-                pass
-            
-            time.sleep(1)
-            
-            # Controlla se il processo è ancora in esecuzione
-            if process.poll() is not None:
-                print("❌ Il processo del server è terminato inaspettatamente")
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.is_healthy():
+                print(f"✅ Server llamafile pronto su {self.base_url}")
+                return True
+            if self.process is not None and self.process.poll() is not None:
+                print(f"❌ Il processo del server è terminato inaspettatamente (log: {self.log_file})")
                 return False
-        
+            time.sleep(1)
+
         print("❌ Timeout: il server non è diventato disponibile")
-        process.terminate()
+        self.stop()
         return False
-        
+
+    def stop(self) -> bool:
+        """Ferma il server gestito (o quello indicato nel pid file)"""
+        with self.lock:
+            process = self.process
+            pid = process.pid if process is not None else self._read_pid()
+            self.process = None
+            self.attached = False
+            self.pid_file.unlink(missing_ok=True)
+            if pid is None:
+                return False
+            try:
+                os.killpg(pid, signal.SIGTERM)
+                if process is not None:
+                    try:
+                        process.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        os.killpg(pid, signal.SIGKILL)
+                        process.wait()
+                else:
+                    for _ in range(20):
+                        time.sleep(0.25)
+                        os.killpg(pid, 0)
+                    os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            except PermissionError as e:
+                print(f"❌ Impossibile fermare il server (pid {pid}): {e}")
+                return False
+            return True
+
+    def restart(self) -> bool:
+        with self.lock:
+            self.restarts += 1
+            self.restart_times.append(time.time())
+            print(f"🔄 Riavvio del server llamafile ({len(self.restart_times)}/{settings.llamafile_max_restarts} "
+                  f"negli ultimi {settings.llamafile_restart_window}s)")
+            self.stop()
+            return self.start()
+
+    def ensure_running(self) -> bool:
+        """
+        Verifica economica prima di una generazione: riavvia solo se il
+        processo gestito è terminato
+        """
+        if self.process is not None and self.process.poll() is not None:
+            return self.recover()
+        if self.process is None and not self.attached:
+            return self.start()
+        return True
+
+    def start_supervisor(self, interval: int = None) -> None:
+        """Thread daemon che controlla periodicamente la salute del server"""
+        if self._supervisor is not None and self._supervisor.is_alive():
+            return
+        self._stop_event.clear()
+        self._supervisor = threading.Thread(
+            target=self._supervise, args=(interval or settings.llamafile_health_interval,),
+            name="llamafile-supervisor", daemon=True
+        )
+        self._supervisor.start()
+
+    def stop_supervisor(self) -> None:
+        self._stop_event.set()
+
+    def shutdown(self) -> None:
+        """Ferma supervisione e server, se avviato da questo processo"""
+        self.stop_supervisor()
+        if self.process is not None:
+            self.stop()
+
+    def _supervise(self, interval: int):
+        failures = 0
+        while not self._stop_event.wait(interval):
+            if self.process is not None and self.process.poll() is not None:
+                print(f"⚠️  Server llamafile terminato (codice {self.process.returncode})")
+                self.recover()
+                failures = 0
+                continue
+
+            # Durante una generazione lunga /health può rallentare: serve più di un fallimento
+            if self.is_healthy(timeout=5):
+                failures = 0
+            else:
+                failures += 1
+                if failures >= 3:
+                    print("⚠️  Server llamafile non risponde su /health")
+                    self.recover()
+                    failures = 0
+
+    def recover(self) -> bool:
+        """
+        Riavvia il server se non è stato raggiunto il limite di riavvii nella
+        finestra: un server che crasha in loop viene lasciato fermo, crash
+        isolati nella vita del processo vengono sempre recuperati
+        """
+        with self.lock:
+            window_start = time.time() - settings.llamafile_restart_window
+            while self.restart_times and self.restart_times[0] < window_start:
+                self.restart_times.popleft()
+            if len(self.restart_times) >= settings.llamafile_max_restarts:
+                print("❌ Numero massimo di riavvii del server llamafile raggiunto, nuovo tentativo più tardi")
+                return False
+            return self.restart()
+
+    def _read_pid(self) -> Optional[int]:
+        try:
+            return int(self.pid_file.read_text().strip())
+        except (OSError, ValueError):
+            return None
+
+    def get_info(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "llamafile_path": str(self.llamafile_path),
+            "pid": self.process.pid if self.process is not None else self._read_pid(),
+            "managed": self.process is not None,
+            "healthy": self.is_healthy(),
+            "restarts": self.restarts,
+            "recent_restarts": len(self.restart_times),
+            "log_file": str(self.log_file)
+        }
+
+
+_local_server: Optional[LlamafileServer] = None
+_local_server_lock = threading.Lock()
+
+
+def get_local_server() -> LlamafileServer:
+    """
+    Server llamafile condiviso dal processo, avviato e supervisionato al primo uso
+
+    Il server avviato qui viene fermato all'uscita dell'interprete; un server
+    già attivo (es. start da riga di comando) viene solo riusato.
+    """
+    global _local_server
+    with _local_server_lock:
+        if _local_server is None:
+            server = LlamafileServer()
+            if not server.start():
+                raise ConnectionError(f"Server llamafile non avviato (log: {server.log_file})")
+            server.start_supervisor()
+            atexit.register(server.shutdown)
+            _local_server = server
+    return _local_server
+
+
+def start_llamafile_server():
+    """Avvia il server llamafile in background (resta attivo dopo l'uscita)"""
+    try:
+        return LlamafileServer().start()
     except Exception as e:
         print(f"❌ Errore nell'avvio del server: {e}")
         return False
 
+
 def check_server_status():
     """Controlla se il server è in esecuzione"""
-    try:
-        response = requests.get("http://127.0.0.1:8080/health", timeout=2)
-        return response.status_code == 200
-    except requests.exceptions.RequestException:
-        return False
+    return LlamafileServer().is_healthy()
+
 
 def stop_server():
-    """Ferma il server llamafile"""
-    try:
-        # Trova e termina il processo
-        result = subprocess.run(
-            ["pkill", "-f", "granite-3.2-8b-instruct-Q4_K_M.llamafile"],
-            capture_output=True,
-            text=True
-        )
-        if result.returncode == 0:
-            print("🛑 Server fermato con successo")
-            return True
-        else:
-            print("⚠️  Nessun processo server trovato")
-            return False
-    except Exception as e:
-        print(f"❌ Errore nel fermare il server: {e}")
+    """Ferma il server llamafile avviato da questo script"""
+    if LlamafileServer().stop():
+        print("🛑 Server fermato con successo")
+        return True
+    print("⚠️  Nessun processo server trovato")
+    return False
+
+
+def supervise_server():
+    """Avvia il server e lo riavvia in caso di crash finché non si preme Ctrl+C"""
+    server = LlamafileServer()
+    if not server.start():
         return False
+    server.start_supervisor()
+    print("👀 Supervisione attiva (Ctrl+C per fermare il server)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop_supervisor()
+        server.stop()
+        print("🛑 Server fermato")
+    return True
+
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
@@ -111,7 +331,9 @@ if __name__ == "__main__":
                 print("✅ Server in esecuzione")
             else:
                 print("❌ Server non in esecuzione")
+        elif sys.argv[1] == "supervise":
+            supervise_server()
         else:
-            print("Uso: python start_llamafile_server.py [start|stop|status]")
+            print("Uso: python start_llamafile_server.py [start|stop|status|supervise]")
     else:
-        start_llamafile_server()
\ No newline at end of file
+        start_llamafile_server()
@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import time
 import json
+import atexit
 import hashlib
 from typing import Any, Optional, Dict, Callable
 from functools import wraps
 from pathlib import Path
 import pickle
-import redis
+import threading
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import redis
+except ImportError:  # Opzionale: non presente nell'installazione minimale
+    redis = None
 from datetime import datetime, timedelta
 
 from utils.logger import StructuredLogger
@@ -107,13 +116,26 @@ class InMemoryCache(CacheBackend):
 
 
 class DiskCache(CacheBackend):
-    """Cache su disco con serializzazione"""
+    """
+    Cache su disco con serializzazione
+
+    Le entry sono tenute in ordine LRU: oltre max_entries le meno recenti
+    vengono eliminate. index.json viene riscritto ogni flush_every modifiche
+    (e all'uscita), e un lock protegge indice e file dai thread concorrenti.
+    """
     
-    def __init__(self, cache_dir: Path = Path("./cache")):
+    def __init__(self, cache_dir: Path = Path("./cache"), max_entries: Optional[int] = None,
+                 flush_every: int = 1):
         self.cache_dir = cache_dir
         self.cache_dir.mkdir(exist_ok=True)
         self.index_file = self.cache_dir / "index.json"
+        self.max_entries = max_entries
+        self.flush_every = max(1, flush_every)
+        self.pending_writes = 0
+        self.lock = threading.RLock()
         self._load_index()
+        if self.flush_every > 1:
+            atexit.register(self.flush)
         logger.info(f"Inizializzata cache su disco in: {cache_dir}")
     
     def _load_index(self):
@@ -123,38 +145,75 @@ class DiskCache(CacheBackend):
                 self.index = json.load(f)
         else:
             self.index = {}
+        
+        # Allinea indice e file rimasti disallineati (es. uscita prima del flush)
+        self.index = {key: entry for key, entry in self.index.items()
+                      if (self.cache_dir / entry['file']).exists()}
+        indexed_files = {entry['file'] for entry in self.index.values()}
+        for cache_file in self.cache_dir.glob("*.pkl"):
+            if cache_file.name not in indexed_files:
+                cache_file.unlink()
     
     def _save_index(self):
-        """Salva indice delle entries"""
-        with open(self.index_file, 'w') as f:
+        """Salva indice delle entries (scrittura atomica)"""
+        tmp_file = self.index_file.with_suffix('.json.tmp')
+        with open(tmp_file, 'w') as f:
             json.dump(self.index, f)
+        os.replace(tmp_file, self.index_file)
+        self.pending_writes = 0
+    
+    def _mark_dirty(self):
+        """Registra una modifica e salva l'indice ogni flush_every modifiche"""
+        self.pending_writes += 1
+        if self.pending_writes >= self.flush_every:
+            self._save_index()
+    
+    def flush(self) -> None:
+        """Scrive su disco le modifiche pendenti dell'indice"""
+        with self.lock:
+            if self.pending_writes:
+                self._save_index()
     
     def _get_cache_file(self, key: str) -> Path:
         """Ottiene path del file cache"""
         key_hash = hashlib.md5(key.encode()).hexdigest()
         return self.cache_dir / f"{key_hash}.pkl"
     
+    def _evict(self):
+        """Elimina le entry meno recenti oltre max_entries"""
+        if not self.max_entries:
+            return
+        while len(self.index) > self.max_entries:
+            key = next(iter(self.index))
+            cache_file = self._get_cache_file(key)
+            if cache_file.exists():
+                cache_file.unlink()
+            del self.index[key]
+    
     def get(self, key: str) -> Optional[Any]:
-        if key not in self.index:
-            return None
-        
-        entry = self.index[key]
-        if entry['expires_at'] and time.time() > entry['expires_at']:
-            self.delete(key)
-            return None
-        
-        cache_file = self._get_cache_file(key)
-        if not cache_file.exists():
-            return None
-        
-        try:
-            with open(cache_file, 'rb') as f:
-                value = pickle.load(f)
-            logger.debug(f"Cache hit su disco per key: {key}")
-            return value
-        except Exception as e:
-            logger.error(f"Errore lettura cache", exception=e, key=key)
-            return None
+        with self.lock:
+            if key not in self.index:
+                return None
+            
+            entry = self.index[key]
+            if entry['expires_at'] and time.time() > entry['expires_at']:
+                self.delete(key)
+                return None
+            
+            cache_file = self._get_cache_file(key)
+            if not cache_file.exists():
+                return None
+            
+            try:
+                with open(cache_file, 'rb') as f:
+                    value = pickle.load(f)
+                # Ordine LRU aggiornato in memoria, persistito al prossimo salvataggio
+                self.index[key] = self.index.pop(key)
+                logger.debug(f"Cache hit su disco per key: {key}")
+                return value
+            except Exception as e:
+                logger.error(f"Errore lettura cache", exception=e, key=key)
+                return None
     
     def set(self, key: str, value: Any, ttl: int = None) -> None:
         expires_at = None
@@ -163,52 +222,60 @@ class DiskCache(CacheBackend):
         
         cache_file = self._get_cache_file(key)
         
-        try:
-            with open(cache_file, 'wb') as f:
-                pickle.dump(value, f)
-            
-            self.index[key] = {
-                'expires_at': expires_at,
-                'created_at': time.time(),
-                'file': str(cache_file.name)
-            }
-            self._save_index()
-            logger.debug(f"Valore salvato su disco per key: {key}")
-        except Exception as e:
-            logger.error(f"Errore scrittura cache", exception=e, key=key)
+        with self.lock:
+            try:
+                with open(cache_file, 'wb') as f:
+                    pickle.dump(value, f)
+                
+                self.index.pop(key, None)
+                self.index[key] = {
+                    'expires_at': expires_at,
+                    'created_at': time.time(),
+                    'file': str(cache_file.name)
+                }
+                self._evict()
+                self._mark_dirty()
+                logger.debug(f"Valore salvato su disco per key: {key}")
+            except Exception as e:
+                logger.error(f"Errore scrittura cache", exception=e, key=key)
     
     def delete(self, key: str) -> None:
-        if key in self.index:
-            cache_file = self._get_cache_file(key)
-            if cache_file.exists():
-                cache_file.unlink()
-            del self.index[key]
-            self._save_index()
-            logger.debug(f"Eliminata entry cache su disco: {key}")
+        with self.lock:
+            if key in self.index:
+                cache_file = self._get_cache_file(key)
+                if cache_file.exists():
+                    cache_file.unlink()
+                del self.index[key]
+                self._mark_dirty()
+                logger.debug(f"Eliminata entry cache su disco: {key}")
     
     def clear(self) -> None:
-        for cache_file in self.cache_dir.glob("*.pkl"):
-            cache_file.unlink()
-        self.index = {}
-        self._save_index()
+        with self.lock:
+            for cache_file in self.cache_dir.glob("*.pkl"):
+                cache_file.unlink()
+            self.index = {}
+            self._save_index()
         logger.info("Cache su disco svuotata")
     
     def exists(self, key: str) -> bool:
-        if key not in self.index:
-            return False
-        
-        entry = self.index[key]
-        if entry['expires_at'] and time.time() > entry['expires_at']:
-            self.delete(key)
-            return False
-        
-        return self._get_cache_file(key).exists()
+        with self.lock:
+            if key not in self.index:
+                return False
+            
+            entry = self.index[key]
+            if entry['expires_at'] and time.time() > entry['expires_at']:
+                self.delete(key)
+                return False
+            
+            return self._get_cache_file(key).exists()
 
 
 class RedisCache(CacheBackend):
     """Cache Redis per deployment distribuiti"""
     
     def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0):
+        if redis is None:
+            raise ImportError("Il pacchetto redis è richiesto per RedisCache")
         try:
             self.client = redis.Redis(host=host, port=port, db=db, decode_responses=True)
             self.client.ping()
@@ -287,11 +354,14 @@ class CacheManager:
         total_requests = self.stats['hits'] + self.stats['misses']
         hit_rate = self.stats['hits'] / total_requests if total_requests > 0 else 0
         
-        return {
+        stats = {
             **self.stats,
             'hit_rate': hit_rate,
             'total_requests': total_requests
         }
+        if _embedding_cache_instance is not None:
+            stats['query_embeddings'] = _embedding_cache_instance.get_stats()
+        return stats
     
     def cache_decorator(self, ttl: int = None, key_prefix: str = ""):
         """Decorator per caching automatico di funzioni"""
@@ -318,8 +388,161 @@ class CacheManager:
         return decorator
 
 
+class EmbeddingCache:
+    """
+    Cache LRU limitata per gli embedding delle query.
+
+    La chiave è nome modello + testo normalizzato (spazi compressi), i valori
+    sono vettori float32. Opzionalmente le entry vengono persistite su un
+    backend secondario (es. DiskCache) e ricaricate al primo accesso.
+    """
+    
+    def __init__(self, max_size: int = 1024, backend: CacheBackend = None):
+        self.max_size = max_size
+        self.backend = backend
+        self.entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'disk_hits': 0,
+            'evictions': 0
+        }
+    
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        """Chiave di cache per modello e testo normalizzato"""
+        normalized = ' '.join(text.split())
+        return f"{model_name}:{normalized}"
+    
+    def get(self, model_name: str, text: str) -> Optional[np.ndarray]:
+        key = self.make_key(model_name, text)
+        with self.lock:
+            vector = self.entries.get(key)
+            if vector is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return vector
+        
+        if self.backend is not None:
+            stored = self.backend.get(hashlib.md5(key.encode()).hexdigest())
+            if stored is not None:
+                vector = np.asarray(stored, dtype=np.float32)
+                with self.lock:
+                    self.stats['hits'] += 1
+                    self.stats['disk_hits'] += 1
+                    self._store(key, vector)
+                return vector
+        
+        with self.lock:
+            self.stats['misses'] += 1
+        return None
+    
+    def set(self, model_name: str, text: str, vector) -> np.ndarray:
+        key = self.make_key(model_name, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)  # Condiviso tra i chiamanti
+        with self.lock:
+            self._store(key, vector)
+        if self.backend is not None:
+            self.backend.set(hashlib.md5(key.encode()).hexdigest(), vector)
+        return vector
+    
+    def _store(self, key: str, vector: np.ndarray) -> None:
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+    
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Ottiene statistiche della cache embedding"""
+        total_requests = self.stats['hits'] + self.stats['misses']
+        return {
+            **self.stats,
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hit_rate': self.stats['hits'] / total_requests if total_requests > 0 else 0,
+            'total_requests': total_requests
+        }
+
+
+class RerankScoreCache:
+    """
+    Cache LRU limitata per gli score del reranker.
+
+    La chiave è (namespace, hash della query normalizzata, id del chunk), dove
+    il namespace identifica modello e lunghezza massima usati per lo score.
+    """
+    
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.entries: "OrderedDict[tuple, float]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0
+        }
+    
+    @staticmethod
+    def query_hash(query: str) -> str:
+        """Hash della query normalizzata (spazi compressi)"""
+        return hashlib.md5(' '.join(query.split()).encode()).hexdigest()
+    
+    def get_many(self, namespace: str, query: str, chunk_ids: list) -> list:
+        """Score in cache per ogni chunk (None se assente)"""
+        query_key = self.query_hash(query)
+        scores = []
+        with self.lock:
+            for chunk_id in chunk_ids:
+                key = (namespace, query_key, chunk_id)
+                score = self.entries.get(key)
+                if score is None:
+                    self.stats['misses'] += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                scores.append(score)
+        return scores
+    
+    def set_many(self, namespace: str, query: str, chunk_ids: list, scores) -> None:
+        query_key = self.query_hash(query)
+        with self.lock:
+            for chunk_id, score in zip(chunk_ids, scores):
+                key = (namespace, query_key, chunk_id)
+                self.entries[key] = float(score)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+    
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Ottiene statistiche della cache degli score"""
+        total_requests = self.stats['hits'] + self.stats['misses']
+        return {
+            **self.stats,
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hit_rate': self.stats['hits'] / total_requests if total_requests > 0 else 0,
+            'total_requests': total_requests
+        }
+
+
 # Singleton globale per cache
 _cache_instance: Optional[CacheManager] = None
+_embedding_cache_instance: Optional[EmbeddingCache] = None
+_rerank_cache_instance: Optional[RerankScoreCache] = None
 
 
 def get_cache() -> CacheManager:
@@ -339,6 +562,33 @@ def get_cache() -> CacheManager:
     return _cache_instance
 
 
+def get_embedding_cache() -> EmbeddingCache:
+    """Ottiene istanza singleton della cache degli embedding delle query"""
+    global _embedding_cache_instance
+    
+    if _embedding_cache_instance is None:
+        backend = None
+        if settings.embedding_cache_persist:
+            backend = DiskCache(Path(settings.embedding_cache_dir),
+                                max_entries=settings.embedding_cache_disk_size,
+                                flush_every=settings.embedding_cache_flush_every)
+        _embedding_cache_instance = EmbeddingCache(settings.embedding_cache_size, backend)
+        logger.info(f"Cache embedding query inizializzata (max {settings.embedding_cache_size} entries)")
+    
+    return _embedding_cache_instance
+
+
+def get_rerank_cache() -> RerankScoreCache:
+    """Ottiene istanza singleton della cache degli score del reranker"""
+    global _rerank_cache_instance
+    
+    if _rerank_cache_instance is None:
+        _rerank_cache_instance = RerankScoreCache(settings.rerank_cache_size)
+        logger.info(f"Cache score reranker inizializzata (max {settings.rerank_cache_size} entries)")
+    
+    return _rerank_cache_instance
+
+
 class NullCache(CacheBackend):
     """Cache nulla che non salva niente"""
     
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
@@ -9,14 +9,14 @@ from typing import List, Optional, Dict, Any
 import uvicorn
 from pathlib import Path
 import aiofiles
-import asyncio
 from datetime import datetime
 
 from config import settings
 from utils.logger import StructuredLogger
 from utils.security import SecurityValidator, RateLimiter, generate_session_id
+from utils.cache import get_cache
 from chatbot_v2 import RAGChatbot
-from ingest_v2 import IngestPipeline
+from ingest_v2 import IngestJob, IngestJobQueue
 
 
 logger = StructuredLogger(__name__, log_file=Path("logs/api.log"))
@@ -43,6 +43,19 @@ security_validator = SecurityValidator()
 rate_limiter = RateLimiter(max_requests=60, window_seconds=60)
 
 
+def reload_chatbot_index(job: IngestJob):
+    """Ricarica l'index del chatbot dopo un job di ingestione completato e invalida le risposte in cache"""
+    chatbot.vector_store.load(settings.faiss_index_path)
+    if job.kind == "files":
+        chatbot.invalidate_answers(job.result.get("sources_updated", []))
+    else:
+        chatbot.invalidate_answers()  # Index ricostruito o compattato
+
+
+# Un solo worker di ingestione con pipeline (e modello di embedding) condivisa
+ingest_queue = IngestJobQueue(on_index_updated=reload_chatbot_index)
+
+
 # Modelli Pydantic
 class ChatRequest(BaseModel):
     query: str = Field(..., min_length=1, max_length=1000)
@@ -65,9 +78,23 @@ class IngestRequest(BaseModel):
 class IngestResponse(BaseModel):
     status: str
     message: str
+    job_id: Optional[str] = None
     stats: Optional[Dict[str, Any]] = None
 
 
+class IngestJobResponse(BaseModel):
+    job_id: str
+    kind: str
+    status: str
+    paths: List[str]
+    progress: Dict[str, Any]
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+
+
 class HealthResponse(BaseModel):
     status: str
     timestamp: str
@@ -164,32 +191,21 @@ async def chat_stream(request: ChatRequest, session_id: str = Depends(check_rate
     from fastapi.responses import StreamingResponse
     import json
     
+    if request.session_id:
+        session_id = request.session_id
+    elif session_id == "anonymous":
+        session_id = generate_session_id()
+    
     async def generate():
         try:
-            # Genera risposta (qui potresti implementare streaming reale)
-            result = await chatbot.generate_response(request.query, session_id)
-            
-            # Simula streaming
-            words = result["response"].split()
-            for i, word in enumerate(words):
-                chunk = {
-                    "type": "content",
-                    "content": word + " ",
-                    "done": i == len(words) - 1
-                }
-                yield f"data: {json.dumps(chunk)}\n\n"
-                await asyncio.sleep(0.05)  # Simula delay
-            
-            # Invia metadata finale
-            metadata = {
-                "type": "metadata",
-                "sources": result.get("sources", []),
-                "chunks_used": result.get("chunks_used", 0),
-                "response_time": result.get("response_time", 0)
-            }
-            yield f"data: {json.dumps(metadata)}\n\n"
+            # Inoltra i token man mano che arrivano dall'LLM (fonti in testa)
+            async for event in chatbot.stream_response(request.query, session_id):
+                if event["type"] == "sources" and not request.include_sources:
+                    event = {**event, "sources": None}
+                yield f"data: {json.dumps(event)}\n\n"
             
         except Exception as e:
+            logger.error("Errore in chat stream endpoint", exception=e)
             error = {"type": "error", "error": str(e)}
             yield f"data: {json.dumps(error)}\n\n"
     
@@ -226,11 +242,8 @@ async def clear_session(session_id: str):
 
 
 @app.post("/ingest", response_model=IngestResponse)
-async def ingest_documents(
-    request: IngestRequest,
-    background_tasks: BackgroundTasks
-):
-    """Avvia processo di ingestione documenti"""
+async def ingest_documents(request: IngestRequest):
+    """Accoda l'ingestione di una directory; lo stato si segue su /ingest/{job_id}"""
     try:
         directory = Path(request.directory) if request.directory else settings.documents_path
         
@@ -241,18 +254,13 @@ async def ingest_documents(
         if not directory.exists():
             raise HTTPException(status_code=404, detail="Directory not found")
         
-        # Avvia ingestione in background
-        def run_ingest():
-            pipeline = IngestPipeline()
-            return pipeline.run(directory)
-        
-        # Per ora eseguiamo in modo sincrono (in produzione usare Celery o simili)
-        result = run_ingest()
+        # Accoda al worker di ingestione
+        job = ingest_queue.submit_directory(directory)
         
         return IngestResponse(
-            status=result["status"],
-            message=result.get("message", "Ingestione completata"),
-            stats=result if result["status"] == "success" else None
+            status=job.status,
+            message="Ingestione accodata",
+            job_id=job.job_id
         )
         
     except HTTPException:
@@ -262,12 +270,34 @@ async def ingest_documents(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/ingest/compact", response_model=IngestResponse)
+async def compact_index():
+    """Accoda la compattazione dell'index (chunk duplicati e documenti orfani)"""
+    job = ingest_queue.submit_compaction()
+    return IngestResponse(status=job.status, message="Compattazione accodata", job_id=job.job_id)
+
+
+@app.get("/ingest/jobs", response_model=List[IngestJobResponse])
+async def list_ingest_jobs():
+    """Elenca i job di ingestione recenti"""
+    return [job.to_dict() for job in ingest_queue.list_jobs()]
+
+
+@app.get("/ingest/{job_id}", response_model=IngestJobResponse)
+async def get_ingest_job(job_id: str):
+    """Stato e avanzamento di un job di ingestione"""
+    job = ingest_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
 @app.post("/upload")
 async def upload_document(
     file: UploadFile = File(...),
     process: bool = True
 ):
-    """Upload e processa un singolo documento"""
+    """Upload di un documento; se process, viene accodato (in batch con altri upload)"""
     try:
         # Valida file
         if not file.filename:
@@ -299,12 +329,11 @@ async def upload_document(
             "processed": False
         }
         
-        # Processa se richiesto
+        # Accoda se richiesto: lo stato si segue su /ingest/{job_id}
         if process:
-            pipeline = IngestPipeline()
-            result = pipeline.update_document(file_path)
-            response["processed"] = result["status"] == "success"
-            response["chunks_added"] = result.get("chunks_added", 0)
+            job = ingest_queue.submit_files([file_path])
+            response["job_id"] = job.job_id
+            response["job_status"] = job.status
         
         return response
         
@@ -318,10 +347,11 @@ async def upload_document(
 @app.get("/stats")
 async def get_stats():
     """Ottiene statistiche del sistema"""
-    cache_stats = chatbot.cache.get_stats()
+    cache_stats = get_cache().get_stats()
     
     return {
         "cache": cache_stats,
+        "semantic_cache": chatbot.answer_cache.get_stats(),
         "sessions": {
             "active": len(chatbot.memory.conversations),
             "total_messages": sum(
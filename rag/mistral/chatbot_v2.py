@@ -3,9 +3,11 @@
 
 import os
 import sys
+import hashlib
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from langchain_mistralai import ChatMistralAI
@@ -18,7 +20,7 @@ from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from config import settings
 from utils.logger import StructuredLogger
 from utils.security import SecurityValidator, RateLimiter, generate_session_id
-from utils.cache import get_cache
+from utils.cache import get_cache, get_semantic_cache
 from core.vector_store import VectorStoreFactory, VectorStoreManager
 
 
@@ -27,6 +29,13 @@ cache = get_cache()
 rate_limiter = RateLimiter(max_requests=30, window_seconds=60)
 
 
+def chunk_id(doc: Document) -> str:
+    """ID del chunk nel vector store (o impronta di sorgente e contenuto se assente)"""
+    if getattr(doc, "id", None):
+        return doc.id
+    return hashlib.md5(f"{doc.metadata.get('source', '')}\x00{doc.page_content}".encode("utf-8")).hexdigest()
+
+
 class ConversationMemory:
     """Gestisce la memoria delle conversazioni"""
     
@@ -72,6 +81,17 @@ class RAGChatbot:
         self.vector_store.load(settings.faiss_index_path)
         self.vector_manager = VectorStoreManager(self.vector_store)
         
+        # Pool limitato per retrieval ed embedding (sincroni) fuori dall'event loop;
+        # le query identiche già in corso condividono lo stesso risultato
+        self.retrieval_executor = ThreadPoolExecutor(
+            max_workers=settings.retrieval_workers,
+            thread_name_prefix="retrieval"
+        )
+        self.inflight_retrievals: Dict[str, asyncio.Future] = {}
+        
+        # Risposte riusabili tra sessioni per query semanticamente equivalenti
+        self.answer_cache = get_semantic_cache()
+        
         # Inizializza LLM
         self.llm = ChatMistralAI(
             model=settings.llm_model_name,
@@ -120,13 +140,18 @@ NON inventare MAI informazioni non presenti nel contesto."""
         
         return "\n---\n".join(formatted_docs)
     
-    def retrieve_context(self, query: str, session_id: str) -> Tuple[List[Document], str]:
-        """Recupera contesto rilevante"""
+    def retrieve_context(
+        self, 
+        query: str, 
+        session_id: str, 
+        query_embedding: Optional[List[float]] = None
+    ) -> Tuple[List[Document], str]:
+        """Recupera contesto rilevante (query_embedding: embedding già calcolato dalla cache semantica)"""
         # Sanitizza query
         clean_query = self.security_validator.sanitize_user_input(query)
         
-        # Check cache
-        cache_key = f"context:{session_id}:{hash(clean_query)}"
+        # Check cache (il contesto non dipende dalla sessione)
+        cache_key = f"context:{hash(clean_query)}"
         cached_result = cache.get(cache_key)
         if cached_result:
             logger.debug("Contesto recuperato da cache", session_id=session_id)
@@ -136,7 +161,8 @@ NON inventare MAI informazioni non presenti nel contesto."""
         retrieved_docs = self.vector_manager.hybrid_search(
             clean_query, 
             k=settings.top_k_chunks,
-            keyword_weight=0.3
+            keyword_weight=0.3,
+            query_embedding=query_embedding
         )
         
         # Formatta contesto
@@ -155,33 +181,144 @@ NON inventare MAI informazioni non presenti nel contesto."""
         
         return result
     
+    async def aretrieve_context(
+        self, 
+        query: str, 
+        session_id: str, 
+        query_embedding: Optional[List[float]] = None
+    ) -> Tuple[List[Document], str]:
+        """
+        Recupera il contesto nel pool di retrieval senza bloccare l'event loop
+        
+        Le richieste concorrenti con la stessa query (dopo la sanitizzazione)
+        attendono lo stesso retrieval invece di ripeterlo.
+        """
+        clean_query = self.security_validator.sanitize_user_input(query)
+        
+        future = self.inflight_retrievals.get(clean_query)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self.retrieval_executor, self.retrieve_context, query, session_id, query_embedding
+            )
+            self.inflight_retrievals[clean_query] = future
+            future.add_done_callback(lambda _: self.inflight_retrievals.pop(clean_query, None))
+        else:
+            logger.debug("Retrieval condiviso con una richiesta in corso", session_id=session_id)
+        
+        # shield: la cancellazione di un client non interrompe il retrieval degli altri
+        return await asyncio.shield(future)
+    
+    def lookup_answer(self, query: str) -> Tuple[List[float], Optional[Dict[str, Any]]]:
+        """
+        Cerca una risposta in cache semantica per la query
+        
+        Returns:
+            Embedding della query (per salvare la risposta in caso di miss)
+            e entry della cache o None
+        """
+        clean_query = self.security_validator.sanitize_user_input(query)
+        query_embedding = self.vector_store.embeddings.embed_query(clean_query)
+        return query_embedding, self.answer_cache.lookup(query_embedding, self.vector_store.index_version())
+    
+    async def alookup_answer(self, query: str) -> Tuple[List[float], Optional[Dict[str, Any]]]:
+        """lookup_answer nel pool di retrieval (l'embedding della query è sincrono)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.retrieval_executor, self.lookup_answer, query)
+    
+    def remember_answer(
+        self, 
+        query: str, 
+        query_embedding: List[float], 
+        retrieved_docs: List[Document], 
+        answer: str, 
+        standalone: bool
+    ) -> None:
+        """
+        Salva la risposta in cache semantica
+        
+        Solo le risposte a domande senza storia di conversazione dipendono
+        unicamente da domanda e chunk, e possono quindi servire altre sessioni.
+        """
+        if not standalone or not retrieved_docs:
+            return
+        self.answer_cache.store(
+            self.security_validator.sanitize_user_input(query),
+            query_embedding,
+            [chunk_id(doc) for doc in retrieved_docs],
+            [doc.metadata.get("source", "Unknown") for doc in retrieved_docs],
+            answer,
+            self.vector_store.index_version()
+        )
+    
+    def invalidate_answers(self, sources: Optional[List[str]] = None) -> int:
+        """
+        Invalida le risposte in cache dopo un'ingestione
+        
+        Args:
+            sources: File reindicizzati; None dopo una ricostruzione o
+                compattazione dell'index (svuota tutta la cache)
+        """
+        # I contesti in cache (per testo della query) possono contenere chunk sostituiti
+        cache.clear()
+        if sources is None:
+            self.answer_cache.clear()
+            return 0
+        return self.answer_cache.invalidate_sources(sources, self.vector_store.index_version())
+    
+    def build_messages(self, query: str, session_id: str, context: str) -> List:
+        """Prepara i messaggi per l'LLM con contesto e storia della conversazione"""
+        # Prepara storia conversazione
+        history = []
+        for msg in self.memory.get_history(session_id)[-6:]:  # Ultimi 3 scambi
+            if msg["role"] == "user":
+                history.append(HumanMessage(content=msg["content"]))
+            else:
+                history.append(AIMessage(content=msg["content"]))
+        
+        return self.prompt_template.format_messages(
+            context=context,
+            question=query,
+            history=history
+        )
+    
     @rate_limiter.rate_limit_decorator(lambda self, query, session_id: session_id)
     async def generate_response(self, query: str, session_id: str) -> Dict[str, Any]:
         """Genera risposta alla query"""
         start_time = datetime.utcnow()
         
         try:
-            # Recupera contesto
-            retrieved_docs, context = self.retrieve_context(query, session_id)
+            # Risposta già generata per una query equivalente (anche da altre sessioni):
+            # solo per domande senza storia, come le risposte salvate
+            standalone = not self.memory.get_history(session_id)
+            query_embedding, cached = await self.alookup_answer(query) if standalone else (None, None)
+            if cached:
+                self.memory.add_message(session_id, "user", query)
+                self.memory.add_message(session_id, "assistant", cached["answer"])
+                elapsed_time = (datetime.utcnow() - start_time).total_seconds()
+                logger.info(
+                    "Risposta da cache semantica",
+                    session_id=session_id,
+                    similarity=cached["similarity"],
+                    response_time=elapsed_time
+                )
+                return {
+                    "response": cached["answer"],
+                    "sources": cached["sources"],
+                    "chunks_used": len(cached["chunk_ids"]),
+                    "response_time": elapsed_time,
+                    "cached": True,
+                    "session_id": session_id
+                }
             
-            # Prepara storia conversazione
-            history = []
-            for msg in self.memory.get_history(session_id)[-6:]:  # Ultimi 3 scambi
-                if msg["role"] == "user":
-                    history.append(HumanMessage(content=msg["content"]))
-                else:
-                    history.append(AIMessage(content=msg["content"]))
+            # Recupera contesto
+            retrieved_docs, context = await self.aretrieve_context(query, session_id, query_embedding)
             
             # Genera risposta
-            response = await self.llm.ainvoke(
-                self.prompt_template.format_messages(
-                    context=context,
-                    question=query,
-                    history=history
-                )
-            )
+            response = await self.llm.ainvoke(self.build_messages(query, session_id, context))
             
             response_text = response.content
+            self.remember_answer(query, query_embedding, retrieved_docs, response_text, standalone)
             
             # Salva in memoria
             self.memory.add_message(session_id, "user", query)
@@ -216,6 +353,82 @@ NON inventare MAI informazioni non presenti nel contesto."""
                 "session_id": session_id
             }
     
+    @rate_limiter.rate_limit_decorator(lambda self, query, session_id: session_id)
+    async def stream_response(self, query: str, session_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Genera la risposta in streaming
+        
+        Emette prima un evento "sources" con i metadati del retrieval, poi un
+        evento "content" per ogni token ricevuto dall'LLM e infine un evento
+        "metadata" con i tempi di risposta.
+        """
+        start_time = datetime.utcnow()
+        
+        # Risposta in cache semantica (solo senza storia): emessa come un unico evento di contenuto
+        standalone = not self.memory.get_history(session_id)
+        query_embedding, cached = await self.alookup_answer(query) if standalone else (None, None)
+        if cached:
+            yield {"type": "sources", "sources": cached["sources"], "chunks_used": len(cached["chunk_ids"])}
+            yield {"type": "content", "content": cached["answer"], "done": False}
+            yield {"type": "content", "content": "", "done": True}
+            self.memory.add_message(session_id, "user", query)
+            self.memory.add_message(session_id, "assistant", cached["answer"])
+            elapsed_time = (datetime.utcnow() - start_time).total_seconds()
+            yield {
+                "type": "metadata",
+                "sources": cached["sources"],
+                "chunks_used": len(cached["chunk_ids"]),
+                "response_time": elapsed_time,
+                "first_token_time": elapsed_time,
+                "cached": True
+            }
+            return
+        
+        # Recupera contesto
+        retrieved_docs, context = await self.aretrieve_context(query, session_id, query_embedding)
+        sources = [doc.metadata.get("source", "Unknown") for doc in retrieved_docs]
+        yield {
+            "type": "sources",
+            "sources": sources,
+            "chunks_used": len(retrieved_docs)
+        }
+        
+        first_token_time = None
+        response_parts = []
+        async for chunk in self.llm.astream(self.build_messages(query, session_id, context)):
+            if not chunk.content:
+                continue
+            if first_token_time is None:
+                first_token_time = (datetime.utcnow() - start_time).total_seconds()
+            response_parts.append(chunk.content)
+            yield {"type": "content", "content": chunk.content, "done": False}
+        
+        response_text = "".join(response_parts)
+        yield {"type": "content", "content": "", "done": True}
+        self.remember_answer(query, query_embedding, retrieved_docs, response_text, standalone)
+        
+        # Salva in memoria solo a risposta completa
+        self.memory.add_message(session_id, "user", query)
+        self.memory.add_message(session_id, "assistant", response_text)
+        
+        elapsed_time = (datetime.utcnow() - start_time).total_seconds()
+        logger.info(
+            "Risposta generata in streaming",
+            session_id=session_id,
+            response_time=elapsed_time,
+            first_token_time=first_token_time,
+            chunks_used=len(retrieved_docs)
+        )
+        
+        yield {
+            "type": "metadata",
+            "sources": sources,
+            "chunks_used": len(retrieved_docs),
+            "response_time": elapsed_time,
+            "first_token_time": first_token_time,
+            "cached": False
+        }
+    
     def run_interactive(self):
         """Modalità interattiva CLI"""
         print("\n🤖 RAG Chatbot v2.0")
@@ -266,6 +479,9 @@ NON inventare MAI informazioni non presenti nel contesto."""
                     print(f"   Cache hits: {stats['hits']}")
                     print(f"   Cache misses: {stats['misses']}")
                     print(f"   Hit rate: {stats['hit_rate']:.1%}")
+                    semantic_stats = self.answer_cache.get_stats()
+                    print(f"   Risposte in cache semantica: {semantic_stats['entries']} "
+                          f"(hit rate {semantic_stats['hit_rate']:.1%})")
                     continue
                 
                 # Genera risposta
@@ -27,6 +27,17 @@ class Settings(BaseSettings):
     top_k_chunks: int = 5
     chunk_size: int = 1000
     chunk_overlap: int = 200
+    retrieval_workers: int = 4  # Thread per retrieval ed embedding fuori dall'event loop
+    # Struttura dell'index FAISS (stringa di faiss.index_factory): "Flat" esatto,
+    # "HNSW32" o "IVF1024,Flat" / "IVF1024,PQ32" per vault grandi (le eliminazioni
+    # su index non Flat ricostruiscono l'index dai vettori rimanenti)
+    faiss_index_spec: str = "Flat"
+    faiss_nprobe: int = 16      # Liste IVF visitate per query
+    faiss_ef_search: int = 64   # Ampiezza di ricerca HNSW
+    
+    # Ingestion in background
+    ingest_batch_delay: float = 0.5  # Secondi di attesa per raggruppare upload ravvicinati
+    ingest_max_jobs: int = 100       # Job conclusi mantenuti per le query di stato
     
     # Security
     max_file_size_mb: int = 50
@@ -39,6 +50,9 @@ class Settings(BaseSettings):
     # Cache
     enable_cache: bool = True
     cache_ttl_seconds: int = 3600
+    # Cache semantica delle risposte (condivisa tra le sessioni)
+    semantic_cache_threshold: float = 0.95  # Similarità coseno minima tra le query
+    semantic_cache_max_entries: int = 1000
     
     # Docling Preprocessing
     enable_docling_preprocessing: bool = True
@@ -3,8 +3,15 @@
 
 import os
 import sys
+import time
+import argparse
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Callable, Iterable
 import asyncio
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -28,6 +35,9 @@ from utils.cache import get_cache
 logger = StructuredLogger(__name__, log_file=Path("logs/ingest.log"))
 cache = get_cache()
 
+# Callback di avanzamento: (fase, elementi processati, totale)
+ProgressCallback = Callable[[str, int, int], None]
+
 
 class DocumentProcessor:
     """Processa documenti per l'ingestione"""
@@ -126,7 +136,11 @@ class DocumentProcessor:
             logger.error(f"Errore processing documenti", exception=e)
             return []
     
-    def load_all_documents(self, directory: Path) -> List[Document]:
+    def load_all_documents(
+        self, 
+        directory: Path, 
+        progress_callback: Optional[ProgressCallback] = None
+    ) -> List[Document]:
         """Carica tutti i documenti da una directory"""
         all_documents = []
         file_paths = []
@@ -147,13 +161,16 @@ class DocumentProcessor:
                 for file_path in file_paths
             }
             
-            for future in as_completed(future_to_file):
+            for done, future in enumerate(as_completed(future_to_file), 1):
                 file_path = future_to_file[future]
                 try:
                     documents = future.result()
                     all_documents.extend(documents)
                 except Exception as e:
                     logger.error(f"Errore caricamento parallelo", exception=e, file=str(file_path))
+                
+                if progress_callback:
+                    progress_callback("loading", done, len(future_to_file))
         
         return all_documents
 
@@ -163,19 +180,34 @@ class IngestPipeline:
     
     def __init__(self, vector_store_type: str = "faiss"):
         self.processor = DocumentProcessor()
+        self.vector_store_type = vector_store_type
         self.vector_store = VectorStoreFactory.create(vector_store_type)
         self.vector_manager = VectorStoreManager(self.vector_store)
+        self.index_loaded = False
         logger.info(f"Pipeline inizializzata con {vector_store_type} vector store")
     
-    def run(self, documents_path: Path = None) -> Dict[str, Any]:
-        """Esegue pipeline di ingestione"""
+    def load_index(self) -> None:
+        """Carica l'index esistente, una sola volta, prima degli aggiornamenti incrementali"""
+        if self.index_loaded:
+            return
+        
+        if (settings.faiss_index_path / "index.faiss").exists():
+            self.vector_store.load(settings.faiss_index_path)
+        self.index_loaded = True
+    
+    def run(
+        self, 
+        documents_path: Path = None, 
+        progress_callback: Optional[ProgressCallback] = None
+    ) -> Dict[str, Any]:
+        """Esegue pipeline di ingestione (ricostruisce l'index da zero)"""
         documents_path = documents_path or settings.documents_path
         
         logger.info(f"Avvio ingestione da: {documents_path}")
         
         # 1. Carica documenti
         logger.info("Fase 1: Caricamento documenti...")
-        raw_documents = self.processor.load_all_documents(documents_path)
+        raw_documents = self.processor.load_all_documents(documents_path, progress_callback)
         
         if not raw_documents:
             logger.error("Nessun documento caricato")
@@ -191,9 +223,16 @@ class IngestPipeline:
         
         # 3. Crea embeddings e salva
         logger.info("Fase 3: Creazione embeddings e indicizzazione...")
+        if progress_callback:
+            progress_callback("indexing", 0, len(chunks))
         try:
+            self.vector_store.reset()
             self.vector_store.add_documents(chunks)
             self.vector_store.save(settings.faiss_index_path)
+            self.index_loaded = True
+            
+            if progress_callback:
+                progress_callback("indexing", len(chunks), len(chunks))
             
             # Statistiche
             stats = {
@@ -213,34 +252,277 @@ class IngestPipeline:
     
     def update_document(self, file_path: Path) -> Dict[str, Any]:
         """Aggiorna un singolo documento nell'indice"""
-        logger.info(f"Aggiornamento documento: {file_path}")
+        return self.update_documents([file_path])
+    
+    def update_documents(
+        self, 
+        file_paths: List[Path], 
+        progress_callback: Optional[ProgressCallback] = None
+    ) -> Dict[str, Any]:
+        """
+        Aggiorna più documenti nell'indice con un solo passaggio di embedding
+        e un solo salvataggio
         
-        # Carica documento
-        documents = self.processor.load_document(file_path)
-        if not documents:
-            return {"status": "error", "message": "Impossibile caricare documento"}
+        Args:
+            file_paths: File da (re)indicizzare
+            progress_callback: Notificato a ogni file caricato e all'indicizzazione
+            
+        Returns:
+            Dict con status, chunks_added, chunks_removed, files_processed e files_failed
+        """
+        logger.info(f"Aggiornamento di {len(file_paths)} documenti")
         
-        # Processa
-        chunks = self.processor.process_documents(documents)
+        # Carica e processa file per file (chunk_index relativo al singolo file)
+        chunks = []
+        files_failed = []
+        for done, file_path in enumerate(file_paths, 1):
+            documents = self.processor.load_document(Path(file_path))
+            if documents:
+                chunks.extend(self.processor.process_documents(documents))
+            else:
+                files_failed.append(str(file_path))
+            
+            if progress_callback:
+                progress_callback("loading", done, len(file_paths))
         
-        # TODO: Implementare rimozione vecchi chunks prima di aggiungere nuovi
-        # Per ora aggiungiamo solo i nuovi
+        if not chunks:
+            message = "Impossibile caricare documento" if len(file_paths) == 1 else "Nessun documento caricato"
+            return {"status": "error", "message": message, "files_failed": files_failed}
         
+        if progress_callback:
+            progress_callback("indexing", 0, len(chunks))
         try:
-            self.vector_store.add_documents(chunks)
+            # I chunk della versione precedente dei file vengono sostituiti, non duplicati
+            self.load_index()
+            chunks_removed = self.vector_store.replace_documents(chunks)
             self.vector_store.save(settings.faiss_index_path)
             
+            if progress_callback:
+                progress_callback("indexing", len(chunks), len(chunks))
+            
             return {
                 "status": "success",
-                "chunks_added": len(chunks)
+                "chunks_added": len(chunks),
+                "chunks_removed": chunks_removed,
+                "files_processed": len(file_paths) - len(files_failed),
+                "files_failed": files_failed,
+                "sources_updated": sorted(set(doc.metadata.get("source", "") for doc in chunks))
             }
         except Exception as e:
-            logger.error("Errore aggiornamento documento", exception=e)
+            logger.error("Errore aggiornamento documenti", exception=e)
+            return {"status": "error", "message": str(e), "files_failed": files_failed}
+    
+    def compact_index(self, drop_missing_sources: bool = False) -> Dict[str, Any]:
+        """Compatta l'index FAISS (chunk duplicati, file rimossi, documenti orfani) e lo salva"""
+        if self.vector_store_type != "faiss":
+            return {"status": "error", "message": "Compattazione supportata solo per FAISS"}
+        
+        try:
+            self.load_index()
+            stats = self.vector_store.compact(drop_missing_sources)
+            if not stats:
+                return {"status": "error", "message": "Nessun index da compattare"}
+            
+            self.vector_store.save(settings.faiss_index_path)
+            return {"status": "success", **stats}
+        except Exception as e:
+            logger.error("Errore compattazione index", exception=e)
             return {"status": "error", "message": str(e)}
 
 
+class IngestJob:
+    """Job di ingestione in coda: directory completa, batch di file caricati o compattazione"""
+    
+    def __init__(self, kind: str, paths: Iterable[Path]):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind  # 'directory', 'files' o 'compact'
+        self.paths: List[Path] = list(paths)
+        self.status = "queued"  # queued -> running -> completed | failed
+        self.phase = "queued"
+        self.processed = 0
+        self.total = 0
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+    
+    def update_progress(self, phase: str, processed: int, total: int):
+        self.phase = phase
+        self.processed = processed
+        self.total = total
+    
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("completed", "failed")
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Stato serializzabile per l'API"""
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "paths": [str(path) for path in self.paths],
+            "progress": {
+                "phase": self.phase,
+                "processed": self.processed,
+                "total": self.total,
+                "percent": round(100 * self.processed / self.total, 1) if self.total else 0.0
+            },
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class IngestJobQueue:
+    """
+    Coda di ingestione in-process con un solo worker.
+    
+    Il worker mantiene una IngestPipeline (e quindi il modello di embedding e
+    l'index caricato) per tutta la vita del processo. Gli upload che arrivano
+    mentre un job di file è ancora in coda vengono aggiunti allo stesso job,
+    così un burst di upload produce un solo passaggio di embedding e un solo
+    salvataggio dell'index.
+    """
+    
+    def __init__(
+        self,
+        vector_store_type: str = "faiss",
+        batch_delay: float = None,
+        max_jobs: int = None,
+        on_index_updated: Optional[Callable[[IngestJob], None]] = None
+    ):
+        self.vector_store_type = vector_store_type
+        self.batch_delay = settings.ingest_batch_delay if batch_delay is None else batch_delay
+        self.max_jobs = max_jobs or settings.ingest_max_jobs
+        self.on_index_updated = on_index_updated
+        
+        self.jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self.pending_files_job: Optional[IngestJob] = None  # Job di file ancora aperto a nuovi upload
+        self.pipeline: Optional[IngestPipeline] = None
+        self._queue: "queue.Queue[Optional[IngestJob]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run_worker, name="ingest-worker", daemon=True)
+        self._worker.start()
+        logger.info("Coda di ingestione avviata")
+    
+    def submit_directory(self, directory: Path) -> IngestJob:
+        """Accoda la re-ingestione completa di una directory"""
+        job = IngestJob("directory", [directory])
+        with self._lock:
+            self._register(job)
+        self._queue.put(job)
+        logger.info("Job di ingestione accodato", job_id=job.job_id, directory=str(directory))
+        return job
+    
+    def submit_files(self, file_paths: List[Path]) -> IngestJob:
+        """Accoda file da indicizzare, unendoli al job di file ancora in attesa se presente"""
+        with self._lock:
+            job = self.pending_files_job
+            if job is not None and job.status == "queued":
+                job.paths.extend(path for path in file_paths if path not in job.paths)
+                logger.debug("File aggiunti a job in coda", job_id=job.job_id, files=len(job.paths))
+                return job
+            
+            job = IngestJob("files", file_paths)
+            self.pending_files_job = job
+            self._register(job)
+        self._queue.put(job)
+        logger.info("Job di upload accodato", job_id=job.job_id, files=len(file_paths))
+        return job
+    
+    def submit_compaction(self) -> IngestJob:
+        """Accoda la compattazione dell'index (eseguita dal worker, mai in parallelo agli aggiornamenti)"""
+        job = IngestJob("compact", [])
+        with self._lock:
+            self._register(job)
+        self._queue.put(job)
+        logger.info("Job di compattazione accodato", job_id=job.job_id)
+        return job
+    
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self.jobs.get(job_id)
+    
+    def list_jobs(self) -> List[IngestJob]:
+        with self._lock:
+            return list(self.jobs.values())
+    
+    def shutdown(self, timeout: Optional[float] = None):
+        """Ferma il worker dopo i job già in coda"""
+        self._queue.put(None)
+        self._worker.join(timeout)
+    
+    def _register(self, job: IngestJob):
+        """Registra un job eliminando i job conclusi più vecchi oltre max_jobs (chiamare con lock)"""
+        self.jobs[job.job_id] = job
+        for job_id in [jid for jid, old in self.jobs.items() if old.is_finished]:
+            if len(self.jobs) <= self.max_jobs:
+                break
+            del self.jobs[job_id]
+    
+    def _get_pipeline(self) -> IngestPipeline:
+        if self.pipeline is None:
+            self.pipeline = IngestPipeline(self.vector_store_type)
+        return self.pipeline
+    
+    def _run_worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            
+            if job.kind == "files" and self.batch_delay > 0:
+                # Lascia il tempo agli upload ravvicinati di unirsi al batch
+                time.sleep(self.batch_delay)
+            
+            with self._lock:
+                if self.pending_files_job is job:
+                    self.pending_files_job = None
+                job.status = "running"
+                job.started_at = datetime.now()
+            
+            self._process(job)
+    
+    def _process(self, job: IngestJob):
+        try:
+            pipeline = self._get_pipeline()
+            if job.kind == "directory":
+                result = pipeline.run(job.paths[0], progress_callback=job.update_progress)
+            elif job.kind == "compact":
+                result = pipeline.compact_index()
+            else:
+                result = pipeline.update_documents(job.paths, progress_callback=job.update_progress)
+            error = None if result["status"] == "success" else result.get("message", "Ingestione fallita")
+        except Exception as e:
+            logger.error("Errore nel job di ingestione", exception=e, job_id=job.job_id)
+            result, error = None, str(e)
+        
+        job.result = result
+        job.error = error
+        job.finished_at = datetime.now()
+        job.status = "failed" if error else "completed"
+        logger.info("Job di ingestione concluso", job_id=job.job_id, status=job.status)
+        
+        if job.status == "completed" and self.on_index_updated:
+            try:
+                self.on_index_updated(job)
+            except Exception as e:
+                logger.error("Errore nel ricaricamento dell'index", exception=e, job_id=job.job_id)
+
+
 def main():
     """Entry point"""
+    parser = argparse.ArgumentParser(description="Ingestione documenti")
+    parser.add_argument("--compact", action="store_true",
+                        help="Compatta l'index esistente (duplicati e orfani) senza reindicizzare")
+    parser.add_argument("--drop-missing", action="store_true",
+                        help="Con --compact, rimuove anche i chunks di file non più presenti")
+    args = parser.parse_args()
+    
     try:
         # Verifica API key
         if not settings.mistral_api_key:
@@ -254,8 +536,20 @@ def main():
             print(f"❌ Directory '{settings.documents_path}' non trovata")
             return
         
-        # Esegui pipeline
         pipeline = IngestPipeline()
+        
+        if args.compact:
+            result = pipeline.compact_index(drop_missing_sources=args.drop_missing)
+            if result["status"] == "success":
+                print(f"\n✅ Index compattato: {result['chunks_before']} -> {result['chunks_after']} chunks")
+                print(f"🔁 Duplicati rimossi: {result['duplicates_removed']}")
+                print(f"🗑️ Chunks di file rimossi: {result['missing_sources_removed']}")
+                print(f"👻 Documenti orfani rimossi: {result['orphans_removed']}")
+            else:
+                print(f"\n❌ Errore: {result['message']}")
+            return
+        
+        # Esegui pipeline
         result = pipeline.run()
         
         if result["status"] == "success":
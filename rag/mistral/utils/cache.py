@@ -4,10 +4,13 @@
 import time
 import json
 import hashlib
-from typing import Any, Optional, Dict, Callable
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Dict, Callable, Iterable, List
 from functools import wraps
 from pathlib import Path
 import pickle
+import numpy as np
 import redis
 from datetime import datetime, timedelta
 
@@ -318,6 +321,171 @@ class CacheManager:
         return decorator
 
 
+class SemanticAnswerCache:
+    """
+    Cache delle risposte condivisa tra le sessioni, indicizzata per similarità
+    dell'embedding della query
+    
+    Ogni entry conserva embedding (normalizzato) della query, ID e sorgenti
+    dei chunk recuperati e risposta generata. Una nuova query con similarità
+    coseno >= threshold con una query in cache riusa la risposta senza
+    retrieval né chiamata all'LLM. Le entry vengono invalidate dall'ingestione
+    quando cambiano i file da cui provengono i loro chunk.
+    
+    Ogni entry registra anche la versione dell'index (VectorStore.index_version)
+    da cui sono stati recuperati i chunk: una entry di una versione diversa da
+    quella corrente non viene servita, così anche un index aggiornato da un
+    altro processo (CLI di ingestione, compattazione) non restituisce risposte
+    basate su chunk non più presenti.
+    """
+    
+    def __init__(self, threshold: float = None, max_entries: int = None, ttl: int = None):
+        self.threshold = settings.semantic_cache_threshold if threshold is None else threshold
+        self.max_entries = settings.semantic_cache_max_entries if max_entries is None else max_entries
+        self.ttl = settings.cache_ttl_seconds if ttl is None else ttl
+        self.entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()  # Ordine LRU
+        self.lock = threading.Lock()
+        self._next_id = 0
+        self._matrix: Optional[np.ndarray] = None  # Embedding delle entry, ricostruita dopo ogni modifica
+        self._matrix_ids: List[int] = []
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'invalidated': 0
+        }
+    
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+    
+    def _is_expired(self, entry: Dict[str, Any]) -> bool:
+        return bool(self.ttl) and time.time() - entry['created_at'] > self.ttl
+    
+    def _vectors(self) -> np.ndarray:
+        """Matrice degli embedding in cache (chiamare con lock)"""
+        if self._matrix is None:
+            self._matrix_ids = list(self.entries)
+            self._matrix = (np.vstack([self.entries[i]['embedding'] for i in self._matrix_ids])
+                            if self._matrix_ids else None)
+        return self._matrix
+    
+    def _remove(self, entry_ids: Iterable[int]) -> int:
+        """Rimuove entry per ID (chiamare con lock)"""
+        removed = 0
+        for entry_id in list(entry_ids):
+            if self.entries.pop(entry_id, None) is not None:
+                removed += 1
+        if removed:
+            self._matrix = None
+        return removed
+    
+    def lookup(self, query_embedding, index_version: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Risposta in cache per la query più simile sopra soglia
+        
+        Args:
+            query_embedding: Embedding della query
+            index_version: Versione corrente dell'index; le entry di altre versioni sono ignorate
+        
+        Returns:
+            Entry (query, answer, chunk_ids, sources, similarity) o None
+        """
+        query_vector = self._normalize(query_embedding)
+        with self.lock:
+            self._remove([i for i, entry in self.entries.items() if self._is_expired(entry)])
+            vectors = self._vectors()
+            if vectors is None or vectors.shape[1] != query_vector.shape[0]:
+                self.stats['misses'] += 1
+                return None
+            
+            similarities = vectors @ query_vector
+            stale = [self.entries[i]['index_version'] != index_version for i in self._matrix_ids]
+            similarities[np.asarray(stale, dtype=bool)] = -np.inf
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.stats['misses'] += 1
+                return None
+            
+            entry_id = self._matrix_ids[best]
+            self.entries.move_to_end(entry_id)
+            self.stats['hits'] += 1
+            entry = self.entries[entry_id]
+            return {
+                'query': entry['query'],
+                'answer': entry['answer'],
+                'chunk_ids': list(entry['chunk_ids']),
+                'sources': list(entry['sources']),
+                'similarity': similarity
+            }
+    
+    def store(
+        self, 
+        query: str, 
+        query_embedding, 
+        chunk_ids: List[str], 
+        sources: List[str], 
+        answer: str, 
+        index_version: Optional[str] = None
+    ) -> None:
+        """Salva la risposta generata con i chunk (e la versione dell'index) da cui dipende"""
+        if self.max_entries <= 0:
+            return
+        entry = {
+            'query': query,
+            'embedding': self._normalize(query_embedding),
+            'chunk_ids': list(chunk_ids),
+            'sources': list(sources),
+            'answer': answer,
+            'index_version': index_version,
+            'created_at': time.time()
+        }
+        with self.lock:
+            self.entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._matrix = None
+            self.stats['sets'] += 1
+    
+    def invalidate_sources(self, sources: Iterable[str], index_version: Optional[str] = None) -> int:
+        """
+        Rimuove le risposte basate su chunk dei file indicati (re-ingestione)
+        
+        Le risposte rimanenti restano valide e passano a index_version, la
+        versione dell'index dopo l'aggiornamento.
+        """
+        changed = set(sources)
+        with self.lock:
+            removed = self._remove(
+                i for i, entry in self.entries.items() if changed.intersection(entry['sources'])
+            )
+            for entry in self.entries.values():
+                entry['index_version'] = index_version
+            self.stats['invalidated'] += removed
+        if removed:
+            logger.info(f"Invalidate {removed} risposte in cache semantica")
+        return removed
+    
+    def clear(self) -> None:
+        with self.lock:
+            self.stats['invalidated'] += len(self.entries)
+            self.entries.clear()
+            self._matrix = None
+        logger.info("Cache semantica svuotata")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        total_requests = self.stats['hits'] + self.stats['misses']
+        return {
+            **self.stats,
+            'entries': len(self.entries),
+            'hit_rate': self.stats['hits'] / total_requests if total_requests > 0 else 0,
+            'threshold': self.threshold
+        }
+
+
 # Singleton globale per cache
 _cache_instance: Optional[CacheManager] = None
 
@@ -339,6 +507,21 @@ def get_cache() -> CacheManager:
     return _cache_instance
 
 
+_semantic_cache_instance: Optional[SemanticAnswerCache] = None
+
+
+def get_semantic_cache() -> SemanticAnswerCache:
+    """Ottiene istanza singleton della cache semantica delle risposte"""
+    global _semantic_cache_instance
+    
+    if _semantic_cache_instance is None:
+        # Con la cache disabilitata nessuna risposta viene salvata
+        max_entries = settings.semantic_cache_max_entries if settings.enable_cache else 0
+        _semantic_cache_instance = SemanticAnswerCache(max_entries=max_entries)
+    
+    return _semantic_cache_instance
+
+
 class NullCache(CacheBackend):
     """Cache nulla che non salva niente"""
     